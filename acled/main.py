@@ -1,15 +1,50 @@
-import requests
 import csv
 import logging
+import sys
+
+import store
 
-from arcgis.gis import GIS
 from datetime import date
 from optparse import OptionParser
 
 from configparser import ConfigParser
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from common.chunked_upload import add_unique_index, upload_chunks  # noqa
+from common.http import default_client  # noqa
+from common.metrics import Metrics  # noqa
+
+client = default_client()
+metrics = Metrics("acled")
+metrics.include(client=client)
 
 parser = OptionParser()
 parser.add_option("-c", "--config", dest="config", default="config.txt")
+parser.add_option(
+    "--offline",
+    dest="offline",
+    action="store_true",
+    default=False,
+    help="Build the slice from the local store without calling the API",
+)
+parser.add_option(
+    "--no-upload",
+    dest="upload",
+    action="store_false",
+    default=True,
+    help="Only export the slice to csv",
+)
+parser.add_option("-o", "--output", dest="output", default=None)
+parser.add_option(
+    "--countries", dest="countries", help="Comma separated iso codes"
+)
+parser.add_option("--start-date", dest="start_date")
+parser.add_option("--end-date", dest="end_date")
+parser.add_option(
+    "--event-types", dest="event_types", help="Comma separated event types"
+)
 options, _ = parser.parse_args()
 
 # get config info
@@ -21,13 +56,13 @@ logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
 FILENAME = config.get("MISC", "FILENAME")
 TEMP_PATH = f"/tmp/{FILENAME}.csv"
+STORE_PATH = config.get("MISC", "STORE_PATH", fallback=f"/tmp/{FILENAME}")
 
 
-def fetch():
+def fetch(countries, watermark=None):
     ACLED_API_URL = config.get("ACLED", "API_URL")
     ACLED_KEY = config.get("ACLED", "KEY")
     ACLED_EMAIL = config.get("ACLED", "EMAIL")
-    ISO_COUNTRIES = config.get("ACLED", "ISO_COUNTRIES").split(",")
     START_DATE = config.get("MISC", "START_DATE")
 
     logger.info("Fetching data from acled API")
@@ -35,72 +70,180 @@ def fetch():
     params = dict(
         key=ACLED_KEY,
         email=ACLED_EMAIL,
-        iso="|".join(ISO_COUNTRIES),
+        iso="|".join(countries),
         event_date=f"{START_DATE}|{date.today().isoformat()}",
         event_date_where="BETWEEN",
         page=1,
     )
 
-    if len(ISO_COUNTRIES) > 1:
+    if watermark is not None:
+        logger.info(f"Fetching rows modified since {watermark}")
+        params.update(dict(timestamp=watermark, timestamp_where=">="))
+
+    if len(countries) > 1:
         params["iso_where"] = "="
 
     len_data = -1
 
     csv_file = []
     while len_data != 0:
-        data = requests.get(ACLED_API_URL, params=params).json()["data"]
+        with metrics.stage("fetch"):
+            data = client.get(ACLED_API_URL, params=params).json()["data"]
         csv_file.extend(data)
         len_data = len(data)
         params["page"] = params["page"] + 1
+        metrics.count("pages")
+
+    metrics.count("events", len(csv_file))
 
     return csv_file
 
 
-def upload_arcgis():
+def update_store():
+    ISO_COUNTRIES = config.get("ACLED", "ISO_COUNTRIES").split(",")
+
+    watermarks = store.get_watermarks(STORE_PATH)
+
+    # Countries never fetched need the whole history, the rest only rows
+    # modified since their last sync.
+    new_countries = [c for c in ISO_COUNTRIES if c not in watermarks]
+    known_countries = [c for c in ISO_COUNTRIES if c in watermarks]
+
+    data = []
+    if len(new_countries) > 0:
+        data.extend(fetch(new_countries))
+
+    if len(known_countries) > 0:
+        watermark = min(watermarks[c] for c in known_countries)
+        data.extend(fetch(known_countries, watermark))
+
+    with metrics.stage("write"):
+        num_rows = store.update(STORE_PATH, data)
+    logger.info(f"Merged {num_rows} rows into local store")
+    metrics.rows("store", inserted=num_rows)
+
+
+def export(path):
+    countries = options.countries or config.get("ACLED", "ISO_COUNTRIES")
+    event_types = None
+    if options.event_types:
+        event_types = options.event_types.split(",")
+
+    df = store.query(
+        STORE_PATH,
+        countries=countries.split(","),
+        start_date=options.start_date or config.get("MISC", "START_DATE"),
+        end_date=options.end_date or date.today().isoformat(),
+        event_types=event_types,
+    )
+
+    df.to_csv(path, index=False)
+    logger.info(f"Exported {len(df)} rows to {path}")
+
+    return len(df)
+
+
+def upload_arcgis(path):
+    from arcgis.gis import GIS
+
     ARCGIS_USER = config.get("ARCGIS", "USER")
     ARCGIS_PW = config.get("ARCGIS", "PW")
     ARCGIS_URL = config.get("ARCGIS", "URL")
+    CHUNK_SIZE = config.getint("ARCGIS", "CHUNK_SIZE", fallback=1000)
 
     gis = GIS(ARCGIS_URL, ARCGIS_USER, ARCGIS_PW)
-    content_data = f"title:{FILENAME} type:CSV owner:{ARCGIS_USER}"
-    items = gis.content.search(content_data)
-
-    item_params = dict(title=FILENAME)
-    overwrite = False
-    if len(items) > 0:
-        logger.info("Updating file in Arcgis")
-        item = items[0]
-        item.update(item_params, data=TEMP_PATH)
-        overwrite = True
-    else:
+    content_data = f"title:{FILENAME} type:Feature Service owner:{ARCGIS_USER}"
+    item = next((f for f in gis.content.search(content_data)), None)
+
+    with open(path, "r") as f:
+        rows = [r for r in csv.DictReader(f)]
+
+    # Rows of the second of a watermark may have been merged into the store
+    # after it was uploaded, they are sent again.
+    uploads = {}
+    if item is not None:
+        uploads = store.get_watermarks(STORE_PATH, store.UPLOADS_FILE)
+        rows = [
+            r
+            for r in rows
+            if int(r["timestamp"]) >= uploads.get(r["iso"], 0)
+        ]
+
+    if len(rows) == 0:
+        logger.info("Layer up to date")
+        return
+
+    for row in rows:
+        uploads[row["iso"]] = max(
+            int(row["timestamp"]), uploads.get(row["iso"], 0)
+        )
+
+    if item is None:
         logger.info("Uploading file to Arcgis")
-        item = gis.content.add(item_params, data=TEMP_PATH)
-
-    item.share(everyone=True)
 
-    logger.info("Publishing layer")
-    publish_params = dict(
-        name=FILENAME,
-        type="csv",
-        locationType="coordinates",
-        latitudeFieldName="latitude",
-        longitudeFieldName="longitude",
-    )
-    item = item.publish(publish_parameters=publish_params, overwrite=overwrite)
-    item.share(everyone=True)
+        # Publish from the first chunk, the rest is sent in batches below.
+        first_path = f"/tmp/{FILENAME}_first.csv"
+        with open(first_path, "w", newline="") as output_file:
+            dict_writer = csv.DictWriter(output_file, rows[0].keys())
+            dict_writer.writeheader()
+            dict_writer.writerows(rows[:CHUNK_SIZE])
+
+        item = gis.content.add(dict(title=FILENAME), data=first_path)
+        item.share(everyone=True)
+
+        logger.info("Publishing layer")
+        publish_params = dict(
+            name=FILENAME,
+            type="csv",
+            locationType="coordinates",
+            latitudeFieldName="latitude",
+            longitudeFieldName="longitude",
+        )
+        item = item.publish(publish_parameters=publish_params)
+        item.share(everyone=True)
+
+        add_unique_index(item.layers[0], store.KEY_FIELD)
+
+        rows = rows[CHUNK_SIZE:]
+
+    if len(rows) > 0:
+        logger.info(f"Upserting {len(rows)} rows into layer")
+        upload_chunks(
+            item.layers[0],
+            rows,
+            x_field="longitude",
+            y_field="latitude",
+            key_field=store.KEY_FIELD,
+            chunk_size=CHUNK_SIZE,
+            workers=config.getint("ARCGIS", "WORKERS", fallback=4),
+            retries=config.getint("ARCGIS", "RETRIES", fallback=3),
+            checkpoint_path=f"/tmp/{FILENAME}_upload.json",
+        )
+
+    # Only once every row is in the layer, a failed upload is sent again.
+    store.set_watermarks(STORE_PATH, uploads, store.UPLOADS_FILE)
 
 
 def main():
-    data = fetch()
+    if options.offline is False:
+        update_store()
+        client.stats.log()
+
+    path = options.output or TEMP_PATH
+    with metrics.stage("export"):
+        num_rows = export(path)
+
+    if options.upload is False:
+        return
 
-    keys = data[0].keys()
-    with open(TEMP_PATH, "w", newline="") as output_file:
-        dict_writer = csv.DictWriter(output_file, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(data)
+    if num_rows == 0:
+        logger.info("Data not found")
+        return
 
-    upload_arcgis()
+    with metrics.stage("upload"):
+        upload_arcgis(path)
 
 
 if __name__ == "__main__":
-    main()
+    with metrics.run():
+        main()
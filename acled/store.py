@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+
+from os.path import basename, dirname, exists, isdir, join
+
+import pandas as pd
+
+logger = logging.getLogger()
+
+KEY_FIELD = "event_id_cnty"
+WATERMARKS_FILE = "_watermarks.json"
+# Latest timestamp per iso sent to the ArcGIS layer.
+UPLOADS_FILE = "_uploads.json"
+
+
+def partition_path(root, iso, year):
+    return join(root, f"iso={iso}", f"year={year}", "data.parquet")
+
+
+def get_watermarks(root, name=WATERMARKS_FILE):
+    path = join(root, name)
+    if not exists(path):
+        return {}
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def set_watermarks(root, watermarks, name=WATERMARKS_FILE):
+    os.makedirs(root, exist_ok=True)
+    path = join(root, name)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(watermarks, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def update(root, data):
+    """Merge fetched rows into their iso/year partitions."""
+    if len(data) == 0:
+        return 0
+
+    df = pd.DataFrame(data)
+    df["timestamp"] = df["timestamp"].astype(int)
+
+    for (iso, year), rows in df.groupby(["iso", "year"]):
+        path = partition_path(root, iso, year)
+        if exists(path):
+            rows = pd.concat(
+                [pd.read_parquet(path), rows], ignore_index=True, sort=False
+            )
+
+        rows = rows.sort_values("timestamp").drop_duplicates(
+            KEY_FIELD, keep="last"
+        )
+
+        os.makedirs(dirname(path), exist_ok=True)
+        rows.to_parquet(f"{path}.tmp", index=False)
+        os.replace(f"{path}.tmp", path)
+
+        logger.info(f"Stored {len(rows)} rows in partition {iso}/{year}")
+
+    # An edited event_date moves an event to another year partition, the
+    # copy left in the old one is removed.
+    for iso, rows in df.groupby("iso"):
+        rows = rows.sort_values("timestamp")
+        years = dict(zip(rows[KEY_FIELD], rows["year"].astype(str)))
+        for path in list_partitions(root, [iso]):
+            year = basename(dirname(path))[5:]
+            stored = pd.read_parquet(path)
+            moved = stored[KEY_FIELD].map(years)
+            stale = moved.notna() & (moved != year)
+            if not stale.any():
+                continue
+
+            stored = stored[~stale]
+            stored.to_parquet(f"{path}.tmp", index=False)
+            os.replace(f"{path}.tmp", path)
+            logger.info(
+                f"Removed {int(stale.sum())} moved rows from {iso}/{year}"
+            )
+
+    watermarks = get_watermarks(root)
+    for iso, timestamp in df.groupby("iso")["timestamp"].max().items():
+        watermarks[iso] = max(int(timestamp), watermarks.get(iso, 0))
+    set_watermarks(root, watermarks)
+
+    return len(df)
+
+
+def list_partitions(root, countries=None, start_date=None, end_date=None):
+    if not isdir(root):
+        return []
+
+    start_year = int(start_date[:4]) if start_date else None
+    end_year = int(end_date[:4]) if end_date else None
+
+    paths = []
+    for iso_dir in os.listdir(root):
+        if not iso_dir.startswith("iso="):
+            continue
+        if countries and iso_dir[4:] not in countries:
+            continue
+
+        for year_dir in os.listdir(join(root, iso_dir)):
+            year = int(year_dir[5:])
+            if start_year is not None and year < start_year:
+                continue
+            if end_year is not None and year > end_year:
+                continue
+
+            path = join(root, iso_dir, year_dir, "data.parquet")
+            if exists(path):
+                paths.append(path)
+
+    return paths
+
+
+def query(
+    root, countries=None, start_date=None, end_date=None, event_types=None
+):
+    """Read a filtered slice of the store, only opening the matching
+    partitions."""
+    paths = list_partitions(root, countries, start_date, end_date)
+
+    frames = []
+    for path in paths:
+        df = pd.read_parquet(path)
+
+        if start_date:
+            df = df[df["event_date"] >= start_date]
+        if end_date:
+            df = df[df["event_date"] <= end_date]
+        if event_types:
+            df = df[df["event_type"].isin(event_types)]
+
+        frames.append(df)
+
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True, sort=False)
+
+    # update() keeps a key in a single partition, this only guards against
+    # partitions written by hand.
+    df = df.sort_values("timestamp").drop_duplicates(KEY_FIELD, keep="last")
+
+    return df.sort_values(["event_date", KEY_FIELD])
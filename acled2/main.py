@@ -1,12 +1,20 @@
-import requests
 import csv
 import logging
+import sqlite3
+import sys
 
-from arcgis.gis import GIS
 from datetime import date
 from optparse import OptionParser
 
 from configparser import ConfigParser
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from common.chunked_upload import add_unique_index, upload_chunks  # noqa
+from common.http import default_client  # noqa
+
+client = default_client()
 
 parser = OptionParser()
 parser.add_option("-c", "--config", dest="config", default="config.txt")
@@ -21,9 +29,53 @@ logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
 FILENAME = config.get("MISC", "FILENAME")
 TEMP_PATH = f"/tmp/{FILENAME}"
+STATE_PATH = config.get(
+    "MISC", "STATE_FILE", fallback=f"/tmp/{FILENAME}_state.sqlite"
+)
+
+KEY_FIELD = "event_id_cnty"
+
+
+def open_state():
+    conn = sqlite3.connect(STATE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS events "
+        "(event_id_cnty TEXT PRIMARY KEY, timestamp INTEGER NOT NULL)"
+    )
+
+    return conn
+
+
+def get_watermark(conn):
+    return conn.execute("SELECT MAX(timestamp) FROM events").fetchone()[0]
 
 
-def fetch(all):
+def filter_changed(conn, data):
+    # Keep rows that are new or have been modified since the last sync.
+    known = dict(conn.execute("SELECT event_id_cnty, timestamp FROM events"))
+
+    changed = {}
+    for row in data:
+        timestamp = int(row["timestamp"])
+        if known.get(row[KEY_FIELD], -1) >= timestamp:
+            continue
+        previous = changed.get(row[KEY_FIELD])
+        if previous is None or int(previous["timestamp"]) < timestamp:
+            changed[row[KEY_FIELD]] = row
+
+    return list(changed.values())
+
+
+def save_state(conn, data):
+    conn.executemany(
+        "INSERT OR REPLACE INTO events (event_id_cnty, timestamp) "
+        "VALUES (?, ?)",
+        [(row[KEY_FIELD], int(row["timestamp"])) for row in data],
+    )
+    conn.commit()
+
+
+def fetch(watermark=None):
     ACLED_API_URL = config.get("ACLED", "API_URL")
     ACLED_KEY = config.get("ACLED", "KEY")
     ACLED_EMAIL = config.get("ACLED", "EMAIL")
@@ -39,16 +91,15 @@ def fetch(all):
         email=ACLED_EMAIL,
         iso="|".join(ISO_COUNTRIES),
         page=1,
-        event_date=date_today,
+        event_date=f"{START_DATE}|{date_today}",
+        event_date_where="BETWEEN",
     )
 
-    if all is True:
-        params.update(
-            dict(
-                event_date=f"{START_DATE}|{date_today}",
-                event_date_where="BETWEEN",
-            )
-        )
+    # Only rows created or modified since the last sync, including backdated
+    # events.
+    if watermark is not None:
+        logger.info(f"Fetching rows modified since {watermark}")
+        params.update(dict(timestamp=watermark, timestamp_where=">="))
 
     if len(ISO_COUNTRIES) > 1:
         params["iso_where"] = "="
@@ -57,7 +108,7 @@ def fetch(all):
 
     csv_file = []
     while len_data != 0:
-        data = requests.get(ACLED_API_URL, params=params).json()["data"]
+        data = client.get(ACLED_API_URL, params=params).json()["data"]
         csv_file.extend(data)
         len_data = len(data)
         params["page"] = params["page"] + 1
@@ -65,40 +116,61 @@ def fetch(all):
     return csv_file
 
 
-def upload_arcgis(gis, item, path):
-    publish_params = dict(
-        name=FILENAME,
-        type="csv",
-        locationType="coordinates",
-        latitudeFieldName="latitude",
-        longitudeFieldName="longitude",
-    )
+def write_csv(path, data):
+    keys = data[0].keys()
+    with open(path, "w", newline="") as output_file:
+        dict_writer = csv.DictWriter(output_file, keys)
+        dict_writer.writeheader()
+        dict_writer.writerows(data)
+
 
-    if item is not None:
-        logger.info("Appending items to layer")
-        lyr = item.layers[0]
-        temp_item = gis.content.add(dict(title=f"{FILENAME}_temp"), data=path)
+def upload_arcgis(gis, item, data):
+    CHUNK_SIZE = config.getint("ARCGIS", "CHUNK_SIZE", fallback=1000)
 
-        lyr.append(
-            item_id=temp_item.id,
-            upload_format="csv",
-            upsert=False,
-            source_info=publish_params,
+    if item is None:
+        logger.info("Uploading layer")
+        publish_params = dict(
+            name=FILENAME,
+            type="csv",
+            locationType="coordinates",
+            latitudeFieldName="latitude",
+            longitudeFieldName="longitude",
         )
 
-        # Delete old item.
-        temp_item.delete()
+        # Publish from the first chunk, the rest is sent in batches below.
+        path = f"{TEMP_PATH}.csv"
+        write_csv(path, data[:CHUNK_SIZE])
+        item = gis.content.add(dict(title=FILENAME), data=path)
 
-        return
+        item = item.publish(publish_parameters=publish_params)
+        item.share(everyone=True)
+
+        data = data[CHUNK_SIZE:]
 
-    logger.info("Uploading layer")
-    item = gis.content.add(dict(title=FILENAME), data=path)
+    if len(data) == 0:
+        return
 
-    item = item.publish(publish_parameters=publish_params)
-    item.share(everyone=True)
+    # Upserts match on the key, layers published before it was added lack
+    # the index.
+    add_unique_index(item.layers[0], KEY_FIELD)
+
+    logger.info("Upserting items into layer")
+    upload_chunks(
+        item.layers[0],
+        data,
+        x_field="longitude",
+        y_field="latitude",
+        key_field=KEY_FIELD,
+        chunk_size=CHUNK_SIZE,
+        workers=config.getint("ARCGIS", "WORKERS", fallback=4),
+        retries=config.getint("ARCGIS", "RETRIES", fallback=3),
+        checkpoint_path=f"{TEMP_PATH}_upload.json",
+    )
 
 
 def main():
+    from arcgis.gis import GIS
+
     ARCGIS_USER = config.get("ARCGIS", "USER")
     ARCGIS_PW = config.get("ARCGIS", "PW")
     ARCGIS_URL = config.get("ARCGIS", "URL")
@@ -107,28 +179,27 @@ def main():
     content_data = f"title:{FILENAME} type:Feature Service owner:{ARCGIS_USER}"
     item = next((f for f in gis.content.search(content_data)), None)
 
-    all = False
-    if item is None:
-        all = True
+    state = open_state()
 
-    data = fetch(all)
+    # Layer is gone, local index is no longer valid.
+    if item is None:
+        state.execute("DELETE FROM events")
+        state.commit()
 
-    path = TEMP_PATH
-    if item is not None:
-        path += "_temp"
-    path += ".csv"
+    data = fetch(get_watermark(state))
+    client.stats.log()
+    data = filter_changed(state, data)
 
     if len(data) == 0:
         logger.info("Data not found")
         return
 
-    keys = data[0].keys()
-    with open(path, "w", newline="") as output_file:
-        dict_writer = csv.DictWriter(output_file, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(data)
+    logger.info(f"Found {len(data)} new or changed rows")
+
+    upload_arcgis(gis, item, data)
 
-    upload_arcgis(gis, item, path)
+    save_state(state, data)
+    state.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,707 @@
+"""In-memory stand-in for the ArcGIS Online endpoints used by acled, acled2
+and travel_spreadsheet: login, content add/search/update/share/delete,
+publish of csv items and feature layer query/applyEdits/append."""
+import csv
+import io
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger()
+
+OID_FIELD = "ObjectId"
+
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(\d+(?:\.\d+)?)|('(?:[^']|'')*')|(<>|!=|>=|<=|=|>|<|\(|\)|,)"
+    r"|([A-Za-z_][A-Za-z0-9_]*))"
+)
+
+
+def tokenize(where):
+    tokens, pos = [], 0
+    where = where.strip()
+    while pos < len(where):
+        match = TOKEN_PATTERN.match(where, pos)
+        if match is None:
+            raise ValueError(f"Invalid where clause: {where}")
+        number, string, op, ident = match.groups()
+        if number is not None:
+            tokens.append(("value", float(number)))
+        elif string is not None:
+            tokens.append(("value", string[1:-1].replace("''", "'")))
+        elif op is not None:
+            tokens.append(("op", op))
+        else:
+            upper = ident.upper()
+            if upper in ("AND", "OR", "IN", "NOT", "NULL", "IS"):
+                tokens.append(("op", upper))
+            else:
+                tokens.append(("ident", ident))
+        pos = match.end()
+
+    return tokens
+
+
+def normalize(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def compare(left, op, right):
+    try:
+        left, right = float(left), float(right)
+    except (TypeError, ValueError):
+        left, right = str(left), str(right)
+
+    return {
+        "=": left == right,
+        "<>": left != right,
+        "!=": left != right,
+        ">": left > right,
+        "<": left < right,
+        ">=": left >= right,
+        "<=": left <= right,
+    }[op]
+
+
+class WhereClause:
+    """Tiny evaluator for the where clauses sent by the scripts: comparisons,
+    IN lists, IS NULL, AND/OR and parentheses."""
+
+    def __init__(self, where):
+        self.tokens = tokenize(where or "1=1")
+        self.pos = 0
+        self.tree = self.parse_or()
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == ("op", "OR"):
+            self.take()
+            nodes.append(self.parse_and())
+        return ("or", nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_factor()]
+        while self.peek() == ("op", "AND"):
+            self.take()
+            nodes.append(self.parse_factor())
+        return ("and", nodes)
+
+    def parse_operand(self):
+        kind, value = self.take()
+        if kind == "ident":
+            return ("field", value)
+        return ("value", value)
+
+    def parse_factor(self):
+        if self.peek() == ("op", "("):
+            self.take()
+            node = self.parse_or()
+            self.take()
+            return node
+
+        left = self.parse_operand()
+        _, op = self.take()
+
+        if op == "IS":
+            negate = self.peek() == ("op", "NOT")
+            if negate:
+                self.take()
+            self.take()
+            return ("null", left, negate)
+
+        if op == "IN":
+            self.take()
+            values = []
+            while self.peek() != ("op", ")"):
+                kind, value = self.take()
+                if kind == "value":
+                    values.append(value)
+            self.take()
+            return ("in", left, set(normalize(v) for v in values))
+
+        return ("cmp", left, op, self.parse_operand())
+
+    def resolve(self, operand, attributes):
+        kind, value = operand
+        return attributes.get(value) if kind == "field" else value
+
+    def evaluate(self, node, attributes):
+        kind = node[0]
+        if kind == "or":
+            return any(self.evaluate(n, attributes) for n in node[1])
+        if kind == "and":
+            return all(self.evaluate(n, attributes) for n in node[1])
+        if kind == "null":
+            is_null = self.resolve(node[1], attributes) is None
+            return not is_null if node[2] else is_null
+        if kind == "in":
+            value = self.resolve(node[1], attributes)
+            return value is not None and normalize(value) in node[2]
+
+        left = self.resolve(node[1], attributes)
+        right = self.resolve(node[3], attributes)
+        if left is None or right is None:
+            return False
+        return compare(left, node[2], right)
+
+    def matches(self, attributes):
+        return self.evaluate(self.tree, attributes)
+
+
+class Layer:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.features = {}
+        self.next_oid = 1
+        self.lock = threading.Lock()
+
+    def info(self):
+        fields = [
+            dict(name=OID_FIELD, type="esriFieldTypeOID", alias=OID_FIELD)
+        ] + [
+            dict(name=f, type="esriFieldTypeString", alias=f)
+            for f in self.fields
+        ]
+        return {
+            "id": 0,
+            "name": self.name,
+            "type": "Feature Layer",
+            "geometryType": "esriGeometryPoint",
+            "objectIdField": OID_FIELD,
+            "fields": fields,
+            "maxRecordCount": 2000,
+            "supportsAppend": True,
+            "supportedAppendFormats": "csv",
+            "capabilities": "Create,Delete,Query,Update,Editing",
+            "currentVersion": 10.7,
+        }
+
+    def add(self, feature):
+        attributes = dict(feature.get("attributes") or {})
+        oid = self.next_oid
+        self.next_oid += 1
+        attributes[OID_FIELD] = oid
+        self.features[oid] = dict(
+            attributes=attributes, geometry=feature.get("geometry")
+        )
+        return oid
+
+    def apply_edits(self, adds, updates, deletes):
+        with self.lock:
+            add_results = [
+                dict(objectId=self.add(f), success=True) for f in adds
+            ]
+
+            update_results = []
+            for feature in updates:
+                oid = feature.get("attributes", {}).get(OID_FIELD)
+                current = self.features.get(oid)
+                if current is None:
+                    update_results.append(
+                        dict(
+                            objectId=oid,
+                            success=False,
+                            error=dict(code=1019, description="Not found"),
+                        )
+                    )
+                    continue
+
+                current["attributes"].update(feature.get("attributes"))
+                if feature.get("geometry") is not None:
+                    current["geometry"] = feature.get("geometry")
+                update_results.append(dict(objectId=oid, success=True))
+
+            delete_results = []
+            for oid in deletes:
+                success = self.features.pop(oid, None) is not None
+                delete_results.append(dict(objectId=oid, success=success))
+
+        return dict(
+            addResults=add_results,
+            updateResults=update_results,
+            deleteResults=delete_results,
+        )
+
+    def query(self, where, out_fields, return_geometry, ids_only, count_only):
+        clause = WhereClause(where)
+        with self.lock:
+            matched = [
+                f
+                for f in self.features.values()
+                if clause.matches(f["attributes"])
+            ]
+
+        if count_only:
+            return dict(count=len(matched))
+
+        if ids_only:
+            return dict(
+                objectIdFieldName=OID_FIELD,
+                objectIds=[f["attributes"][OID_FIELD] for f in matched],
+            )
+
+        fields = None
+        if out_fields and out_fields != "*":
+            fields = out_fields.split(",")
+
+        features = []
+        for feature in matched:
+            attributes = feature["attributes"]
+            if fields is not None:
+                attributes = {k: attributes.get(k) for k in fields}
+            out = dict(attributes=attributes)
+            if return_geometry:
+                out["geometry"] = feature["geometry"]
+            features.append(out)
+
+        return dict(
+            objectIdFieldName=OID_FIELD,
+            geometryType="esriGeometryPoint",
+            spatialReference=dict(wkid=4326),
+            fields=self.info()["fields"],
+            features=features,
+        )
+
+    def load_csv(self, content, x_field, y_field, upsert_field=None):
+        reader = csv.DictReader(io.StringIO(content.decode("utf-8")))
+        features = [
+            dict(
+                attributes=row,
+                geometry=dict(x=float(row[x_field]), y=float(row[y_field])),
+            )
+            for row in reader
+        ]
+
+        if upsert_field is None:
+            return self.apply_edits(features, [], [])
+
+        with self.lock:
+            index = {
+                str(f["attributes"].get(upsert_field)): oid
+                for oid, f in self.features.items()
+            }
+
+        adds, updates = [], []
+        for feature in features:
+            oid = index.get(str(feature["attributes"].get(upsert_field)))
+            if oid is None:
+                adds.append(feature)
+                continue
+            feature["attributes"][OID_FIELD] = oid
+            updates.append(feature)
+
+        return self.apply_edits(adds, updates, [])
+
+
+class FakePortal:
+    def __init__(self, latency=0.0, per_feature=0.0):
+        self.latency = latency
+        self.per_feature = per_feature
+        self.items = {}
+        self.services = {}
+        self.lock = threading.Lock()
+        self.url = None
+        self.requests = 0
+
+    def item_info(self, item):
+        return {k: v for k, v in item.items() if k != "data"}
+
+    def add_item(self, owner, params, data):
+        item_id = uuid.uuid4().hex
+        item = dict(
+            id=item_id,
+            owner=owner,
+            title=params.get("title"),
+            type=params.get("type") or "CSV",
+            typeKeywords=[],
+            tags=[],
+            access="private",
+            created=int(time.time() * 1000),
+            modified=int(time.time() * 1000),
+            url=None,
+            data=data,
+        )
+        with self.lock:
+            self.items[item_id] = item
+        return item
+
+    def search(self, q):
+        terms = dict(re.findall(r"(\w+):\s*(\S+(?:\s+Service)?)", q or ""))
+        results = []
+        for item in list(self.items.values()):
+            if "title" in terms and item["title"] != terms["title"]:
+                continue
+            if "owner" in terms and item["owner"] != terms["owner"]:
+                continue
+            if "type" in terms and item["type"] != terms["type"]:
+                continue
+            results.append(self.item_info(item))
+
+        return dict(
+            total=len(results),
+            start=1,
+            num=len(results),
+            nextStart=-1,
+            results=results,
+        )
+
+    def publish(self, owner, item_id, params, overwrite):
+        item = self.items[item_id]
+        name = params.get("name") or item["title"]
+        x_field = params.get("longitudeFieldName", "longitude")
+        y_field = params.get("latitudeFieldName", "latitude")
+
+        header = item["data"].decode("utf-8").splitlines()[0]
+        fields = next(csv.reader([header]))
+
+        layer = Layer(name, fields)
+        layer.load_csv(item["data"], x_field, y_field)
+        self.services[name] = layer
+
+        service_url = f"{self.url}/rest/services/{name}/FeatureServer"
+        service_item = next(
+            (
+                i
+                for i in self.items.values()
+                if i["type"] == "Feature Service" and i["title"] == name
+            ),
+            None,
+        )
+        if service_item is None:
+            service_item = self.add_item(
+                owner, dict(title=name, type="Feature Service"), b""
+            )
+        service_item["url"] = service_url
+        service_item["typeKeywords"] = ["Hosted Service"]
+
+        return dict(
+            services=[
+                dict(
+                    type="Feature Service",
+                    serviceurl=service_url,
+                    serviceItemId=service_item["id"],
+                    jobId=uuid.uuid4().hex,
+                    size=len(item["data"]),
+                    success=True,
+                )
+            ]
+        )
+
+
+def make_handler(portal):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def read_params(self):
+            parsed = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            files = {}
+
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length > 0 else b""
+            content_type = self.headers.get("Content-Type", "")
+
+            if content_type.startswith("multipart/form-data"):
+                message = BytesParser().parsebytes(
+                    f"Content-Type: {content_type}\r\n\r\n".encode() + body
+                )
+                for part in message.get_payload():
+                    name = part.get_param("name", header="content-disposition")
+                    payload = part.get_payload(decode=True) or b""
+                    if part.get_filename() is not None:
+                        files[name] = payload
+                    else:
+                        params[name] = payload.decode("utf-8")
+            elif body:
+                params.update(
+                    {
+                        k: v[0]
+                        for k, v in parse_qs(body.decode("utf-8")).items()
+                    }
+                )
+
+            return parsed.path.rstrip("/"), params, files
+
+        def respond(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.dispatch()
+
+        def do_POST(self):
+            self.dispatch()
+
+        def dispatch(self):
+            path, params, files = self.read_params()
+            portal.requests += 1
+
+            if portal.latency > 0:
+                time.sleep(portal.latency)
+
+            try:
+                payload = self.route(path, params, files)
+            except Exception as e:
+                logger.exception(f"Failed request {path}")
+                payload = dict(error=dict(code=500, message=str(e)))
+
+            if payload is None:
+                payload = dict(error=dict(code=404, message="Not found"))
+
+            self.respond(payload)
+
+        def route(self, path, params, files):
+            host = f"http://{self.headers.get('Host')}"
+            portal.url = portal.url or host
+
+            if path.endswith("/sharing/rest/info"):
+                return dict(
+                    owningSystemUrl=host,
+                    authInfo=dict(
+                        tokenServicesUrl=f"{host}/sharing/rest/generateToken",
+                        isTokenBasedSecurity=True,
+                    ),
+                )
+
+            if path.endswith("/generateToken"):
+                return dict(
+                    token=uuid.uuid4().hex,
+                    expires=int((time.time() + 3600) * 1000),
+                    ssl=False,
+                )
+
+            if path.endswith("/sharing/rest/portals/self"):
+                return dict(
+                    id="fakeportal",
+                    name="Fake portal",
+                    isPortal=False,
+                    currentVersion="8.2",
+                    portalHostname=host[len("http://") :],
+                    urlKey="fake",
+                    allSSL=False,
+                    supportsHostedServices=True,
+                    helperServices={},
+                    user=dict(username=params.get("username", "bench")),
+                )
+
+            match = re.search(r"/community/(?:self|users/([^/]+))$", path)
+            if match is not None:
+                return dict(
+                    username=match.group(1) or "bench",
+                    role="org_admin",
+                    privileges=[],
+                    groups=[],
+                )
+
+            if path.endswith("/sharing/rest/search"):
+                return portal.search(params.get("q"))
+
+            match = re.search(r"/content/users/([^/]+)/addItem$", path)
+            if match is not None:
+                data = next(iter(files.values()), b"")
+                item = portal.add_item(match.group(1), params, data)
+                return dict(success=True, id=item["id"], folder=None)
+
+            match = re.search(r"/content/users/([^/]+)/publish$", path)
+            if match is not None:
+                publish_params = json.loads(
+                    params.get("publishParameters") or "{}"
+                )
+                return portal.publish(
+                    match.group(1),
+                    params.get("itemId"),
+                    publish_params,
+                    params.get("overwrite") == "true",
+                )
+
+            match = re.search(r"/items/([0-9a-f]+)/status$", path)
+            if match is not None:
+                return dict(status="completed", itemId=match.group(1))
+
+            match = re.search(r"/items/([0-9a-f]+)/update$", path)
+            if match is not None:
+                item = portal.items[match.group(1)]
+                if files:
+                    item["data"] = next(iter(files.values()))
+                item["modified"] = int(time.time() * 1000)
+                return dict(success=True, id=item["id"])
+
+            match = re.search(r"/items/([0-9a-f]+)/delete$", path)
+            if match is not None:
+                portal.items.pop(match.group(1), None)
+                return dict(success=True, itemId=match.group(1))
+
+            if re.search(r"/(share|shareItems)$", path):
+                return dict(notSharedWith=[], itemId=params.get("items"))
+
+            match = re.search(r"/content/items/([0-9a-f]+)(/data)?$", path)
+            if match is not None:
+                item = portal.items.get(match.group(1))
+                if item is None:
+                    return None
+                return portal.item_info(item)
+
+            match = re.search(
+                r"/rest/(?:admin/)?services/([^/]+)/FeatureServer"
+                r"(?:/(\d+))?(?:/(\w+))?$",
+                path,
+            )
+            if match is not None:
+                return self.route_service(
+                    match.group(1), match.group(2), match.group(3), params
+                )
+
+            return None
+
+        def route_service(self, name, layer_id, operation, params):
+            layer = portal.services.get(name)
+            if layer is None:
+                return None
+
+            if layer_id is None and operation is None:
+                return dict(
+                    currentVersion=10.7,
+                    serviceDescription="",
+                    layers=[dict(id=0, name=layer.name)],
+                    tables=[],
+                    spatialReference=dict(wkid=4326),
+                )
+
+            if operation is None:
+                return layer.info()
+
+            if operation == "query":
+                return layer.query(
+                    params.get("where"),
+                    params.get("outFields"),
+                    params.get("returnGeometry", "true") == "true",
+                    params.get("returnIdsOnly") == "true",
+                    params.get("returnCountOnly") == "true",
+                )
+
+            if operation == "applyEdits":
+                adds = json.loads(params.get("adds") or "[]")
+                updates = json.loads(params.get("updates") or "[]")
+                deletes = params.get("deletes") or ""
+                if deletes.startswith("["):
+                    deletes = json.loads(deletes)
+                else:
+                    deletes = [int(d) for d in deletes.split(",") if d]
+
+                num_edits = len(adds) + len(updates) + len(deletes)
+                if portal.per_feature > 0:
+                    time.sleep(portal.per_feature * num_edits)
+
+                return layer.apply_edits(adds, updates, deletes)
+
+            if operation == "append":
+                item = portal.items[params.get("appendItemId")]
+                source_info = json.loads(params.get("sourceInfo") or "{}")
+                upsert_field = None
+                if params.get("upsert") == "true":
+                    upsert_field = params.get("upsertMatchingField")
+
+                result = layer.load_csv(
+                    item["data"],
+                    source_info.get("longitudeFieldName", "longitude"),
+                    source_info.get("latitudeFieldName", "latitude"),
+                    upsert_field,
+                )
+                num_edits = len(result["addResults"]) + len(
+                    result["updateResults"]
+                )
+                if portal.per_feature > 0:
+                    time.sleep(portal.per_feature * num_edits)
+
+                return dict(status="Completed", success=True)
+
+            if operation in ("addToDefinition", "updateDefinition"):
+                return dict(success=True)
+
+            if operation == "truncate":
+                with layer.lock:
+                    layer.features.clear()
+                return dict(success=True)
+
+            return None
+
+    return Handler
+
+
+def start_server(port=0, latency=0.0, per_feature=0.0):
+    """Start the fake portal in a background thread and return it with its
+    base url."""
+    portal = FakePortal(latency=latency, per_feature=per_feature)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(portal))
+    server.daemon_threads = True
+
+    portal.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, portal
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-p", "--port", dest="port", type="int", default=8765)
+    parser.add_option(
+        "--latency",
+        dest="latency",
+        type="float",
+        default=0.0,
+        help="Seconds added to every request",
+    )
+    parser.add_option(
+        "--per-feature",
+        dest="per_feature",
+        type="float",
+        default=0.0,
+        help="Seconds added for every edited feature",
+    )
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    server, portal = start_server(
+        options.port, options.latency, options.per_feature
+    )
+    logger.info(f"Fake ArcGIS portal listening on {portal.url}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,786 @@
+"""Synthetic upstream fixtures for the offline benchmarks.
+
+    python -m benchmarks.fixtures -o /tmp/wfp_fixtures --scale 1
+
+Writes one folder per upstream (gdacs, usgs, ibtracs, acled, vam, nominatim)
+with an index.json of recorded responses and their bodies, plus the input
+files the scripts read (countries, admin0, dump.csv) and meta.json with the
+values scenarios need. Folders recorded through the replay server use the
+same layout and can replace any of them.
+"""
+import csv
+import io
+import json
+import logging
+import os
+import random
+import struct
+import zipfile
+
+from datetime import date, datetime, timedelta
+from optparse import OptionParser
+from os.path import join
+
+logger = logging.getLogger()
+
+# Counts at scale 1.
+SIZES = dict(
+    gdacs_events=60,
+    gdacs_max_episodes=8,
+    gdacs_eq_events=30,
+    ibtracs_storms=600,
+    ibtracs_points=60,
+    usgs_countries=6,
+    usgs_quakes=40,
+    acled_pages=10,
+    acled_page_size=500,
+    vam_countries=6,
+    vam_markets=150,
+    vam_months=12,
+    vam_prices=40,
+    nominatim_rows=2000,
+)
+
+# Shared by the bodies that embed their own server url.
+BASE_URL = "{{BASE_URL}}"
+
+HTML = dict(content_type="text/html")
+
+POLYGON_CLASSES = ["Poly_Green", "Poly_Orange", "Poly_Red", "Poly_Cones"]
+ACLED_EVENT_TYPES = [
+    "Battles",
+    "Protests",
+    "Riots",
+    "Explosions/Remote violence",
+    "Violence against civilians",
+    "Strategic developments",
+]
+
+
+class FixtureWriter:
+    """Collects the responses of one upstream and writes them as
+    index.json plus one body file per response."""
+
+    def __init__(self, root, name):
+        self.path = join(root, name)
+        self.entries = []
+        os.makedirs(join(self.path, "bodies"), exist_ok=True)
+
+    def add(
+        self,
+        path,
+        body,
+        query=None,
+        method="GET",
+        status=200,
+        content_type="application/json",
+        template=False,
+    ):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        name = f"bodies/{len(self.entries):06d}"
+        with open(join(self.path, name), "wb") as f:
+            f.write(body)
+
+        self.entries.append(
+            dict(
+                method=method,
+                path=path,
+                query={k: str(v) for k, v in (query or {}).items()},
+                status=status,
+                content_type=content_type,
+                body=name,
+                template=template,
+            )
+        )
+
+    def save(self):
+        with open(join(self.path, "index.json"), "w") as f:
+            json.dump(self.entries, f, indent=1)
+
+        logger.info(f"Wrote {len(self.entries)} responses to {self.path}")
+
+
+def scaled(scale, key):
+    return max(1, int(SIZES[key] * scale))
+
+
+def listing(links):
+    """Directory listing in the IIS format GDACS serves."""
+    items = "<br>".join(f'<a href="{link}">{link}</a>' for link in links)
+    return (
+        "<html><head><title>resources</title></head>"
+        f"<body><H1>resources</H1><hr><pre>{items}</pre><hr></body></html>"
+    )
+
+
+def gdacs_point(rng, event_id, name, episode, lng, lat, day):
+    return dict(
+        type="Feature",
+        geometry=dict(type="Point", coordinates=[lng, lat]),
+        properties=dict(
+            eventid=event_id,
+            eventname=name,
+            episodeid=episode,
+            eventtype="TC",
+            fromdate=day.isoformat(),
+            todate=day.isoformat(),
+            windspeed=round(rng.uniform(60, 260), 1),
+        ),
+    )
+
+
+def gdacs_buffer(lng, lat, size, polygon_class, event_id, episode):
+    ring = [
+        [lng - size, lat - size],
+        [lng - size, lat + size],
+        [lng + size, lat + size],
+        [lng + size, lat - size],
+        [lng - size, lat - size],
+    ]
+
+    return dict(
+        type="Feature",
+        geometry=dict(type="Polygon", coordinates=[ring]),
+        properties=dict(
+            Class=polygon_class,
+            polygonlabel=polygon_class.split("_")[1],
+            eventid=event_id,
+            episodeid=episode,
+        ),
+    )
+
+
+def gdacs_earthquake(rng, event_id, episode, lng, lat, day):
+    """Epicenter and intensity polygons of an earthquake episode, the
+    outer one a multipolygon."""
+    features = [
+        dict(
+            type="Feature",
+            geometry=dict(type="Point", coordinates=[lng, lat]),
+            properties=dict(
+                eventid=event_id,
+                eventname=f"Earthquake {event_id}",
+                episodeid=episode,
+                eventtype="EQ",
+                fromdate=day.isoformat(),
+                todate=day.isoformat(),
+                alertlevel=rng.choice(["Green", "Orange", "Red"]),
+                country=rng.choice(["Chile", "Peru", "Nepal", "Japan"]),
+                severitydata=dict(severity=round(rng.uniform(4.5, 8), 1)),
+            ),
+        )
+    ]
+    for n in range(3):
+        polygon = gdacs_buffer(
+            lng, lat, 0.2 * (n + 1), f"Poly_Int{6 + n}", event_id, episode
+        )
+        if n == 2:
+            ring = polygon["geometry"]["coordinates"][0]
+            shifted = [[x + 2, y] for x, y in ring]
+            polygon["geometry"] = dict(
+                type="MultiPolygon", coordinates=[[ring], [shifted]]
+            )
+        features.append(polygon)
+
+    return features
+
+
+def write_gdacs(root, rng, scale):
+    """Directory listings, episode geojsons and the rss feed. The latest
+    episode carries the whole track except for some events, which only
+    keep their last point so the previous episodes get crawled.
+    Earthquakes get their own listing for fetch_gdacs.py."""
+    writer = FixtureWriter(root, "gdacs")
+    prefix = "/datareport/resources/TC"
+
+    events = []
+    start = datetime(2015, 1, 1)
+    for i in range(scaled(scale, "gdacs_events")):
+        event_id = 1000001 + i
+        episodes = rng.randint(1, SIZES["gdacs_max_episodes"])
+        events.append((event_id, episodes))
+
+        name = f"STORM-{i:03d}"
+        lng, lat = rng.uniform(-180, 170), rng.uniform(-35, 35)
+        day = start + timedelta(days=rng.randint(0, 3000))
+
+        points = []
+        files = []
+        for episode in range(1, episodes + 1):
+            points.append(
+                gdacs_point(rng, event_id, name, episode, lng, lat, day)
+            )
+            lng, lat = lng + rng.uniform(0, 1.5), lat + rng.uniform(-1, 1)
+            day += timedelta(hours=6)
+
+            features = list(points)
+            if episode == episodes and i % 5 == 0:
+                features = points[-1:]
+
+            features += [
+                gdacs_buffer(lng, lat, 0.5 * (n + 1), c, event_id, episode)
+                for n, c in enumerate(POLYGON_CLASSES)
+            ]
+            if i % 2 == 0 and len(points) > 1:
+                features.append(
+                    dict(
+                        type="Feature",
+                        geometry=dict(
+                            type="LineString",
+                            coordinates=[
+                                p["geometry"]["coordinates"] for p in points
+                            ],
+                        ),
+                        properties=dict(eventid=event_id, Class="Line"),
+                    )
+                )
+
+            path = f"{prefix}/{event_id}/geojson_{event_id}_{episode}.geojson"
+            files.append(path)
+            writer.add(
+                path, dict(type="FeatureCollection", features=features)
+            )
+
+        # Listings also hold files the crawler has to skip.
+        files.append(f"{prefix}/{event_id}/cones_{event_id}_1_2.geojson")
+        writer.add(f"{prefix}/{event_id}/", listing(files), **HTML)
+
+    links = [f"{prefix}/{event_id}/" for event_id, _ in events]
+    writer.add(prefix, listing(["/datareport/resources/"] + links), **HTML)
+
+    prefix = "/datareport/resources/EQ"
+    earthquakes = []
+    for n in range(scaled(scale, "gdacs_eq_events")):
+        event_id = 1300000 + n
+        lng, lat = rng.uniform(-180, 170), rng.uniform(-60, 60)
+        day = start + timedelta(days=rng.randint(0, 3000))
+
+        files = []
+        for episode in range(1, rng.randint(1, 3) + 1):
+            path = f"{prefix}/{event_id}/geojson_{event_id}_{episode}.geojson"
+            files.append(path)
+            features = gdacs_earthquake(rng, event_id, episode, lng, lat, day)
+            writer.add(
+                path, dict(type="FeatureCollection", features=features)
+            )
+        writer.add(f"{prefix}/{event_id}/", listing(files), **HTML)
+        earthquakes.append(f"{prefix}/{event_id}/")
+
+    writer.add(
+        prefix, listing(["/datareport/resources/"] + earthquakes), **HTML
+    )
+
+    # Latest episode of the last events, plus earthquakes to skip.
+    items = []
+    for event_id, episodes in events[-10:]:
+        items.append(("TC", event_id, episodes))
+    items += [("EQ", 1300000 + n, 1) for n in range(5)]
+
+    rss_items = "".join(
+        "<item>"
+        f"<title>{event_type} {event_id}</title>"
+        f"<gdacs:eventtype>{event_type}</gdacs:eventtype>"
+        f"<gdacs:eventid>{event_id}</gdacs:eventid>"
+        f"<gdacs:episodeid>{episode}</gdacs:episodeid>"
+        "</item>"
+        for event_type, event_id, episode in items
+    )
+    writer.add(
+        "/xml/rss.xml",
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss xmlns:gdacs="http://www.gdacs.org" version="2.0">'
+        f"<channel><title>GDACS</title>{rss_items}</channel></rss>",
+        content_type="application/xml",
+    )
+    writer.save()
+
+    return dict(events=len(events), earthquakes=len(earthquakes))
+
+
+def ibtracs_row(sid, season, number, name, time, lat, lng, rng):
+    row = [" "] * 163
+    row[:10] = [
+        sid,
+        str(season),
+        str(number),
+        rng.choice(["WP", "EP", "NA", "NI", "SI", "SP"]),
+        "MM",
+        name,
+        time.strftime("%Y-%m-%d %H:%M:%S"),
+        rng.choice(["TS", "ET", "DS", "NR"]),
+        f"{lat:.4f}",
+        f"{lng:.4f}",
+    ]
+    row[14] = str(rng.randint(0, 2000))
+    row[15] = str(rng.randint(0, 2000)) if rng.random() > 0.2 else " "
+    row[161] = str(rng.randint(0, 40))
+    row[162] = str(rng.randint(0, 359))
+
+    return row
+
+
+def write_ibtracs(root, rng, scale):
+    """The ALL and ACTIVE csv files, ACTIVE being the newest storms with a
+    few points more than ALL had."""
+    writer = FixtureWriter(root, "ibtracs")
+    header = ["SID", "SEASON", "NUMBER", "BASIN", "SUBBASIN", "NAME"]
+    header += ["ISO_TIME", "NATURE", "LAT", "LON"]
+    header += [f"COL{n}" for n in range(10, 163)]
+    units = [" "] * 163
+
+    storms = scaled(scale, "ibtracs_storms")
+    all_rows, active_rows = [], []
+    for n in range(storms):
+        season = 1980 + n * 44 // storms
+        sid = f"{season}{n:03d}N{rng.randint(10, 30)}{rng.randint(100, 300)}"
+        time = datetime(season, rng.randint(1, 12), rng.randint(1, 28))
+        lat, lng = rng.uniform(-30, 30), rng.uniform(-180, 180)
+        active = n >= storms - 5
+
+        points = rng.randint(10, 2 * SIZES["ibtracs_points"])
+        for p in range(points):
+            row = ibtracs_row(sid, season, n, f"NAME{n}", time, lat, lng, rng)
+            if not active or p < points - 4:
+                all_rows.append(row)
+            if active:
+                active_rows.append(row)
+
+            time += timedelta(hours=3)
+            lat, lng = lat + rng.uniform(-0.3, 0.6), lng + rng.uniform(-1, 1)
+
+    for name, rows in (("ALL", all_rows), ("ACTIVE", active_rows)):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(
+            [header, units] + rows
+        )
+        for method in ("GET", "POST"):
+            writer.add(
+                f"/csv/ibtracs.{name}.list.v04r00.csv",
+                buffer.getvalue(),
+                method=method,
+                content_type="text/csv",
+            )
+    writer.save()
+
+    return dict(all_rows=len(all_rows), active_rows=len(active_rows))
+
+
+def shapefile_zip(rings):
+    """Zipped polygon shapefile mi.shp with a PARAMVALUE field, one record
+    per (mmi, ring)."""
+    records = []
+    for mmi, ring in rings:
+        xs, ys = [p[0] for p in ring], [p[1] for p in ring]
+        content = struct.pack("<i4d", 5, min(xs), min(ys), max(xs), max(ys))
+        content += struct.pack("<ii", 1, len(ring)) + struct.pack("<i", 0)
+        content += b"".join(struct.pack("<2d", x, y) for x, y in ring)
+        records.append(content)
+
+    xs = [p[0] for _, ring in rings for p in ring]
+    ys = [p[1] for _, ring in rings for p in ring]
+
+    def header(length):
+        return (
+            struct.pack(">i5ii", 9994, 0, 0, 0, 0, 0, length // 2)
+            + struct.pack("<ii", 1000, 5)
+            + struct.pack("<4d", min(xs), min(ys), max(xs), max(ys))
+            + struct.pack("<4d", 0, 0, 0, 0)
+        )
+
+    shp, shx = b"", b""
+    offset = 100
+    for number, content in enumerate(records, 1):
+        shx += struct.pack(">ii", offset // 2, len(content) // 2)
+        shp += struct.pack(">ii", number, len(content) // 2) + content
+        offset += 8 + len(content)
+    shp = header(100 + len(shp)) + shp
+    shx = header(100 + len(shx)) + shx
+
+    today = date.today()
+    dbf = struct.pack(
+        "<4BIHH20x",
+        3,
+        today.year - 1900,
+        today.month,
+        today.day,
+        len(rings),
+        32 + 32 + 1,
+        1 + 8,
+    )
+    dbf += struct.pack("<11sc4xBB14x", b"PARAMVALUE", b"N", 8, 2)
+    dbf += b"\r"
+    dbf += b"".join(b" " + f"{mmi:8.2f}".encode() for mmi, _ in rings)
+    dbf += b"\x1a"
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as f:
+        f.writestr("mi.shp", shp)
+        f.writestr("mi.shx", shx)
+        f.writestr("mi.dbf", dbf)
+        f.writestr("mi.prj", 'GEOGCS["WGS 84",DATUM["WGS_1984"]]')
+
+    return buffer.getvalue()
+
+
+def usgs_feature(rng, eq_id, lng, lat, shakemap):
+    types = ",origin,phase-data,"
+    if shakemap:
+        types += "shakemap,"
+
+    return dict(
+        type="Feature",
+        id=eq_id,
+        properties=dict(
+            mag=round(rng.uniform(4, 8), 1),
+            place=f"{rng.randint(1, 90)} km of somewhere",
+            time=int(rng.uniform(1.3e12, 1.6e12)),
+            mmi=round(rng.uniform(2, 9), 2) if shakemap else None,
+            title=f"M quake {eq_id}",
+            types=types,
+            detail=(
+                f"{BASE_URL}/fdsnws/event/1/query"
+                f"?eventid={eq_id}&format=geojson"
+            ),
+        ),
+        geometry=dict(type="Point", coordinates=[lng, lat, 10.0]),
+    )
+
+
+def write_usgs(root, rng, scale):
+    """Country queries, event details with shakemap zips, the hourly feed
+    and the countries file eq_historical reads."""
+    writer = FixtureWriter(root, "usgs")
+
+    countries = []
+    feed = []
+    for c in range(scaled(scale, "usgs_countries")):
+        minlon, minlat = float(-170 + c * 25), float(-40 + (c % 4) * 20)
+        maxlon, maxlat = minlon + 20.0, minlat + 15.0
+        iso3 = f"X{c:02d}"
+        countries.append(
+            dict(
+                iso3=iso3,
+                bbox=(
+                    f"POLYGON(({minlon} {maxlat}, {maxlon} {maxlat}, "
+                    f"{maxlon} {minlat}, {minlon} {minlat}, "
+                    f"{minlon} {maxlat}))"
+                ),
+            )
+        )
+
+        features = []
+        for q in range(scaled(scale, "usgs_quakes")):
+            eq_id = f"us{c:02d}{q:05d}"
+            lng = rng.uniform(minlon + 1, maxlon - 1)
+            lat = rng.uniform(minlat + 1, maxlat - 1)
+            shakemap = q % 5 == 0
+
+            feature = usgs_feature(rng, eq_id, lng, lat, shakemap)
+            features.append(feature)
+            if q < 2:
+                feed.append(feature)
+
+            detail = dict(
+                type="Feature",
+                id=eq_id,
+                properties=dict(products={}),
+            )
+            if shakemap:
+                zip_path = f"/product/shakemap/{eq_id}/download/shape.zip"
+                detail["properties"]["products"]["shakemap"] = [
+                    dict(
+                        contents={
+                            "download/shape.zip": dict(
+                                url=f"{BASE_URL}{zip_path}"
+                            )
+                        }
+                    )
+                ]
+                rings = []
+                for level in range(1, 6):
+                    size = 2.0 / level
+                    rings.append(
+                        (
+                            2.0 + level,
+                            [
+                                (lng - size, lat - size),
+                                (lng - size, lat + size),
+                                (lng + size, lat + size),
+                                (lng + size, lat - size),
+                                (lng - size, lat - size),
+                            ],
+                        )
+                    )
+                writer.add(
+                    zip_path,
+                    shapefile_zip(rings),
+                    content_type="application/zip",
+                )
+
+            writer.add(
+                "/fdsnws/event/1/query",
+                detail,
+                query=dict(eventid=eq_id),
+                template=True,
+            )
+
+        # eq_historical asks for the country envelope.
+        writer.add(
+            "/fdsnws/event/1/query",
+            dict(type="FeatureCollection", features=features),
+            query=dict(
+                minlongitude=minlon,
+                maxlongitude=maxlon,
+                minlatitude=minlat,
+                maxlatitude=maxlat,
+            ),
+            template=True,
+        )
+
+    writer.add(
+        "/earthquakes/feed/v1.0/summary/all_hour.geojson",
+        dict(type="FeatureCollection", features=feed),
+        template=True,
+    )
+    writer.save()
+
+    with open(join(root, "usgs_countries.csv"), "w", newline="") as f:
+        csv_writer = csv.DictWriter(f, ["iso3", "bbox"])
+        csv_writer.writeheader()
+        csv_writer.writerows(countries)
+
+    return dict(countries=len(countries))
+
+
+def acled_row(rng, n, iso, timestamp):
+    day = date(2018, 1, 1) + timedelta(days=rng.randint(0, 1500))
+
+    return dict(
+        event_id_cnty=f"MOZ{n}",
+        event_date=day.isoformat(),
+        year=str(day.year),
+        time_precision="1",
+        event_type=rng.choice(ACLED_EVENT_TYPES),
+        sub_event_type="",
+        actor1=f"Actor {rng.randint(1, 50)}",
+        country="Mozambique",
+        iso=iso,
+        admin1=f"Province {rng.randint(1, 10)}",
+        location=f"Place {rng.randint(1, 500)}",
+        latitude=f"{rng.uniform(-26, -10):.4f}",
+        longitude=f"{rng.uniform(31, 40):.4f}",
+        fatalities=str(rng.randint(0, 20)),
+        timestamp=str(timestamp),
+    )
+
+
+def write_acled(root, rng, scale):
+    """Paged backfill plus the pages returned for the watermark the
+    backfill leaves behind, with changed and new events."""
+    writer = FixtureWriter(root, "acled")
+    iso = "508"
+    page_size = SIZES["acled_page_size"]
+    pages = scaled(scale, "acled_pages")
+
+    watermark = 1600000000
+    rows = [
+        acled_row(rng, n, iso, watermark - rng.randint(0, 10 ** 7))
+        for n in range(pages * page_size)
+    ]
+    rows[-1]["timestamp"] = str(watermark)
+
+    for page in range(pages + 1):
+        writer.add(
+            "/acled/read",
+            dict(data=rows[page * page_size : (page + 1) * page_size]),
+            query=dict(page=page + 1),
+        )
+
+    changed = [dict(r, timestamp=str(watermark + 60)) for r in rows[:100]]
+    new = [
+        acled_row(rng, len(rows) + n, iso, watermark + 120)
+        for n in range(200)
+    ]
+    writer.add(
+        "/acled/read",
+        dict(data=changed + new),
+        query=dict(timestamp=watermark, page=1),
+    )
+    writer.add(
+        "/acled/read", dict(data=[]), query=dict(timestamp=watermark, page=2)
+    )
+    writer.save()
+
+    return dict(iso=iso, rows=len(rows), watermark=watermark)
+
+
+def write_vam(root, rng, scale):
+    """Token, markets per country and monthly prices for the last
+    vam_months months, one page each."""
+    writer = FixtureWriter(root, "vam")
+    prefix = "/vam-data-bridges/1.0.0"
+
+    writer.add(
+        "/token",
+        dict(access_token="bench", expires_in=3600),
+        method="POST",
+    )
+
+    months = []
+    month = date.today().replace(day=1)
+    for _ in range(SIZES["vam_months"]):
+        months.append(month)
+        month = (month - timedelta(days=1)).replace(day=1)
+    months.reverse()
+
+    countries = []
+    market_id = 1
+    for c in range(scaled(scale, "vam_countries")):
+        code = 100 + c
+        countries.append(dict(code=code, name=f"Country {code}"))
+
+        markets = []
+        for _ in range(scaled(scale, "vam_markets")):
+            markets.append(
+                dict(
+                    type="Feature",
+                    id=market_id,
+                    geometry=dict(
+                        type="Point",
+                        coordinates=[
+                            round(rng.uniform(-20, 50), 5),
+                            round(rng.uniform(-30, 30), 5),
+                        ],
+                    ),
+                    properties=dict(name=f"Market {market_id}"),
+                )
+            )
+            market_id += 1
+
+        writer.add(
+            f"{prefix}/Markets/GeoJSONList",
+            dict(type="FeatureCollection", features=markets),
+            query=dict(adm0code=code),
+        )
+
+        for month in months:
+            items = [
+                dict(
+                    marketID=rng.choice(markets)["id"],
+                    commodityID=rng.randint(1, 400),
+                    commodityName=f"Commodity {rng.randint(1, 400)}",
+                    priceTypeName=rng.choice(["Retail", "Wholesale"]),
+                    commodityUnitName="KG",
+                    currencyName="USD",
+                    commodityPrice=round(rng.uniform(0.1, 50), 2),
+                    commodityPriceDate=f"{month.isoformat()}T00:00:00",
+                )
+                for _ in range(scaled(scale, "vam_prices"))
+            ]
+            writer.add(
+                f"{prefix}/MarketPrices/PriceMonthly",
+                dict(items=items, totalItems=len(items), page=1),
+                query=dict(adm0code=code, startDate=month.isoformat(), page=1),
+            )
+    writer.save()
+
+    with open(join(root, "vam_admin0.csv"), "w", newline="") as f:
+        csv_writer = csv.DictWriter(f, ["code", "name"])
+        csv_writer.writeheader()
+        csv_writer.writerows(countries)
+
+    return dict(countries=len(countries), prices_start=f"{months[0]:%Y-%m}")
+
+
+def write_nominatim(root, rng, scale):
+    """dump.csv and the reverse geocoding answer of each of its rows."""
+    writer = FixtureWriter(root, "nominatim")
+
+    rows = []
+    for n in range(scaled(scale, "nominatim_rows")):
+        lat = f"{rng.uniform(-50, 60):.9f}"
+        lng = f"{rng.uniform(-170, 170):.9f}"
+        rows.append(
+            dict(
+                objectid=str(n + 1),
+                city_name=f"City {n + 1}",
+                city_altnm="",
+                lat=lat,
+                lng=lng,
+            )
+        )
+
+        address = dict(
+            city=f"City {n + 1}",
+            county=f"County {n // 20}",
+            state=f"State {n // 200}",
+            country=f"Country {n // 1000}",
+            country_code="xx",
+        )
+        writer.add(
+            "/reverse", dict(address=address), query=dict(lat=lat, lon=lng)
+        )
+    writer.save()
+
+    with open(join(root, "dump.csv"), "w", newline="") as f:
+        csv_writer = csv.DictWriter(f, list(rows[0]))
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+    return dict(rows=len(rows))
+
+
+UPSTREAMS = dict(
+    gdacs=write_gdacs,
+    ibtracs=write_ibtracs,
+    usgs=write_usgs,
+    acled=write_acled,
+    vam=write_vam,
+    nominatim=write_nominatim,
+)
+
+
+def synthesize(root, scale=1.0, seed=0, upstreams=None):
+    os.makedirs(root, exist_ok=True)
+
+    meta = dict(scale=scale, seed=seed, created=date.today().isoformat())
+    for name, write in UPSTREAMS.items():
+        if upstreams is not None and name not in upstreams:
+            continue
+        meta[name] = write(root, random.Random(f"{seed}-{name}"), scale)
+
+    with open(join(root, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    return meta
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option(
+        "-o", "--output", dest="output", default="/tmp/wfp_fixtures"
+    )
+    parser.add_option("--scale", dest="scale", type="float", default=1.0)
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+    parser.add_option(
+        "--upstreams",
+        dest="upstreams",
+        help="Comma separated subset of " + ",".join(UPSTREAMS),
+    )
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    upstreams = None
+    if options.upstreams:
+        upstreams = options.upstreams.split(",")
+
+    synthesize(options.output, options.scale, options.seed, upstreams)
+
+
+if __name__ == "__main__":
+    main()
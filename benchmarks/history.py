@@ -0,0 +1,59 @@
+"""JSON run history shared by the benchmarks: every run is appended and
+compared with the latest previous result of each measurement."""
+import json
+import subprocess
+import sys
+
+from datetime import datetime
+from os.path import abspath, dirname, exists
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+def get_commit():
+    proc = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+
+    return proc.stdout.strip() or None
+
+
+def load_history(path):
+    if path is None or not exists(path):
+        return []
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def latest_results(history, key, valid=None):
+    """Latest previous result of every key(result), only those for which
+    valid(result) is true when given."""
+    previous = {}
+    for entry in history:
+        previous.update(
+            {
+                key(r): r
+                for r in entry["results"]
+                if valid is None or valid(r)
+            }
+        )
+
+    return previous
+
+
+def append_run(path, history, results, **fields):
+    history.append(
+        dict(
+            date=datetime.now().isoformat(timespec="seconds"),
+            commit=get_commit(),
+            python=sys.version.split()[0],
+            **fields,
+            results=results,
+        )
+    )
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2)
@@ -0,0 +1,251 @@
+"""Serves fixture folders written by benchmarks.fixtures, one port per
+upstream, so scripts can be pointed at them instead of the real services.
+
+    python -m benchmarks.replay_server -f /tmp/wfp_fixtures --latency 0.02
+
+A request is answered with the entry of the same method and path whose
+query is contained in the request query, preferring the entry matching
+the most parameters. With --record NAME=URL, misses of that upstream are
+fetched from URL and added to its fixtures.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from os.path import exists, isdir, join
+from urllib.parse import parse_qsl, urlparse
+
+logger = logging.getLogger()
+
+BASE_URL = "{{BASE_URL}}"
+
+
+class Upstream:
+    def __init__(self, root, name, latency=0.0, record_url=None):
+        self.path = join(root, name)
+        self.name = name
+        self.latency = latency
+        self.record_url = record_url
+        self.url = None
+
+        self.requests = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        index_path = join(self.path, "index.json")
+        self.entries = []
+        if exists(index_path):
+            with open(index_path) as f:
+                self.entries = json.load(f)
+        os.makedirs(join(self.path, "bodies"), exist_ok=True)
+
+        # (method, path) -> query keys -> query values -> entry
+        self.routes = defaultdict(lambda: defaultdict(dict))
+        for entry in self.entries:
+            self.add_route(entry)
+
+    def add_route(self, entry):
+        keys = tuple(sorted(entry["query"]))
+        values = tuple(entry["query"][k] for k in keys)
+        route = (entry["method"], entry["path"].rstrip("/"))
+        self.routes[route][keys].setdefault(values, entry)
+
+    def find(self, method, path, query):
+        candidates = self.routes.get((method, path.rstrip("/")), {})
+
+        best = None
+        for keys, entries in candidates.items():
+            if not all(k in query for k in keys):
+                continue
+            entry = entries.get(tuple(query[k] for k in keys))
+            if entry is not None and (
+                best is None or len(keys) > len(best["query"])
+            ):
+                best = entry
+
+        return best
+
+    def body(self, entry):
+        with open(join(self.path, entry["body"]), "rb") as f:
+            body = f.read()
+
+        if entry.get("template"):
+            body = body.replace(BASE_URL.encode(), self.url.encode())
+
+        return body
+
+    def record(self, method, path, query, raw_query, data):
+        """Fetch a miss from the real upstream and keep it."""
+        url = f"{self.record_url}{path}"
+        if raw_query:
+            url += f"?{raw_query}"
+
+        request = urllib.request.Request(url, data=data, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=120) as resp:
+                status, headers, body = resp.status, resp.headers, resp.read()
+        except urllib.error.HTTPError as e:
+            status, headers, body = e.code, e.headers, e.read()
+
+        # Links back to the upstream must point to the replay server.
+        template = self.record_url.encode() in body
+        if template:
+            body = body.replace(self.record_url.encode(), BASE_URL.encode())
+
+        with self.lock:
+            name = f"bodies/{len(self.entries):06d}"
+            with open(join(self.path, name), "wb") as f:
+                f.write(body)
+
+            entry = dict(
+                method=method,
+                path=path,
+                query=query,
+                status=status,
+                content_type=headers.get("Content-Type"),
+                body=name,
+                template=template,
+            )
+            self.entries.append(entry)
+            self.add_route(entry)
+            self.save()
+
+        logger.info(f"Recorded {method} {url}")
+
+        return entry
+
+    def save(self):
+        with open(join(self.path, "index.json"), "w") as f:
+            json.dump(self.entries, f, indent=1)
+
+
+def make_handler(upstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def respond(self, status, body=b"", headers=None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.dispatch("GET")
+
+        def do_POST(self):
+            self.dispatch("POST")
+
+        def dispatch(self, method):
+            parsed = urlparse(self.path)
+            query = dict(parse_qsl(parsed.query, keep_blank_values=True))
+
+            length = int(self.headers.get("Content-Length") or 0)
+            data = self.rfile.read(length) if length > 0 else None
+
+            upstream.requests += 1
+            if upstream.latency > 0:
+                time.sleep(upstream.latency)
+
+            entry = upstream.find(method, parsed.path, query)
+            if entry is None and upstream.record_url is not None:
+                entry = upstream.record(
+                    method, parsed.path, query, parsed.query, data
+                )
+
+            if entry is None:
+                upstream.misses += 1
+                logger.warning(f"No fixture for {upstream.name} {self.path}")
+                self.respond(404, b"Not found")
+                return
+
+            body = upstream.body(entry)
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                self.respond(304, headers={"ETag": etag})
+                return
+
+            headers = {"ETag": etag}
+            if entry.get("content_type"):
+                headers["Content-Type"] = entry["content_type"]
+            self.respond(entry["status"], body, headers)
+
+    return Handler
+
+
+def start_servers(root, latency=0.0, record=None, names=None):
+    """Start a server for every upstream folder under root, or for names,
+    and return {name: (server, upstream)}. upstream.url is its base url."""
+    record = record or {}
+    names = names or sorted(
+        name
+        for name in os.listdir(root)
+        if isdir(join(root, name)) or name in record
+    )
+
+    servers = {}
+    for name in names:
+        upstream = Upstream(root, name, latency, record.get(name))
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(upstream))
+        server.daemon_threads = True
+        upstream.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers[name] = (server, upstream)
+
+    return servers
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option(
+        "-f", "--fixtures", dest="fixtures", default="/tmp/wfp_fixtures"
+    )
+    parser.add_option(
+        "--latency",
+        dest="latency",
+        type="float",
+        default=0.0,
+        help="Seconds added to every request",
+    )
+    parser.add_option(
+        "--record",
+        dest="record",
+        action="append",
+        default=[],
+        help="NAME=URL, fetch and keep the requests missing in NAME",
+    )
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    record = dict(r.split("=", 1) for r in options.record)
+    servers = start_servers(options.fixtures, options.latency, record)
+    for name, (_, upstream) in servers.items():
+        logger.info(
+            f"{name}: {upstream.url} ({len(upstream.entries)} responses)"
+        )
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server, _ in servers.values():
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""Times the scripts end to end against the replay server.
+
+    python -m benchmarks.scenarios --db-url postgresql://u:p@localhost/bench
+
+backfill loads everything from scratch, incremental times a second run on
+top of an untimed backfill (rss mode for gdacs and eq_historical), rss
+runs the feed modes on an empty database. The loaders write with COPY,
+hstore, JSONB and partitions, so the target is a PostGIS database; steps
+needing it are skipped without --db-url. Every run is appended to the
+history file and steps slower than --threshold are reported.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from configparser import ConfigParser
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+from urllib.parse import urlsplit
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.append(ROOT)
+
+from benchmarks.fixtures import synthesize  # noqa: E402
+from benchmarks.history import (  # noqa: E402
+    append_run,
+    latest_results,
+    load_history,
+)
+from benchmarks.replay_server import start_servers  # noqa: E402
+
+logger = logging.getLogger()
+
+# (command, args, needs database)
+BACKFILL = [
+    ("gdacs", [], True),
+    ("fetch-gdacs", [], True),
+    ("ts-historical", ["--all"], True),
+    ("eq-historical", [], True),
+    ("fetch-catalog", [], True),
+    ("fetch-catalog", ["--prices"], True),
+    ("acled", ["--no-upload"], False),
+    ("osm-names", [], False),
+]
+
+INCREMENTAL = [
+    ("gdacs", ["--rss"], True),
+    ("ts-historical", [], True),
+    ("eq-historical", ["--rss"], True),
+    ("fetch-catalog", [], True),
+    ("fetch-catalog", ["--prices"], True),
+    ("acled", ["--no-upload"], False),
+    ("osm-names", ["--restart"], False),
+]
+
+RSS = [
+    ("gdacs", ["--rss"], True),
+    ("eq-historical", ["--rss"], True),
+]
+
+# Steps as (command, args, needs database, timed).
+SCENARIOS = dict(
+    backfill=[step + (True,) for step in BACKFILL],
+    incremental=[step + (False,) for step in BACKFILL]
+    + [step + (True,) for step in INCREMENTAL],
+    rss=[step + (True,) for step in RSS],
+)
+
+
+class Context:
+    def __init__(self, fixtures, meta, servers, work, db_url, schema):
+        self.fixtures = fixtures
+        self.meta = meta
+        self.urls = {name: u.url for name, (_, u) in servers.items()}
+        self.work = work
+        self.db_url = db_url
+        self.schema = schema
+
+    def write_config(self, name, sections):
+        config = ConfigParser()
+        config.optionxform = str
+        config.read_dict(sections)
+
+        path = join(self.work, name)
+        with open(path, "w") as f:
+            config.write(f)
+
+        return path
+
+
+def configure_gdacs(ctx):
+    db = urlsplit(ctx.db_url or "postgresql://bench@localhost/bench")
+    path = ctx.write_config(
+        "gdacs.txt",
+        dict(
+            GDACS=dict(URL=ctx.urls["gdacs"]),
+            PG=dict(
+                HOST=db.hostname,
+                USER=db.username or "",
+                PW=db.password or "",
+                NAME=db.path.lstrip("/"),
+                SCHEMA=ctx.schema,
+                PORT=str(db.port or 5432),
+            ),
+        ),
+    )
+
+    return ["-c", path], {}
+
+
+def configure_eq(ctx):
+    usgs = ctx.urls["usgs"]
+    path = ctx.write_config(
+        "eq_historical.txt",
+        dict(
+            USGS=dict(
+                API_URL=f"{usgs}/fdsnws/event/1/query",
+                FEED_URL=f"{usgs}/earthquakes/feed/v1.0/summary/"
+                "all_hour.geojson",
+                COUNTRIES_FILE=join(ctx.fixtures, "usgs_countries.csv"),
+            ),
+            DB=dict(
+                SCHEMA=ctx.schema,
+                URL=ctx.db_url or "",
+                EVENTS_TABLE_NAME="eq_events",
+                SM_TABLE_NAME="eq_shakemaps",
+            ),
+        ),
+    )
+
+    return ["-c", path], {}
+
+
+def configure_ts(ctx):
+    url = f"{ctx.urls['ibtracs']}/csv/ibtracs"
+
+    return [], dict(
+        API_URL=f"{url}.ACTIVE.list.v04r00.csv",
+        ALL_API_URL=f"{url}.ALL.list.v04r00.csv",
+        TABLE_NAME="wld_ibtracs",
+        DB_SCHEMA=ctx.schema,
+        DB_URL=ctx.db_url or "",
+    )
+
+
+def configure_catalog(ctx):
+    return [], dict(
+        API_URL=ctx.urls["vam"],
+        CONSUMER_KEY="bench",
+        CONSUMER_SECRET="bench",
+        ADMIN0_FILE=join(ctx.fixtures, "vam_admin0.csv"),
+        DB_SCHEMA=ctx.schema,
+        DB_URL=ctx.db_url or "",
+        PRICES_START=ctx.meta["vam"]["prices_start"],
+    )
+
+
+def configure_acled(ctx):
+    path = ctx.write_config(
+        "acled.txt",
+        dict(
+            ACLED=dict(
+                KEY="bench",
+                EMAIL="bench",
+                API_URL=f"{ctx.urls['acled']}/acled/read",
+                ISO_COUNTRIES=ctx.meta["acled"]["iso"],
+            ),
+            ARCGIS=dict(USER="", PW="", URL=""),
+            MISC=dict(
+                START_DATE="2018-01-01",
+                FILENAME="bench",
+                STORE_PATH=join(ctx.work, "acled_store"),
+            ),
+        ),
+    )
+
+    return ["-c", path, "-o", join(ctx.work, "acled.csv")], {}
+
+
+def configure_osm_names(ctx):
+    return [], dict(
+        NOMINATIM_URL=f"{ctx.urls['nominatim']}/reverse",
+        DUMP_FILE=join(ctx.fixtures, "dump.csv"),
+        OUT_FILE=join(ctx.work, "osm_names.csv"),
+        CACHE_FILE=join(ctx.work, "osm_names_cache.sqlite"),
+        RATE="1000",
+        MAX_CONCURRENCY="8",
+    )
+
+
+CONFIGURE = {
+    "gdacs": configure_gdacs,
+    "fetch-gdacs": configure_gdacs,
+    "eq-historical": configure_eq,
+    "ts-historical": configure_ts,
+    "fetch-catalog": configure_catalog,
+    "acled": configure_acled,
+    "osm-names": configure_osm_names,
+}
+
+
+def reset_schema(db_url, schema):
+    from sqlalchemy import create_engine
+
+    engine = create_engine(db_url)
+    engine.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    engine.execute(f"CREATE SCHEMA {schema}")
+    engine.dispose()
+
+
+def run_step(ctx, command, args, number, timeout):
+    extra_args, env = CONFIGURE[command](ctx)
+    env = {
+        **os.environ,
+        **env,
+        "WFP_HTTP_CACHE_DIR": join(ctx.work, "http_cache"),
+        "WFP_HTTP_RATES": "",
+    }
+
+    log_path = join(ctx.work, f"{number:02d}_{command}.log")
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        try:
+            proc = subprocess.run(
+                [sys.executable, "run.py", command] + extra_args + args,
+                cwd=ROOT,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                timeout=timeout,
+            )
+            returncode = proc.returncode
+        except subprocess.TimeoutExpired:
+            returncode = "timeout"
+
+    return time.perf_counter() - start, returncode, log_path
+
+
+def run_scenario(name, fixtures, meta, servers, options):
+    work = join(options.work, name)
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+
+    schema = f"bench_{name}"
+    if options.db_url:
+        reset_schema(options.db_url, schema)
+
+    ctx = Context(fixtures, meta, servers, work, options.db_url, schema)
+
+    results = []
+    for number, (command, args, needs_db, timed) in enumerate(
+        SCENARIOS[name]
+    ):
+        step = " ".join([command] + args)
+        if needs_db and not options.db_url:
+            logger.info(f"{name}: skipping {step}, no --db-url")
+            continue
+
+        seconds, returncode, log_path = run_step(
+            ctx, command, args, number, options.timeout
+        )
+        if returncode != 0:
+            logger.warning(f"{name}: {step} failed, see {log_path}")
+
+        if timed:
+            results.append(
+                dict(
+                    scenario=name,
+                    step=step,
+                    seconds=round(seconds, 3),
+                    returncode=returncode,
+                )
+            )
+
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option(
+        "--scenarios", dest="scenarios", default=",".join(SCENARIOS)
+    )
+    parser.add_option("--db-url", dest="db_url")
+    parser.add_option(
+        "-f",
+        "--fixtures",
+        dest="fixtures",
+        help="Fixture folder, synthesized into the work folder when missing",
+    )
+    parser.add_option("--scale", dest="scale", type="float", default=1.0)
+    parser.add_option(
+        "--latency",
+        dest="latency",
+        type="float",
+        default=0.0,
+        help="Seconds added to every upstream request",
+    )
+    parser.add_option("--timeout", dest="timeout", type="int", default=3600)
+    parser.add_option(
+        "--threshold",
+        dest="threshold",
+        type="float",
+        default=0.2,
+        help="Relative slowdown reported as a regression",
+    )
+    parser.add_option("--work", dest="work", default="/tmp/wfp_bench")
+    parser.add_option(
+        "-o",
+        "--output",
+        dest="output",
+        default=join(ROOT, "benchmarks", "scenario_history.json"),
+    )
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    fixtures = options.fixtures
+    if fixtures is None:
+        fixtures = join(options.work, "fixtures")
+        shutil.rmtree(fixtures, ignore_errors=True)
+        meta = synthesize(fixtures, options.scale)
+    else:
+        with open(join(fixtures, "meta.json")) as f:
+            meta = json.load(f)
+
+    servers = start_servers(fixtures, options.latency)
+
+    history = load_history(options.output)
+    # Failed steps are kept in the history but never used as a baseline.
+    previous = latest_results(
+        history,
+        lambda r: (r["scenario"], r["step"]),
+        lambda r: r["returncode"] == 0,
+    )
+
+    results = []
+    regressions = []
+    for name in options.scenarios.split(","):
+        for result in run_scenario(name, fixtures, meta, servers, options):
+            results.append(result)
+
+            message = f"{name}: {result['step']} {result['seconds']:.2f}s"
+            if result["returncode"] != 0:
+                message += f" (failed: {result['returncode']})"
+
+            before = previous.get((name, result["step"]))
+            if before is not None and result["returncode"] == 0:
+                change = result["seconds"] / before["seconds"] - 1
+                message += f" {change:+.0%}"
+                if change > options.threshold:
+                    regressions.append(f"{name}: {result['step']}")
+
+            print(message)
+
+    for name, (server, upstream) in servers.items():
+        if upstream.misses > 0:
+            logger.warning(f"{name}: {upstream.misses} requests not found")
+        server.shutdown()
+
+    append_run(
+        options.output,
+        history,
+        results,
+        scale=meta.get("scale"),
+        latency=options.latency,
+        database=options.db_url is not None,
+    )
+
+    if len(regressions) > 0:
+        logger.warning(f"Slower than the previous run: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Cold start time of each run.py command, measured with -X importtime.
+
+    python -m benchmarks.startup_bench --repeat 3 -o startup_history.json
+
+Every run is appended to the history file and each command is compared with
+its latest previous result, commands slower than --threshold are reported.
+"""
+import logging
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.append(ROOT)
+
+from benchmarks.history import (  # noqa: E402
+    append_run,
+    latest_results,
+    load_history,
+)
+from run import COMMANDS  # noqa: E402
+
+logger = logging.getLogger()
+
+# Scripts without option parsing would run for real on --help.
+SKIP = {"countries-fetch"}
+
+
+def parse_importtime(stderr):
+    """Cumulative import time in microseconds of each top level import."""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+
+        # Nested imports are indented under their parent.
+        if name.startswith("   "):
+            continue
+
+        name = name.strip()
+        imports[name] = imports.get(name, 0) + int(cumulative)
+
+    return imports
+
+
+def measure(command):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "run.py", command, "--help"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+
+    imports = parse_importtime(proc.stderr)
+    slowest = sorted(imports.items(), key=lambda i: i[1], reverse=True)
+
+    return dict(
+        command=command,
+        returncode=proc.returncode,
+        seconds=round(seconds, 4),
+        import_seconds=round(sum(imports.values()) / 1e6, 4),
+        slowest_imports=[
+            dict(module=name, seconds=round(us / 1e6, 4))
+            for name, us in slowest[:10]
+        ],
+    )
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option(
+        "--commands",
+        dest="commands",
+        default=",".join(sorted(set(COMMANDS) - SKIP)),
+    )
+    parser.add_option("--repeat", dest="repeat", type="int", default=3)
+    parser.add_option(
+        "--threshold",
+        dest="threshold",
+        type="float",
+        default=0.2,
+        help="Relative slowdown reported as a regression",
+    )
+    parser.add_option(
+        "-o",
+        "--output",
+        dest="output",
+        default=join(ROOT, "benchmarks", "startup_history.json"),
+    )
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    history = load_history(options.output)
+    previous = latest_results(history, lambda r: r["command"])
+
+    results = []
+    regressions = []
+    for command in options.commands.split(","):
+        # Best of repeat, the first run also warms the page cache.
+        runs = [measure(command) for _ in range(options.repeat)]
+        result = min(runs, key=lambda r: r["seconds"])
+        results.append(result)
+
+        if result["returncode"] != 0:
+            logger.warning(f"{command} exited with {result['returncode']}")
+
+        message = (
+            f"{command}: {result['seconds']:.3f}s "
+            f"(imports {result['import_seconds']:.3f}s)"
+        )
+
+        before = previous.get(command)
+        if before is not None:
+            change = result["seconds"] / before["seconds"] - 1
+            message += f" {change:+.0%}"
+            if change > options.threshold:
+                regressions.append(command)
+
+        print(message)
+
+    append_run(options.output, history, results)
+
+    if len(regressions) > 0:
+        logger.warning(f"Slower than the previous run: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Time the chunked ArcGIS upload path against the fake portal.
+
+    python -m benchmarks.upload_bench --sizes 1000,10000 --chunk-sizes 500,2000
+"""
+import csv
+import io
+import json
+import logging
+import random
+import sys
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+from datetime import date, timedelta
+from optparse import OptionParser
+from os.path import abspath, dirname
+from types import SimpleNamespace
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from benchmarks.arcgis_server import start_server  # noqa: E402
+from common.chunked_upload import upload_chunks  # noqa: E402
+
+logger = logging.getLogger()
+
+KEY_FIELD = "event_id_cnty"
+
+EVENT_TYPES = [
+    "Battles",
+    "Protests",
+    "Riots",
+    "Violence against civilians",
+    "Explosions/Remote violence",
+    "Strategic developments",
+]
+
+
+def synthetic_rows(size, seed=0):
+    rng = random.Random(seed)
+    start = date(2018, 1, 1)
+
+    rows = []
+    for idx in range(size):
+        event_date = start + timedelta(days=rng.randint(0, 1000))
+        rows.append(
+            dict(
+                event_id_cnty=f"BEN{idx}",
+                event_date=event_date.isoformat(),
+                year=str(event_date.year),
+                event_type=rng.choice(EVENT_TYPES),
+                iso="508",
+                country="Mozambique",
+                latitude=f"{rng.uniform(-26.8, -10.5):.4f}",
+                longitude=f"{rng.uniform(30.2, 40.8):.4f}",
+                fatalities=str(rng.randint(0, 20)),
+                notes="x" * rng.randint(50, 400),
+                timestamp=str(1600000000 + idx),
+            )
+        )
+
+    return rows
+
+
+def to_csv(rows):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, rows[0].keys())
+    writer.writeheader()
+    writer.writerows(rows)
+
+    return output.getvalue().encode("utf-8")
+
+
+class RestLayer:
+    """Minimal FeatureLayer replacement talking plain REST, for running the
+    benchmark where the arcgis package is not installed."""
+
+    def __init__(self, url):
+        self.url = url
+        self.properties = SimpleNamespace(**self.request(""))
+
+    def request(self, operation, **params):
+        params["f"] = "json"
+        data = urllib.parse.urlencode(params).encode("utf-8")
+        url = f"{self.url}/{operation}" if operation else self.url
+        with urllib.request.urlopen(url, data=data) as resp:
+            return json.load(resp)
+
+    def query(self, where="1=1", out_fields="*", return_geometry=True):
+        result = self.request(
+            "query",
+            where=where,
+            outFields=out_fields,
+            returnGeometry=str(return_geometry).lower(),
+        )
+        features = [
+            SimpleNamespace(attributes=f["attributes"])
+            for f in result.get("features", [])
+        ]
+        return SimpleNamespace(features=features)
+
+    def edit_features(self, adds=None, updates=None, deletes=None):
+        return self.request(
+            "applyEdits",
+            adds=json.dumps(adds or []),
+            updates=json.dumps(updates or []),
+            deletes=json.dumps(deletes or []),
+        )
+
+    def count(self):
+        return self.request("query", where="1=1", returnCountOnly="true")[
+            "count"
+        ]
+
+
+def publish_rest(portal_url, name, rows):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="title"\r\n\r\n'
+        f"{name}\r\n"
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="data.csv"\r\n'
+        "Content-Type: text/csv\r\n\r\n"
+    ).encode("utf-8")
+    body += to_csv(rows) + f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    request = urllib.request.Request(
+        f"{portal_url}/sharing/rest/content/users/bench/addItem",
+        data=body,
+        headers={
+            "Content-Type": f"multipart/form-data; boundary={boundary}"
+        },
+    )
+    with urllib.request.urlopen(request) as resp:
+        item_id = json.load(resp)["id"]
+
+    publish_params = dict(
+        name=name,
+        type="csv",
+        locationType="coordinates",
+        latitudeFieldName="latitude",
+        longitudeFieldName="longitude",
+    )
+    data = urllib.parse.urlencode(
+        dict(itemId=item_id, publishParameters=json.dumps(publish_params))
+    ).encode("utf-8")
+    with urllib.request.urlopen(
+        f"{portal_url}/sharing/rest/content/users/bench/publish", data=data
+    ) as resp:
+        service_url = json.load(resp)["services"][0]["serviceurl"]
+
+    return RestLayer(f"{service_url}/0")
+
+
+def publish_arcgis(portal_url, name, rows):
+    from arcgis.gis import GIS
+
+    gis = GIS(portal_url, "bench", "bench")
+
+    path = f"/tmp/{name}.csv"
+    with open(path, "wb") as f:
+        f.write(to_csv(rows))
+
+    item = gis.content.add(dict(title=name), data=path)
+    item = item.publish(
+        publish_parameters=dict(
+            name=name,
+            type="csv",
+            locationType="coordinates",
+            latitudeFieldName="latitude",
+            longitudeFieldName="longitude",
+        )
+    )
+
+    return item.layers[0]
+
+
+def run_scenario(portal, publish, size, chunk_size, workers):
+    rows = synthetic_rows(size)
+    name = f"bench_{size}_{chunk_size}_{workers}_{uuid.uuid4().hex[:6]}"
+
+    start = time.perf_counter()
+    layer = publish(portal.url, name, rows[:chunk_size])
+    upload_chunks(
+        layer,
+        rows[chunk_size:],
+        x_field="longitude",
+        y_field="latitude",
+        key_field=KEY_FIELD,
+        chunk_size=chunk_size,
+        workers=workers,
+    )
+    initial = time.perf_counter() - start
+
+    # Same rows again, every feature becomes an update.
+    start = time.perf_counter()
+    upload_chunks(
+        layer,
+        rows,
+        x_field="longitude",
+        y_field="latitude",
+        key_field=KEY_FIELD,
+        chunk_size=chunk_size,
+        workers=workers,
+    )
+    rerun = time.perf_counter() - start
+
+    num_features = len(portal.services[name].features)
+    if num_features != size:
+        raise ValueError(f"Expected {size} features, found {num_features}")
+
+    return dict(
+        size=size,
+        chunk_size=chunk_size,
+        workers=workers,
+        initial_seconds=round(initial, 3),
+        rerun_seconds=round(rerun, 3),
+        rows_per_second=round(size / initial, 1),
+    )
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sizes", dest="sizes", default="1000,10000")
+    parser.add_option("--chunk-sizes", dest="chunk_sizes", default="500,2000")
+    parser.add_option("--workers", dest="workers", default="1,4")
+    parser.add_option(
+        "--latency", dest="latency", type="float", default=0.05
+    )
+    parser.add_option(
+        "--per-feature", dest="per_feature", type="float", default=0.0001
+    )
+    parser.add_option(
+        "--client",
+        dest="client",
+        choices=["arcgis", "rest"],
+        default="rest",
+        help="Use the arcgis package or a plain REST client",
+    )
+    parser.add_option("-o", "--output", dest="output")
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.WARN)
+
+    server, portal = start_server(
+        latency=options.latency, per_feature=options.per_feature
+    )
+    publish = publish_arcgis if options.client == "arcgis" else publish_rest
+
+    results = []
+    for size in parse_ints(options.sizes):
+        for chunk_size in parse_ints(options.chunk_sizes):
+            for workers in parse_ints(options.workers):
+                result = run_scenario(
+                    portal, publish, size, chunk_size, workers
+                )
+                print(
+                    "size={size} chunk_size={chunk_size} workers={workers} "
+                    "initial={initial_seconds}s rerun={rerun_seconds}s "
+                    "rows/s={rows_per_second}".format(**result)
+                )
+                results.append(result)
+
+    server.shutdown()
+
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(
+                dict(
+                    client=options.client,
+                    latency=options.latency,
+                    per_feature=options.per_feature,
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
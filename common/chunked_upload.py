@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import exists
+
+logger = logging.getLogger()
+
+
+def batches(items, size):
+    for idx in range(0, len(items), size):
+        yield items[idx : idx + size]
+
+
+def to_feature(row, x_field, y_field):
+    attributes = {k: (None if v == "" else v) for k, v in row.items()}
+    geometry = {
+        "x": float(row[x_field]),
+        "y": float(row[y_field]),
+        "spatialReference": {"wkid": 4326},
+    }
+
+    return {"attributes": attributes, "geometry": geometry}
+
+
+def quote(value):
+    value = str(value).replace("'", "''")
+    return f"'{value}'"
+
+
+def add_unique_index(layer, field):
+    """Unique index on field, upserts matching on field need it."""
+    for index in layer.properties.get("indexes", []):
+        if index["isUnique"] and index["fields"].lower() == field.lower():
+            return
+
+    layer.manager.add_to_definition(
+        {
+            "indexes": [
+                {
+                    "name": f"{field}_idx",
+                    "fields": field,
+                    "isUnique": True,
+                    "isAscending": True,
+                    "description": f"Unique {field}",
+                }
+            ]
+        }
+    )
+
+
+def get_object_ids(layer, key_field, keys):
+    oid_field = layer.properties.objectIdField
+    where = "{} IN ({})".format(key_field, ",".join(quote(k) for k in keys))
+
+    result = layer.query(
+        where=where,
+        out_fields=f"{oid_field},{key_field}",
+        return_geometry=False,
+    )
+
+    return {
+        str(f.attributes[key_field]): f.attributes[oid_field]
+        for f in result.features
+    }
+
+
+def apply_chunk(layer, features, key_field=None):
+    adds, updates = features, []
+
+    # Features already in the layer are sent as updates.
+    if key_field is not None:
+        oid_field = layer.properties.objectIdField
+        keys = [str(f["attributes"][key_field]) for f in features]
+        object_ids = get_object_ids(layer, key_field, keys)
+
+        adds = []
+        for feature in features:
+            oid = object_ids.get(str(feature["attributes"][key_field]))
+            if oid is None:
+                adds.append(feature)
+                continue
+
+            feature["attributes"][oid_field] = oid
+            updates.append(feature)
+
+    result = layer.edit_features(adds=adds, updates=updates)
+
+    errors = [
+        r
+        for k in ("addResults", "updateResults")
+        for r in result.get(k, [])
+        if r.get("success") is not True
+    ]
+    if len(errors) > 0:
+        raise ValueError(
+            f"{len(errors)} edits failed: {errors[0].get('error')}"
+        )
+
+    return len(adds), len(updates)
+
+
+def apply_chunk_with_retry(layer, features, key_field, retries):
+    for attempt in range(retries + 1):
+        try:
+            return apply_chunk(layer, features, key_field)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = 2 ** attempt
+            logger.warning(f"Chunk failed ({e}), retrying in {wait}s")
+            time.sleep(wait)
+
+
+def get_fingerprint(rows, chunk_size):
+    content = json.dumps(rows, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(content + str(chunk_size).encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(path, fingerprint):
+    if path is None or not exists(path):
+        return set()
+
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+
+    # Checkpoint belongs to a different upload.
+    if checkpoint.get("fingerprint") != fingerprint:
+        return set()
+
+    return set(checkpoint.get("done"))
+
+
+def save_checkpoint(path, fingerprint, done):
+    if path is None:
+        return
+
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(dict(fingerprint=fingerprint, done=sorted(done)), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def upload_chunks(
+    layer,
+    rows,
+    x_field,
+    y_field,
+    key_field=None,
+    chunk_size=1000,
+    workers=4,
+    retries=3,
+    checkpoint_path=None,
+):
+    """Send rows to a feature layer in parallel batches of edit_features.
+
+    With key_field set, rows matching an existing feature are updated
+    instead of added. Completed chunks are recorded in checkpoint_path so a
+    rerun over the same rows only retries the chunks that failed.
+    """
+    fingerprint = get_fingerprint(rows, chunk_size)
+    done = load_checkpoint(checkpoint_path, fingerprint)
+
+    chunks = list(batches(rows, chunk_size))
+    pending = [idx for idx in range(len(chunks)) if idx not in done]
+
+    if len(done) > 0:
+        logger.info(f"Resuming upload, {len(done)} chunks already sent")
+
+    num_adds, num_updates = 0, 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                apply_chunk_with_retry,
+                layer,
+                [to_feature(r, x_field, y_field) for r in chunks[idx]],
+                key_field,
+                retries,
+            ): idx
+            for idx in pending
+        }
+
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                adds, updates = future.result()
+            except Exception as e:
+                logger.error(f"Chunk {idx} failed: {e}")
+                failed.append(idx)
+                continue
+
+            num_adds += adds
+            num_updates += updates
+            done.add(idx)
+            save_checkpoint(checkpoint_path, fingerprint, done)
+
+    logger.info(f"Added {num_adds} and updated {num_updates} features")
+
+    if len(failed) > 0:
+        raise RuntimeError(
+            f"{len(failed)} of {len(chunks)} chunks failed: {sorted(failed)}"
+        )
+
+    if checkpoint_path is not None and exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return num_adds, num_updates
@@ -0,0 +1,317 @@
+import json
+import logging
+import os
+import time
+
+from collections import defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import JSON, create_engine
+
+logger = logging.getLogger()
+
+ENGINES = {}
+
+
+def get_pool_settings():
+    """Pool settings from the environment, read when an engine is created
+    since the scheduler sets them in processes that imported this module
+    already."""
+    return dict(
+        pool_size=int(os.getenv("WFP_DB_POOL_SIZE", 5)),
+        max_overflow=int(os.getenv("WFP_DB_MAX_OVERFLOW", 10)),
+        pool_recycle=int(os.getenv("WFP_DB_POOL_RECYCLE", 1800)),
+        statement_timeout=int(os.getenv("WFP_DB_STATEMENT_TIMEOUT", 0)),
+    )
+
+
+def get_pool_capacity():
+    """Connections an engine can hand out at once."""
+    settings = get_pool_settings()
+    return settings["pool_size"] + settings["max_overflow"]
+
+
+def get_engine(url, application_name=None, statement_timeout=None):
+    """Pooled engine for url, created once per process and shared by every
+    loader using the same database."""
+    if url in ENGINES:
+        return ENGINES[url]
+
+    connect_args = {}
+    if application_name is not None:
+        connect_args["application_name"] = application_name
+
+    settings = get_pool_settings()
+
+    # Milliseconds, 0 disables it.
+    timeout = statement_timeout or settings["statement_timeout"]
+    if timeout > 0:
+        connect_args["options"] = f"-c statement_timeout={timeout}"
+
+    engine = create_engine(
+        url,
+        pool_size=settings["pool_size"],
+        max_overflow=settings["max_overflow"],
+        pool_pre_ping=True,
+        pool_recycle=settings["pool_recycle"],
+        connect_args=connect_args,
+    )
+    ENGINES[url] = engine
+
+    return engine
+
+
+class LazyEngine:
+    """Stands in for get_engine(url, ...) and only creates the engine, and
+    imports the database driver, the first time it is used."""
+
+    def __init__(self, url, **kwargs):
+        self.engine_url = url
+        self.engine_options = kwargs
+
+    def __getattr__(self, name):
+        engine = get_engine(self.engine_url, **self.engine_options)
+        return getattr(engine, name)
+
+
+def quote_element(value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{value}"'
+
+
+def format_hstore(value):
+    return ", ".join(
+        "{}=>{}".format(
+            quote_element(k), "NULL" if v is None else quote_element(v)
+        )
+        for k, v in value.items()
+    )
+
+
+def format_array(value):
+    elements = []
+    for element in value:
+        if element is None:
+            elements.append("NULL")
+        elif isinstance(element, bool):
+            elements.append("t" if element else "f")
+        elif isinstance(element, (int, float)):
+            elements.append(str(element))
+        elif isinstance(element, dict):
+            elements.append(quote_element(format_hstore(element)))
+        else:
+            elements.append(quote_element(element))
+
+    return "{" + ",".join(elements) + "}"
+
+
+def format_value(value, srid=None, as_json=False):
+    """Value in COPY text format. Dicts are hstore unless as_json, set for
+    JSON and JSONB columns."""
+    if value is None:
+        return "\\N"
+
+    if as_json:
+        text = json.dumps(value, default=str)
+    elif isinstance(value, bool):
+        text = "t" if value else "f"
+    elif isinstance(value, (datetime, date)):
+        text = value.isoformat()
+    elif isinstance(value, dict):
+        text = format_hstore(value)
+    elif isinstance(value, (list, tuple)):
+        text = format_array(value)
+    elif hasattr(value, "wkt"):
+        # Shapely geometry.
+        text = value.wkt if srid is None else f"SRID={srid};{value.wkt}"
+    else:
+        text = str(value)
+        if srid is not None and not text.upper().startswith("SRID="):
+            text = f"SRID={srid};{text}"
+
+    return (
+        text.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class CopyStream:
+    """File-like object producing COPY lines on demand, so rows are never
+    all held in memory as text."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = bytearray()
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer.extend(line.encode("utf-8"))
+            self.count += 1
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def get_srids(table, columns):
+    srids = []
+    for name in columns:
+        srid = None
+        if not isinstance(table, str):
+            srid = getattr(table.columns[name].type, "srid", None)
+        srids.append(srid if srid is not None and srid > 0 else None)
+
+    return srids
+
+
+def get_json_columns(table, columns):
+    if isinstance(table, str):
+        return [False] * len(columns)
+
+    return [isinstance(table.columns[c].type, JSON) for c in columns]
+
+
+class BulkWriter:
+    """Streams rows into PostgreSQL with COPY and keeps rows/seconds per
+    table."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.metrics = defaultdict(lambda: dict(rows=0, seconds=0.0))
+
+    def copy_rows(self, table, columns, rows, connection=None, target=None):
+        """COPY rows (tuples in columns order, or dicts) into table, a
+        Table or a table name. Uses connection when given so the rows are
+        part of the caller's transaction. target overrides the table name,
+        keeping the column types of table."""
+        name = table if isinstance(table, str) else table.fullname
+        name = target or name
+        srids = get_srids(table, columns)
+        json_columns = get_json_columns(table, columns)
+
+        def lines():
+            for row in rows:
+                if isinstance(row, dict):
+                    row = [row.get(c) for c in columns]
+                values = [
+                    format_value(v, s, j)
+                    for v, s, j in zip(row, srids, json_columns)
+                ]
+                yield "\t".join(values) + "\n"
+
+        stream = CopyStream(lines())
+        sql = "COPY {} ({}) FROM STDIN".format(
+            name, ", ".join(f'"{c}"' for c in columns)
+        )
+
+        start = time.perf_counter()
+        if connection is None:
+            with self.engine.begin() as conn:
+                conn.connection.cursor().copy_expert(sql, stream)
+        else:
+            connection.connection.cursor().copy_expert(sql, stream)
+
+        self.record(name, stream.count, time.perf_counter() - start)
+
+        return stream.count
+
+    def write_objects(self, objects, connection=None):
+        """COPY ORM objects, grouped by table. Autoincrement primary keys
+        left empty are filled by the database."""
+        groups = defaultdict(list)
+        for obj in objects:
+            groups[type(obj)].append(obj)
+
+        count = 0
+        for model, items in groups.items():
+            table = model.__table__
+            columns = [
+                c
+                for c in table.columns
+                if not (
+                    c.primary_key
+                    and c.autoincrement is not False
+                    and all(getattr(o, c.key) is None for o in items)
+                )
+            ]
+
+            rows = ([getattr(o, c.key) for c in columns] for o in items)
+            count += self.copy_rows(
+                table, [c.name for c in columns], rows, connection
+            )
+
+        return count
+
+    def upsert(
+        self,
+        table,
+        columns,
+        rows,
+        key_columns,
+        update_columns=None,
+        connection=None,
+    ):
+        """COPY rows into a staging table and merge them into table with
+        INSERT ... ON CONFLICT. Without update_columns existing rows are
+        left untouched. Returns the number of rows inserted or updated."""
+        staging = f"staging_{table.name}"
+        column_list = ", ".join(f'"{c}"' for c in columns)
+        keys = ", ".join(f'"{c}"' for c in key_columns)
+
+        conflict = "DO NOTHING"
+        if update_columns:
+            conflict = "DO UPDATE SET " + ", ".join(
+                f'"{c}" = EXCLUDED."{c}"' for c in update_columns
+            )
+
+        def merge(conn):
+            conn.execute(
+                f"CREATE TEMP TABLE {staging} "
+                f"(LIKE {table.fullname} INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            self.copy_rows(table, columns, rows, conn, target=staging)
+
+            start = time.perf_counter()
+            result = conn.execute(
+                f"INSERT INTO {table.fullname} ({column_list}) "
+                f"SELECT DISTINCT ON ({keys}) {column_list} FROM {staging} "
+                f"ON CONFLICT ({keys}) {conflict}"
+            )
+            self.record(
+                f"{table.fullname} (merged)",
+                result.rowcount,
+                time.perf_counter() - start,
+            )
+
+            return result.rowcount
+
+        if connection is not None:
+            return merge(connection)
+
+        with self.engine.begin() as conn:
+            return merge(conn)
+
+    def record(self, table, rows, seconds):
+        self.metrics[table]["rows"] += rows
+        self.metrics[table]["seconds"] += seconds
+
+    def log_metrics(self):
+        for table, metric in self.metrics.items():
+            rows, seconds = metric["rows"], metric["seconds"]
+            rate = rows / seconds if seconds > 0 else 0
+            logger.info(
+                f"{table}: {rows} rows in {seconds:.2f}s ({rate:.0f} rows/s)"
+            )
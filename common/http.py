@@ -0,0 +1,498 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+from os.path import exists, join
+from urllib.parse import urlsplit
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+TIMEOUT = float(os.getenv("WFP_HTTP_TIMEOUT", 60))
+RETRIES = int(os.getenv("WFP_HTTP_RETRIES", 4))
+BACKOFF = float(os.getenv("WFP_HTTP_BACKOFF", 1))
+MAX_BACKOFF = float(os.getenv("WFP_HTTP_MAX_BACKOFF", 60))
+POOL_SIZE = int(os.getenv("WFP_HTTP_POOL_SIZE", 10))
+CACHE_DIR = os.getenv("WFP_HTTP_CACHE_DIR", "/tmp/wfp_http_cache")
+
+# Requests per second by host, "www.gdacs.org=2,api.acleddata.com=1".
+RATES = os.getenv("WFP_HTTP_RATES", "")
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def parse_rates(value):
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        host, rate = item.split("=", 1)
+        rates[host.strip()] = float(rate)
+
+    return rates
+
+
+def get_host(url):
+    return urlsplit(url).netloc
+
+
+def get_delay(attempt, backoff, retry_after=None):
+    """Retry-After when the server sent seconds, otherwise exponential
+    backoff with full jitter."""
+    if retry_after is not None and retry_after.isdigit():
+        return min(MAX_BACKOFF, float(retry_after))
+
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+
+
+class HttpStatusError(Exception):
+    def __init__(self, status, url):
+        super().__init__(f"HTTP {status} for {url}")
+        self.status = status
+        self.url = url
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncTokenBucket(TokenBucket):
+    def __init__(self, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostStats:
+    """Requests, retries, errors, seconds and bytes received per host."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = defaultdict(
+            lambda: dict(
+                requests=0,
+                retries=0,
+                errors=0,
+                not_modified=0,
+                seconds=0.0,
+                bytes=0,
+            )
+        )
+
+    def record(self, host, **values):
+        with self.lock:
+            stats = self.hosts[host]
+            for key, value in values.items():
+                stats[key] += value
+
+    def as_dict(self):
+        with self.lock:
+            return {host: dict(stats) for host, stats in self.hosts.items()}
+
+    def log(self):
+        for host, stats in self.as_dict().items():
+            logger.info(
+                f"{host}: {stats['requests']} requests "
+                f"({stats['retries']} retries, {stats['errors']} errors, "
+                f"{stats['not_modified']} not modified) "
+                f"{stats['seconds']:.2f}s {stats['bytes'] / 1e6:.2f}MB"
+            )
+
+
+class ConditionalCache:
+    """Validators and body of the last response per url, used to send
+    If-None-Match/If-Modified-Since and to answer a 304."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, url, params):
+        value = json.dumps([url, params], sort_keys=True, default=str)
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    def headers(self, key):
+        meta_path = join(self.path, f"{key}.json")
+        if not exists(meta_path):
+            return {}
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        return headers
+
+    def get(self, key):
+        with open(join(self.path, f"{key}.body"), "rb") as f:
+            return f.read()
+
+    def put(self, key, headers, body):
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+
+        with open(join(self.path, f"{key}.body"), "wb") as f:
+            f.write(body)
+
+        # Metadata last, a partial write never leaves validators pointing
+        # to a missing body.
+        with open(join(self.path, f"{key}.json"), "w") as f:
+            json.dump(dict(etag=etag, last_modified=last_modified), f)
+
+
+class HttpClient:
+    """requests wrapper with a connection pool per host, timeouts, retries
+    with jittered backoff, per host rate limits and conditional GETs.
+
+    Responses get a from_cache attribute, True when the server answered
+    304 and the body comes from the local cache."""
+
+    def __init__(
+        self,
+        timeout=TIMEOUT,
+        retries=RETRIES,
+        backoff=BACKOFF,
+        rates=None,
+        pool_size=POOL_SIZE,
+        headers=None,
+        cache_dir=CACHE_DIR,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rates = parse_rates(RATES) if rates is None else rates
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self.cache_dir = cache_dir
+        self.cache = None
+
+        self.sessions = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.stats = HostStats()
+        self.pid = os.getpid()
+
+    def get_session(self, host):
+        # Forked workers must not share the parent's sockets.
+        if os.getpid() != self.pid:
+            self.sessions = {}
+            self.buckets = {}
+            self.lock = threading.Lock()
+            self.stats = HostStats()
+            self.pid = os.getpid()
+
+        with self.lock:
+            if host not in self.sessions:
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size
+                )
+                session = requests.Session()
+                session.headers.update(self.headers)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+
+                if host in self.rates:
+                    self.buckets[host] = TokenBucket(self.rates[host])
+
+            return self.sessions[host]
+
+    def get_cache(self):
+        with self.lock:
+            if self.cache is None:
+                self.cache = ConditionalCache(self.cache_dir)
+
+            return self.cache
+
+    def request(self, method, url, conditional=False, retry=None, **kwargs):
+        """Send a request, retrying connection errors and RETRY_STATUS
+        answers. Non idempotent methods are only retried with retry=True.
+        conditional=True revalidates a cached GET body."""
+        host = get_host(url)
+        session = self.get_session(host)
+        kwargs.setdefault("timeout", self.timeout)
+
+        if retry is None:
+            retry = method.upper() in IDEMPOTENT_METHODS
+        retries = self.retries if retry else 0
+
+        cache_key = None
+        if conditional:
+            if kwargs.get("stream"):
+                raise ValueError("Conditional requests cannot be streamed")
+            cache = self.get_cache()
+            cache_key = cache.key(url, kwargs.get("params"))
+            kwargs["headers"] = {
+                **cache.headers(cache_key),
+                **(kwargs.get("headers") or {}),
+            }
+
+        for attempt in range(retries + 1):
+            if host in self.buckets:
+                self.buckets[host].acquire()
+
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.stats.record(
+                    host,
+                    requests=1,
+                    errors=1,
+                    seconds=time.perf_counter() - start,
+                )
+                if attempt == retries:
+                    raise
+                logger.warning(f"Retrying {url}: {e}")
+                self.stats.record(host, retries=1)
+                time.sleep(get_delay(attempt, self.backoff))
+                continue
+
+            # Streamed bodies are counted from the declared length.
+            if kwargs.get("stream"):
+                size = int(resp.headers.get("Content-Length") or 0)
+            else:
+                size = len(resp.content)
+            self.stats.record(
+                host,
+                requests=1,
+                seconds=time.perf_counter() - start,
+                bytes=size,
+            )
+
+            if resp.status_code not in RETRY_STATUS or attempt == retries:
+                break
+
+            logger.warning(f"Retrying {url}: HTTP {resp.status_code}")
+            self.stats.record(host, retries=1)
+            resp.close()
+            time.sleep(
+                get_delay(
+                    attempt, self.backoff, resp.headers.get("Retry-After")
+                )
+            )
+
+        resp.from_cache = False
+        if cache_key is not None:
+            if resp.status_code == 304:
+                self.stats.record(host, not_modified=1)
+                resp.status_code = 200
+                resp._content = cache.get(cache_key)
+                resp.from_cache = True
+            elif resp.status_code == 200:
+                cache.put(cache_key, resp.headers, resp.content)
+
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+
+DEFAULT_CLIENT = None
+
+
+def default_client():
+    """Process wide HttpClient configured from the environment."""
+    global DEFAULT_CLIENT
+    if DEFAULT_CLIENT is None:
+        DEFAULT_CLIENT = HttpClient()
+
+    return DEFAULT_CLIENT
+
+
+class AsyncResponse:
+    def __init__(self, url, status, headers, body, from_cache=False):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.body.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpStatusError(self.status, self.url)
+
+
+class AsyncHttpClient:
+    """aiohttp counterpart of HttpClient, used as an async context manager.
+    Bodies are read completely and returned as AsyncResponse."""
+
+    def __init__(
+        self,
+        timeout=TIMEOUT,
+        retries=RETRIES,
+        backoff=BACKOFF,
+        rates=None,
+        pool_size=POOL_SIZE,
+        headers=None,
+        cache_dir=CACHE_DIR,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rates = parse_rates(RATES) if rates is None else rates
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self.cache_dir = cache_dir
+        self.cache = None
+
+        self.session = None
+        self.buckets = {}
+        self.stats = HostStats()
+
+    async def __aenter__(self):
+        # Only the async fetchers depend on aiohttp.
+        import aiohttp
+
+        self.errors = (aiohttp.ClientError, asyncio.TimeoutError)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers=self.headers,
+        )
+
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def get_bucket(self, host):
+        if host in self.rates and host not in self.buckets:
+            self.buckets[host] = AsyncTokenBucket(self.rates[host])
+
+        return self.buckets.get(host)
+
+    async def request(self, method, url, conditional=False, **kwargs):
+        host = get_host(url)
+        bucket = self.get_bucket(host)
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+
+        cache_key = None
+        if conditional:
+            if self.cache is None:
+                self.cache = ConditionalCache(self.cache_dir)
+            cache = self.cache
+            cache_key = cache.key(url, kwargs.get("params"))
+            kwargs["headers"] = {
+                **cache.headers(cache_key),
+                **(kwargs.get("headers") or {}),
+            }
+
+        for attempt in range(retries + 1):
+            if bucket is not None:
+                await bucket.acquire()
+
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as r:
+                    body = await r.read()
+                    resp = AsyncResponse(url, r.status, r.headers, body)
+            except self.errors as e:
+                self.stats.record(
+                    host,
+                    requests=1,
+                    errors=1,
+                    seconds=time.perf_counter() - start,
+                )
+                if attempt == retries:
+                    raise
+                logger.warning(f"Retrying {url}: {e!r}")
+                self.stats.record(host, retries=1)
+                await asyncio.sleep(get_delay(attempt, self.backoff))
+                continue
+
+            self.stats.record(
+                host,
+                requests=1,
+                seconds=time.perf_counter() - start,
+                bytes=len(body),
+            )
+
+            if resp.status not in RETRY_STATUS or attempt == retries:
+                break
+
+            logger.warning(f"Retrying {url}: HTTP {resp.status}")
+            self.stats.record(host, retries=1)
+            await asyncio.sleep(
+                get_delay(
+                    attempt, self.backoff, resp.headers.get("Retry-After")
+                )
+            )
+
+        if cache_key is not None:
+            if resp.status == 304:
+                self.stats.record(host, not_modified=1)
+                resp.status = 200
+                resp.body = cache.get(cache_key)
+                resp.from_cache = True
+            elif resp.status == 200:
+                cache.put(cache_key, resp.headers, resp.body)
+
+        return resp
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from os.path import join
+
+from common import profiling
+
+logger = logging.getLogger()
+
+METRICS_DIR = os.getenv("WFP_METRICS_DIR", "/tmp/wfp_metrics")
+
+TABLE_ACTIONS = ("inserted", "updated", "skipped", "deleted")
+
+
+def format_labels(**labels):
+    values = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels.items()
+    )
+
+    return "{" + values + "}"
+
+
+class Metrics:
+    """Stage timers, counters and rows per table of a run, written at the
+    end as <job>.prom for the node_exporter textfile collector and
+    <job>.json. Every value covers the last run only. Stage seconds are
+    summed over threads, so they can exceed the run time."""
+
+    def __init__(self, job):
+        self.job = job
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = defaultdict(lambda: dict(calls=0, errors=0, seconds=0.0))
+        self.counters = defaultdict(int)
+        self.tables = defaultdict(lambda: dict.fromkeys(TABLE_ACTIONS, 0))
+        self.clients = []
+        self.writers = []
+
+    def include(self, client=None, writer=None):
+        """Add the request stats of an HttpClient and the COPY stats of a
+        BulkWriter to the summary."""
+        if client is not None:
+            self.clients.append(client)
+        if writer is not None:
+            self.writers.append(writer)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        memory = profiling.enter_stage(name)
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            profiling.exit_stage(name, memory)
+            with self.lock:
+                stage = self.stages[name]
+                stage["calls"] += 1
+                stage["errors"] += int(error)
+                stage["seconds"] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def rows(self, table, **values):
+        """Rows inserted, updated, skipped or deleted in table."""
+        with self.lock:
+            for action, value in values.items():
+                self.tables[table][action] += value
+
+    def as_dict(self, success=True):
+        with self.lock:
+            summary = dict(
+                job=self.job,
+                success=success,
+                started=self.started,
+                seconds=round(time.time() - self.started, 3),
+                stages={k: dict(v) for k, v in self.stages.items()},
+                counters=dict(self.counters),
+                tables={k: dict(v) for k, v in self.tables.items()},
+            )
+
+        summary["http"] = {}
+        for client in self.clients:
+            summary["http"].update(client.stats.as_dict())
+
+        summary["copy"] = {}
+        for writer in self.writers:
+            summary["copy"].update(
+                {k: dict(v) for k, v in writer.metrics.items()}
+            )
+
+        return summary
+
+    def to_prometheus(self, summary):
+        job = summary["job"]
+        lines = []
+
+        def add(name, help_text, kind, samples):
+            lines.append(f"# HELP wfp_{name} {help_text}")
+            lines.append(f"# TYPE wfp_{name} {kind}")
+            for labels, value in samples:
+                labels = format_labels(job=job, **labels)
+                lines.append(f"wfp_{name}{labels} {value}")
+
+        add(
+            "run_success",
+            "1 if the last run finished without errors.",
+            "gauge",
+            [({}, int(summary["success"]))],
+        )
+        add(
+            "run_seconds",
+            "Duration of the last run.",
+            "gauge",
+            [({}, summary["seconds"])],
+        )
+        add(
+            "run_finished_timestamp_seconds",
+            "End of the last run.",
+            "gauge",
+            [({}, round(summary["started"] + summary["seconds"]))],
+        )
+
+        stages = summary["stages"].items()
+        add(
+            "stage_seconds",
+            "Seconds spent in each stage.",
+            "gauge",
+            [(dict(stage=k), round(v["seconds"], 4)) for k, v in stages],
+        )
+        add(
+            "stage_calls",
+            "Times each stage ran.",
+            "gauge",
+            [(dict(stage=k), v["calls"]) for k, v in stages],
+        )
+        add(
+            "stage_errors",
+            "Stage runs ending with an exception.",
+            "gauge",
+            [(dict(stage=k), v["errors"]) for k, v in stages],
+        )
+        add(
+            "items",
+            "Items counted during the run.",
+            "gauge",
+            [(dict(name=k), v) for k, v in summary["counters"].items()],
+        )
+        add(
+            "table_rows",
+            "Rows written to each table by action.",
+            "gauge",
+            [
+                (dict(table=table, action=action), value)
+                for table, actions in summary["tables"].items()
+                for action, value in actions.items()
+            ],
+        )
+
+        copy = summary["copy"].items()
+        add(
+            "copy_rows",
+            "Rows streamed with COPY into each table.",
+            "gauge",
+            [(dict(table=k), v["rows"]) for k, v in copy],
+        )
+        add(
+            "copy_seconds",
+            "Seconds spent in COPY for each table.",
+            "gauge",
+            [(dict(table=k), round(v["seconds"], 4)) for k, v in copy],
+        )
+
+        hosts = summary["http"].items()
+        for key, help_text in (
+            ("requests", "HTTP requests by host."),
+            ("retries", "HTTP retries by host."),
+            ("errors", "Failed HTTP requests by host."),
+            ("not_modified", "Responses revalidated from the cache."),
+            ("bytes", "Bytes downloaded by host."),
+        ):
+            add(
+                f"http_{key}",
+                help_text,
+                "gauge",
+                [(dict(host=k), v[key]) for k, v in hosts],
+            )
+        add(
+            "http_seconds",
+            "Seconds spent in HTTP requests by host.",
+            "gauge",
+            [(dict(host=k), round(v["seconds"], 4)) for k, v in hosts],
+        )
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, success=True, directory=None):
+        """Write <job>.prom and <job>.json, replacing them atomically so
+        the collector never reads half a file."""
+        directory = directory or METRICS_DIR
+        os.makedirs(directory, exist_ok=True)
+
+        summary = self.as_dict(success)
+        for name, content in (
+            (f"{self.job}.prom", self.to_prometheus(summary)),
+            (f"{self.job}.json", json.dumps(summary, indent=2)),
+        ):
+            path = join(directory, name)
+            with open(f"{path}.tmp", "w") as f:
+                f.write(content)
+            os.replace(f"{path}.tmp", path)
+
+        self.log(summary)
+
+        return summary
+
+    def log(self, summary):
+        for name, stage in sorted(
+            summary["stages"].items(),
+            key=lambda i: i[1]["seconds"],
+            reverse=True,
+        ):
+            logger.info(
+                f"{name}: {stage['seconds']:.2f}s in {stage['calls']} calls "
+                f"({stage['errors']} errors)"
+            )
+
+        for table, actions in summary["tables"].items():
+            values = ", ".join(f"{v} {k}" for k, v in actions.items() if v)
+            logger.info(f"{table}: {values or 'no changes'}")
+
+    @contextmanager
+    def run(self):
+        """Write the summary when the block ends, marking the run failed
+        if it raised."""
+        success = False
+        try:
+            yield self
+            success = True
+        finally:
+            self.write(success)
@@ -0,0 +1,312 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from glob import glob
+from os.path import basename, join
+
+logger = logging.getLogger()
+
+SAMPLE_INTERVAL = float(os.getenv("WFP_PROFILE_INTERVAL", 0.01))
+TRACEMALLOC_FRAMES = int(os.getenv("WFP_PROFILE_FRAMES", 1))
+TOP_ALLOCATIONS = 15
+# New stage peaks smaller than this ratio of the last one are not
+# snapshotted again, a snapshot takes seconds with many live objects.
+SNAPSHOT_GROWTH = 1.1
+
+# Profiler of the current process, set by start().
+PROFILER = None
+# (pid, profile, sampler) of a worker process.
+WORKER_PROFILE = None
+# Entry of a stage not run yet in Profiler.stages.
+EMPTY_STAGE = dict(calls=0, peak=0, growth=0, top=[], top_peak=0)
+
+
+def get_profile_dir():
+    """Set by run.py --profile, inherited by worker processes."""
+    return os.getenv("WFP_PROFILE_DIR")
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of every thread for a collapsed stack file, which
+    flamegraph.pl, speedscope or inferno read directly."""
+
+    def __init__(self, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(format_frame(frame).replace(";", ":"))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Profiler:
+    """cProfile stats, sampled stacks and tracemalloc peaks of a process.
+
+    Threads started while profiling get their own cProfile profile, merged
+    into the process stats. Memory is tracked per metrics stage: the peak
+    of traced memory while the stage ran and the largest allocations left
+    at the end of its biggest call. The peak is process wide, so stages
+    running at the same time in threads share it."""
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.sampler = Sampler(SAMPLE_INTERVAL)
+        self.thread_profiles = []
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = None
+        self.thread_run = None
+
+    def start(self):
+        global PROFILER
+
+        os.makedirs(self.directory, exist_ok=True)
+        PROFILER = self
+        self.started = time.perf_counter()
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        # Plain threads (ThreadPoolExecutor workers) run Thread.run.
+        self.thread_run = threading.Thread.run
+        profiler = self
+
+        def run(thread):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                profiler.thread_run(thread)
+            finally:
+                profile.disable()
+                with profiler.lock:
+                    profiler.thread_profiles.append(profile)
+
+        threading.Thread.run = run
+
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        global PROFILER
+
+        self.profile.disable()
+        self.sampler.stop()
+        threading.Thread.run = self.thread_run
+        PROFILER = None
+
+    def enter_stage(self, name):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        return current
+
+    def exit_stage(self, name, start):
+        _, peak = tracemalloc.get_traced_memory()
+
+        with self.lock:
+            stage = self.stages.setdefault(name, dict(EMPTY_STAGE))
+            stage["calls"] += 1
+            if peak <= stage["peak"]:
+                return
+            stage["peak"] = peak
+            stage["growth"] = peak - start
+
+            if peak < stage["top_peak"] * SNAPSHOT_GROWTH:
+                return
+            stage["top_peak"] = peak
+
+        top = self.top_allocations()
+        with self.lock:
+            stage["top"] = top
+
+        # Kept up to date so an OOM killed run still leaves its peaks.
+        self.write_memory()
+
+    def top_allocations(self):
+        top = []
+        for stat in tracemalloc.take_snapshot().statistics("lineno"):
+            frame = stat.traceback[0]
+            # The profiler's own sampled stacks.
+            if frame.filename == __file__:
+                continue
+
+            top.append(
+                dict(
+                    size=stat.size,
+                    count=stat.count,
+                    line=f"{frame.filename}:{frame.lineno}",
+                )
+            )
+            if len(top) == TOP_ALLOCATIONS:
+                break
+
+        return top
+
+    def write_memory(self):
+        current, _ = tracemalloc.get_traced_memory()
+        with self.lock:
+            memory = dict(
+                current=current,
+                stages={k: dict(v) for k, v in self.stages.items()},
+            )
+
+        path = join(self.directory, f"{self.name}.memory.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(memory, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def dump(self):
+        """Write <name>.pstats, <name>.collapsed, <name>.memory.json and a
+        text summary, merged with the files left by worker processes."""
+        # Stages reset the peak, the run peak is the largest of theirs.
+        _, peak = tracemalloc.get_traced_memory()
+        peak = max([peak] + [s["peak"] for s in self.stages.values()])
+        self.stages["run"] = dict(
+            calls=1,
+            peak=peak,
+            growth=peak,
+            top=self.top_allocations(),
+            top_peak=peak,
+        )
+
+        # Stages run in worker processes, with the peak of the largest.
+        for path in glob(join(self.directory, "worker-*.memory.json")):
+            with open(path) as f:
+                worker_stages = json.load(f)["stages"]
+            for name, values in worker_stages.items():
+                stage = self.stages.setdefault(name, dict(EMPTY_STAGE))
+                stage["calls"] += values["calls"]
+                if values["peak"] > stage["peak"]:
+                    calls = stage["calls"]
+                    stage.update(values, calls=calls)
+
+        stats = pstats.Stats(self.profile)
+        for profile in self.thread_profiles:
+            stats.add(profile)
+        for path in glob(join(self.directory, "worker-*.pstats")):
+            stats.add(path)
+        stats.dump_stats(join(self.directory, f"{self.name}.pstats"))
+
+        stacks = Counter(self.sampler.stacks)
+        for path in glob(join(self.directory, "worker-*.collapsed")):
+            with open(path) as f:
+                for line in f:
+                    stack, count = line.rsplit(" ", 1)
+                    stacks[stack] += int(count)
+        path = join(self.directory, f"{self.name}.collapsed")
+        write_collapsed(path, stacks)
+
+        self.write_memory()
+
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats("cumulative").print_stats(40)
+        with open(join(self.directory, f"{self.name}.txt"), "w") as f:
+            f.write(output.getvalue())
+
+        seconds = time.perf_counter() - self.started
+        peak = self.stages["run"]["peak"]
+        logger.info(
+            f"Profile of {seconds:.1f}s written to {self.directory}, "
+            f"peak traced memory {peak / 1e6:.1f}MB"
+        )
+
+
+def write_collapsed(path, stacks):
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def enter_stage(name):
+    if PROFILER is None:
+        return None
+
+    return PROFILER.enter_stage(name)
+
+
+def exit_stage(name, start):
+    if PROFILER is None or start is None:
+        return
+
+    PROFILER.exit_stage(name, start)
+
+
+class Worker:
+    """Profiles a function run in a worker process, writing the process
+    stats to the profile folder after every call since pool workers can be
+    terminated without running exit handlers."""
+
+    def __init__(self, func, directory):
+        self.func = func
+        self.directory = directory
+
+    def __call__(self, *args, **kwargs):
+        global PROFILER, WORKER_PROFILE
+
+        # Pool unpickles a new Worker for every task, the profile is kept
+        # per process. A forked child inherits the parent profiler, it is
+        # replaced by one tracking the stages of this process.
+        if WORKER_PROFILE is None or WORKER_PROFILE[0] != os.getpid():
+            pid = os.getpid()
+            PROFILER = Profiler(self.directory, f"worker-{pid}")
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            PROFILER.sampler.start()
+            WORKER_PROFILE = (pid, PROFILER.profile, PROFILER.sampler)
+
+        pid, profile, sampler = WORKER_PROFILE
+        profile.enable()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            profile.disable()
+            name = join(self.directory, f"worker-{pid}")
+            profile.dump_stats(f"{name}.pstats")
+            write_collapsed(f"{name}.collapsed", sampler.stacks)
+            PROFILER.write_memory()
+
+
+def worker(func):
+    """func wrapped for Pool.map when profiling, func itself otherwise."""
+    directory = get_profile_dir()
+    if directory is None:
+        return func
+
+    return Worker(func, directory)
@@ -2,13 +2,15 @@
 import json
 import re
 import os
-import requests
 import sys
 
 from os import remove
-from os.path import join
+from os.path import abspath, dirname, join
 from osgeo import gdal
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.http import HttpClient, default_client  # noqa: E402
+
 gdal.SetConfigOption("OGR_INTERLEAVED_READING", "YES")    
 os.environ["OSM_CONFIG_FILE"] = "./customconf.ini"
 
@@ -35,7 +37,7 @@ def find_authenticity_token(response):
 
 def get_tokens(consumer_url):
     url = f"{consumer_url}?action=request_token"
-    resp = requests.post(url, data={}, headers=CUSTOM_HEADER)
+    resp = default_client().post(url, data={}, headers=CUSTOM_HEADER)
     if resp.status_code != 200:
         raise ValueError(
             "POST {}, received HTTP status code {} but expected 200".format(
@@ -53,7 +55,8 @@ def get_tokens(consumer_url):
 
 def create_osm_session(username, password):
     login_url = f"{OSM_HOST}/login?cookie_test=true"
-    session = requests.Session()
+    # Own client, the login cookies stay out of the shared one.
+    session = HttpClient()
     resp = session.get(login_url, headers=CUSTOM_HEADER)
     if resp.status_code != 200:
         raise ValueError(
@@ -124,7 +127,7 @@ def logout(consumer_url, session, oauth_token, oauth_token_secret_encr):
         )
 
     # get final cookie
-    resp = requests.post(
+    resp = default_client().post(
         f"{consumer_url}?action=get_access_token_cookie&format=http",
         data={
             "oauth_token": oauth_token,
@@ -146,7 +149,7 @@ def process_country(values, cookies):
     download_url = values.get("urls").get("pbf-internal")
 
     file_path = join(PATH, f"{schema}.osm.pbf")
-    r = requests.get(download_url, cookies=cookies, stream=True)
+    r = default_client().get(download_url, cookies=cookies, stream=True)
     total_length = int(r.headers.get("content-length"))
 
     with open(file_path, "wb") as f:
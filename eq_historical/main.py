@@ -1,9 +1,8 @@
 import logging
-import requests
 import optparse
+import sys
 
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
@@ -23,9 +22,7 @@ from configparser import ConfigParser
 
 from zipfile import ZipFile
 
-from osgeo import ogr
-
-from os.path import join
+from os.path import abspath, dirname, join
 
 from tempfile import TemporaryDirectory
 
@@ -35,6 +32,11 @@ from json import dumps
 
 from multiprocessing import Pool
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import BulkWriter, LazyEngine  # noqa: E402
+from common.http import default_client  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
 parser = optparse.OptionParser()
@@ -53,10 +55,16 @@ Base = declarative_base()
 
 TABLE_COLUMNS = ["mag", "place", "time", "mmi", "title", "id"]
 
-engine = create_engine(config.get("DB", "URL"))
+engine = LazyEngine(
+    config.get("DB", "URL"), application_name="eq_historical"
+)
 Session = sessionmaker(bind=engine)
+writer = BulkWriter(engine)
+client = default_client()
+metrics = Metrics("eq_historical")
+metrics.include(client=client, writer=writer)
+
 
-'''
 class Earthquake(Base):
     __tablename__ = config.get("DB", "EVENTS_TABLE_NAME")
     __table_args__ = {"schema": DB_SCHEMA}
@@ -69,7 +77,6 @@ class Earthquake(Base):
     mmi = Column(Integer)
     title = Column(String, nullable=False)
     iso3 = Column(String, nullable=False)
-'''
 
 
 class ShakeMap(Base):
@@ -85,70 +92,81 @@ class ShakeMap(Base):
 
 
 def download_shakemap_polygons(detail_url, item):
-    resp = requests.get(detail_url)
-    resp.raise_for_status()
-
-    zip_url = (
-        resp.json()
-        .get("properties")
-        .get("products")
-        .get("shakemap")[0]
-        .get("contents")
-        .get("download/shape.zip")
-        .get("url")
-    )
+    from osgeo import ogr
+
+    with metrics.stage("fetch"):
+        resp = client.get(detail_url)
+        resp.raise_for_status()
+
+        zip_url = (
+            resp.json()
+            .get("properties")
+            .get("products")
+            .get("shakemap")[0]
+            .get("contents")
+            .get("download/shape.zip")
+            .get("url")
+        )
 
     temp_folder = TemporaryDirectory()
 
     FILE_PATH = join(temp_folder.name, "{}.zip".format(item.get("id")))
 
-    with requests.get(zip_url, stream=True) as r:
-        r.raise_for_status()
-        with open(FILE_PATH, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-    with ZipFile(FILE_PATH, "r") as zip_file:
-        zip_file.extractall(temp_folder.name)
-
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    shp = driver.Open(join(temp_folder.name, "mi.shp"))
-    layer = shp.GetLayer()
-
-    sql_objects = []
-    for i in range(layer.GetFeatureCount()):
-        feature = layer.GetFeature(i)
-
-        try:
-            mmi = feature.GetField("PARAMVALUE")
-        except ValueError:
-            mmi = feature.GetField("VALUE")
-
-        geom = feature.GetGeometryRef()
-        geom_name = geom.GetGeometryName()
+    with metrics.stage("fetch_shakemap"):
+        with client.get(zip_url, stream=True) as r:
+            r.raise_for_status()
+            with open(FILE_PATH, "wb") as f:
+                for chunk in r.iter_content(chunk_size=8192):
+                    f.write(chunk)
+                    metrics.count("shakemap_bytes", len(chunk))
+
+    with metrics.stage("geometry"):
+        with ZipFile(FILE_PATH, "r") as zip_file:
+            zip_file.extractall(temp_folder.name)
+
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        shp = driver.Open(join(temp_folder.name, "mi.shp"))
+        layer = shp.GetLayer()
+
+        sql_objects = []
+        for i in range(layer.GetFeatureCount()):
+            feature = layer.GetFeature(i)
+
+            try:
+                mmi = feature.GetField("PARAMVALUE")
+            except ValueError:
+                mmi = feature.GetField("VALUE")
+
+            geom = feature.GetGeometryRef()
+            geom_name = geom.GetGeometryName()
+
+            if geom_name not in ("MULTIPOLYGON", "POLYGON"):
+                logging.warn(
+                    f"Geometry not supported: {geom_name}"
+                )
+                metrics.count("shakemap_geometries_skipped")
+                continue
 
-        if geom_name not in ("MULTIPOLYGON", "POLYGON"):
-            logging.warn(
-                f"Geometry not supported: {geom_name}"
+            # Split multipolygon into array of polygons.
+            geom_array = (
+                [geom] if geom_name == "POLYGON" else [g for g in geom]
             )
-            continue
-
-        # Split multipolygon into array of polygons.
-        geom_array = [geom] if geom_name == "POLYGON" else [g for g in geom]
-        for geom in geom_array:
-            sql_objects.append(
-                ShakeMap(
-                    eq_id=item.get("id"),
-                    mmi=mmi,
-                    shape=f"SRID=4326;{geom.ExportToWkt()}",
-                    time=item.get("time"),
-                    iso3=item.get("iso3")
+            for geom in geom_array:
+                sql_objects.append(
+                    ShakeMap(
+                        eq_id=item.get("id"),
+                        mmi=mmi,
+                        shape=f"SRID=4326;{geom.ExportToWkt()}",
+                        time=item.get("time"),
+                        iso3=item.get("iso3")
+                    )
                 )
-            )
 
-    session = Session()
-    session.add_all(sql_objects)
-    session.commit()
+    with metrics.stage("write"):
+        writer.write_objects(sql_objects)
+
+    metrics.count("shakemaps")
+    metrics.rows(ShakeMap.__tablename__, inserted=len(sql_objects))
 
     temp_folder.cleanup()
 
@@ -203,28 +221,56 @@ def fetch_country(country_dict):
         maxlatitude=maxlat,
     )
 
-    resp = requests.get(config.get("USGS", "API_URL"), params=params)
-    if resp.status_code != 200:
-        raise ValueError("could not fetch data from server.")
+    with metrics.stage("fetch"):
+        resp = client.get(config.get("USGS", "API_URL"), params=params)
+        if resp.status_code != 200:
+            raise ValueError("could not fetch data from server.")
 
-    features = resp.json().get("features")
+        features = resp.json().get("features")
 
     logging.info(f"Found {len(features)} features")
+    metrics.count("earthquakes", len(features))
 
+    # Shakemap downloads inside parse_feature keep their own stages.
     sql_objs = [parse_feature(f, country_dict.get("iso3")) for f in features]
 
-    session = Session()
-    session.add_all(sql_objs)
-    session.commit()
+    with metrics.stage("write"):
+        writer.write_objects(sql_objs)
+
+    metrics.rows(
+        config.get("DB", "EVENTS_TABLE_NAME"), inserted=len(sql_objs)
+    )
+
 
+def read_countries():
+    from osgeo import ogr
 
-def fetch_rss(countries):
+    with open(config.get("USGS", "COUNTRIES_FILE"), "r") as file:
+        return [
+            {**x, "geom": ogr.CreateGeometryFromWkt(x.get("bbox"))}
+            for x in DictReader(file)
+        ]
+
+
+def fetch_rss():
     logging.info("Fetching data from rss feed")
 
-    resp = requests.get(config.get("USGS", "FEED_URL"))
+    resp = client.get(config.get("USGS", "FEED_URL"), conditional=True)
+    resp.raise_for_status()
+
+    # Shakemaps of an unchanged feed were downloaded by a previous run.
+    if resp.from_cache:
+        logging.info("Feed unchanged")
+        return
 
     features = resp.json().get("features")
+    if len(features) == 0:
+        logging.info("No earthquakes in the feed")
+        return
+
+    from osgeo import ogr
 
+    countries = read_countries()
     features = [
         {**f, "geom": ogr.CreateGeometryFromJson(dumps(f.get("geometry")))}
         for f in features
@@ -239,10 +285,19 @@ def fetch_rss(countries):
         if len(filtered) == 0:
             continue
 
+        metrics.count("earthquakes", len(filtered))
+
         # Check that it is within the database.
         ids = [f.get("id") for f in filtered]
 
-        session.query(ShakeMap).filter(ShakeMap.eq_id.in_(ids)).delete()
+        with metrics.stage("write"):
+            deleted = (
+                session.query(ShakeMap)
+                .filter(ShakeMap.eq_id.in_(ids))
+                .delete(synchronize_session=False)
+            )
+            session.commit()
+        metrics.rows(ShakeMap.__tablename__, deleted=deleted)
 
         for feature in filtered:
             parse_feature(feature, country.get("iso3"))
@@ -258,20 +313,16 @@ def main():
     # Create tables.
     Base.metadata.create_all(engine)
 
-    # List all countries.
-    with open(config.get("USGS", "COUNTRIES_FILE"), "r") as file:
-        countries = [
-            {**x, "geom": ogr.CreateGeometryFromWkt(x.get("bbox"))}
-            for x in DictReader(file)
-        ]
-
     if options.rss is True:
-        fetch_rss(countries)
-        return
+        fetch_rss()
+    else:
+        for country_dict in read_countries():
+            fetch_country(country_dict)
 
-    for country_dict in countries:
-        fetch_country(country_dict)
+    writer.log_metrics()
+    client.stats.log()
 
 
 if __name__ == "__main__":
-    main()
+    with metrics.run():
+        main()
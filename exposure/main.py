@@ -0,0 +1,444 @@
+"""Markets and admin units exposed to cyclone buffers and shakemaps.
+
+    python run.py exposure -c config.txt
+
+Keeps wld_exposure_markets and wld_exposure_admin up to date with the
+spatial join of the hazard tables loaded by gdacs_tc and eq_historical
+against wld_markets from fetch_catalog and an admin boundaries table. Each
+run only joins the events with geometries added since the last one, and the
+markets added or moved since, so "markets in the red cone" is a lookup:
+
+    SELECT market_name FROM exposure.wld_exposure_markets
+    WHERE hazard = 'tc' AND event_id = '1000123' AND level = 'Red'
+"""
+import logging
+import sys
+import time
+
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from os.path import abspath, dirname
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    PrimaryKeyConstraint,
+    String,
+    Table,
+    text,
+)
+from sqlalchemy.schema import CreateSchema
+from sqlalchemy.exc import ProgrammingError
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import LazyEngine  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+
+logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+metrics = Metrics("exposure")
+
+# Seconds to wait for transactions still writing rows below a watermark.
+COMMIT_WAIT = 300
+
+# Columns of each hazard table, in the config [SOURCES] section. Polygons of
+# one event are replaced together, the levels of a shakemap are collapsed to
+# the highest MMI reaching each unit.
+HAZARDS = dict(
+    tc=dict(
+        option="BUFFERS",
+        event_column="event_id",
+        event="h.event_id::text",
+        level="h.label",
+        mmi="NULL::float",
+        time='h."timestamp"',
+    ),
+    eq=dict(
+        option="SHAKEMAPS",
+        event_column="eq_id",
+        event="h.eq_id",
+        level="'MMI'",
+        mmi="h.mmi",
+        time='h."time"',
+    ),
+)
+
+
+def exposure_columns(name, *unit_columns):
+    return [
+        Column("hazard", String, nullable=False),
+        Column("event_id", String, nullable=False),
+        Column("level", String, nullable=False),
+        Column("mmi", Float),
+        *unit_columns,
+        Column("event_time", DateTime),
+        Column("updated_at", DateTime, nullable=False),
+        PrimaryKeyConstraint(
+            "hazard", "event_id", "level", name, name=f"pk_exposure_{name}"
+        ),
+    ]
+
+
+def define_tables(metadata):
+    markets = Table(
+        "wld_exposure_markets",
+        metadata,
+        *exposure_columns(
+            "market_id",
+            Column("market_id", Integer, nullable=False),
+            Column("market_code", Integer),
+            Column("market_name", String),
+        ),
+    )
+    admin = Table(
+        "wld_exposure_admin",
+        metadata,
+        *exposure_columns(
+            "admin_id",
+            Column("admin_id", String, nullable=False),
+            Column("admin_name", String),
+        ),
+    )
+    watermarks = Table(
+        "wld_exposure_watermarks",
+        metadata,
+        Column("source", String, primary_key=True),
+        Column("last_id", Integer, nullable=False),
+        Column("updated_at", DateTime, nullable=False),
+    )
+
+    return markets, admin, watermarks
+
+
+class Exposure:
+    def __init__(self, config):
+        self.engine = LazyEngine(
+            config.get("DB", "URL"), application_name="exposure"
+        )
+        self.schema = config.get("DB", "SCHEMA", fallback="exposure")
+        self.metadata = MetaData(schema=self.schema)
+        self.markets, self.admin, self.watermarks = define_tables(
+            self.metadata
+        )
+
+        sources = config["SOURCES"]
+        self.sources = {
+            name: sources.get(hazard["option"])
+            for name, hazard in HAZARDS.items()
+            if sources.get(hazard["option"])
+        }
+        self.markets_source = sources.get("MARKETS")
+
+        # Optional admin boundaries, one polygon per unit.
+        self.admin_source = None
+        if config.has_section("ADMIN"):
+            admin = config["ADMIN"]
+            self.admin_source = admin.get("TABLE")
+            self.admin_id = admin.get("ID", "id")
+            self.admin_name = admin.get("NAME", "name")
+            self.admin_geom = admin.get("GEOM", "geom")
+
+    def setup(self):
+        try:
+            self.engine.execute(CreateSchema(self.schema))
+        except ProgrammingError:
+            pass
+        self.metadata.create_all(self.engine)
+
+        # wld_markets has no SRID, the joins use this expression so the
+        # planner can probe the markets by index for each hazard polygon.
+        name = self.markets_source.split(".")[-1]
+        self.engine.execute(
+            f"CREATE INDEX IF NOT EXISTS ix_{name}_geom_4326 "
+            f"ON {self.markets_source} USING GIST (ST_SetSRID(geom, 4326))"
+        )
+        if self.admin_source is not None:
+            name = self.admin_source.split(".")[-1]
+            self.engine.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_{name}_{self.admin_geom} "
+                f"ON {self.admin_source} USING GIST ({self.admin_geom})"
+            )
+
+    def get_watermark(self, conn, source):
+        """(last id, time of the run that set it)"""
+        row = conn.execute(
+            text(
+                f"SELECT last_id, updated_at FROM {self.watermarks.fullname} "
+                "WHERE source = :source"
+            ),
+            source=source,
+        ).first()
+
+        if row is None:
+            return 0, None
+
+        return row.last_id, row.updated_at
+
+    def set_watermark(self, conn, source, last_id):
+        conn.execute(
+            text(
+                f"INSERT INTO {self.watermarks.fullname} "
+                "(source, last_id, updated_at) VALUES (:source, :last_id, "
+                ":now) ON CONFLICT (source) DO UPDATE SET "
+                "last_id = EXCLUDED.last_id, updated_at = EXCLUDED.updated_at"
+            ),
+            source=source,
+            last_id=last_id,
+            now=self.now,
+        )
+
+    def get_max_id(self, conn, source):
+        """Highest id of source with every lower id committed, None when
+        writers do not finish in time.
+
+        Ids are drawn before commit, so a lower id can still be written by
+        a transaction running when max(id) is read. Any id drawn later is
+        higher, so once those transactions end the range is complete."""
+        high, snapshot = conn.execute(
+            f"SELECT max(id), txid_current_snapshot()::text FROM {source}"
+        ).first()
+
+        deadline = time.monotonic() + COMMIT_WAIT
+        while True:
+            running = conn.execute(
+                text(
+                    "SELECT count(*) FROM "
+                    "txid_snapshot_xip(CAST(:snapshot AS txid_snapshot)) x "
+                    "WHERE txid_status(x) = 'in progress'"
+                ),
+                snapshot=snapshot,
+            ).scalar()
+            if running == 0:
+                return high or 0
+
+            if time.monotonic() > deadline:
+                logging.warning(f"{source}: writers still running, skipped")
+                return None
+            time.sleep(1)
+
+    def targets(self):
+        """(table, unit key, unit columns, units table, join condition)"""
+        targets = [
+            (
+                self.markets,
+                "market_id",
+                "u.id, u.code, u.name",
+                self.markets_source,
+                "ST_Intersects(ST_SetSRID(u.geom, 4326), h.shape) "
+                "AND NOT coalesce(u.deleted, false)",
+            )
+        ]
+        if self.admin_source is not None:
+            targets.append(
+                (
+                    self.admin,
+                    "admin_id",
+                    f"u.{self.admin_id}::text, u.{self.admin_name}",
+                    self.admin_source,
+                    f"ST_Intersects(u.{self.admin_geom}, h.shape)",
+                )
+            )
+
+        return targets
+
+    def upsert(self, conn, target, name, where, **params):
+        """Insert or refresh the exposure rows of hazard name matching
+        where, returning how many were written."""
+        table, key, unit_columns, units, join = target
+        hazard = HAZARDS[name]
+        columns = [
+            c.name for c in table.columns if c.name not in ("updated_at",)
+        ]
+        column_list = ", ".join(f'"{c}"' for c in columns)
+        updates = ", ".join(
+            f'"{c}" = EXCLUDED."{c}"'
+            for c in columns + ["updated_at"]
+            if c not in ("hazard", "event_id", "level", key)
+        )
+
+        # One row per unit and level, the highest MMI when polygons of the
+        # same level overlap.
+        sql = f"""
+            INSERT INTO {table.fullname} ({column_list}, updated_at)
+            SELECT DISTINCT ON (event_id, level, {key}) {column_list}, :now
+            FROM (
+                SELECT
+                    :hazard AS hazard,
+                    {hazard['event']} AS event_id,
+                    {hazard['level']} AS level,
+                    {hazard['mmi']} AS mmi,
+                    {unit_columns},
+                    {hazard['time']} AS event_time
+                FROM {self.sources[name]} h
+                JOIN {units} u ON {join}
+                WHERE {where}
+            ) AS exposure ({column_list})
+            ORDER BY event_id, level, {key}, mmi DESC NULLS LAST
+            ON CONFLICT (hazard, event_id, level, {key})
+            DO UPDATE SET {updates}
+        """
+
+        return conn.execute(
+            text(sql), hazard=name, now=self.now, **params
+        ).rowcount
+
+    def update_hazard(self, name):
+        """Recompute the exposure of the events with new geometries."""
+        source = self.sources[name]
+        event_column = HAZARDS[name]["event_column"]
+
+        with self.engine.begin() as conn:
+            low, _ = self.get_watermark(conn, name)
+            high = self.get_max_id(conn, source)
+            if high is None:
+                return
+            if high <= low:
+                logging.info(f"{name}: no new geometries")
+                return
+
+            changed = (
+                f"SELECT DISTINCT {event_column} FROM {source} "
+                "WHERE id > :low AND id <= :high"
+            )
+            events = conn.execute(
+                text(f"SELECT count(*) FROM ({changed}) AS changed"),
+                low=low,
+                high=high,
+            ).scalar()
+            logging.info(f"{name}: {events} events with new geometries")
+            metrics.count(f"{name}_events", events)
+
+            for target in self.targets():
+                table = target[0]
+                written = self.upsert(
+                    conn,
+                    target,
+                    name,
+                    f"h.{event_column} IN ({changed})",
+                    low=low,
+                    high=high,
+                )
+
+                # Units no longer reached by the replaced geometries.
+                deleted = conn.execute(
+                    text(
+                        f"DELETE FROM {table.fullname} "
+                        "WHERE hazard = :hazard AND updated_at < :now "
+                        f"AND event_id IN (SELECT {HAZARDS[name]['event']} "
+                        f"FROM {source} h WHERE h.id > :low "
+                        "AND h.id <= :high)"
+                    ),
+                    hazard=name,
+                    now=self.now,
+                    low=low,
+                    high=high,
+                ).rowcount
+
+                metrics.rows(table.name, inserted=written, deleted=deleted)
+                logging.info(
+                    f"{table.name}: {written} rows written, {deleted} removed"
+                )
+
+            self.set_watermark(conn, name, high)
+
+    def update_markets(self):
+        """Drop the exposure of deleted markets and join the markets added
+        or moved since the last run with every hazard.
+
+        wld_markets ids come from the VAM API, not a sequence, so markets
+        are selected by the dates fetch_catalog sets instead of an id
+        watermark."""
+        target = self.targets()[0]
+        table = target[0]
+        markets = self.markets_source
+
+        with self.engine.begin() as conn:
+            deleted = conn.execute(
+                f"DELETE FROM {table.fullname} e USING {markets} m "
+                "WHERE e.market_id = m.id AND m.deleted IS TRUE"
+            ).rowcount
+            metrics.rows(table.name, deleted=deleted)
+            logging.info(f"Removed {deleted} rows of deleted markets")
+
+            # On the first run the hazards join every market.
+            _, last_run = self.get_watermark(conn, "markets")
+            if last_run is not None:
+                # created_at and last_updated are the date fetch_catalog
+                # started, a run going past midnight commits rows dated the
+                # day before. Markets of those days are joined again.
+                since = last_run.date() - timedelta(days=1)
+
+                moved = conn.execute(
+                    text(
+                        f"DELETE FROM {table.fullname} e USING {markets} u "
+                        "WHERE e.market_id = u.id "
+                        "AND u.last_updated >= :since"
+                    ),
+                    since=since,
+                ).rowcount
+                metrics.rows(table.name, deleted=moved)
+
+                for name in self.sources:
+                    written = self.upsert(
+                        conn,
+                        target,
+                        name,
+                        "(u.created_at >= :since OR u.last_updated >= :since)",
+                        since=since,
+                    )
+                    metrics.rows(table.name, inserted=written)
+                    logging.info(f"{name}: {written} rows of new markets")
+
+            # Only the time of the run is used.
+            self.set_watermark(conn, "markets", 0)
+
+    def reset(self):
+        with self.engine.begin() as conn:
+            for table in (self.markets, self.admin, self.watermarks):
+                conn.execute(f"TRUNCATE {table.fullname}")
+
+    def run(self, full=False):
+        self.now = datetime.now()
+
+        if full:
+            logging.info("Recomputing every event")
+            self.reset()
+
+        # Markets first, a hazard run already covers the markets it sees.
+        with metrics.stage("markets"):
+            self.update_markets()
+
+        for name in self.sources:
+            with metrics.stage(name):
+                self.update_hazard(name)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="config", default="config.txt")
+    parser.add_option(
+        "--full",
+        dest="full",
+        action="store_true",
+        default=False,
+        help="Drop the exposure tables and recompute every event",
+    )
+    options, _ = parser.parse_args()
+
+    config = ConfigParser()
+    if not config.read(options.config):
+        raise ValueError(f"Could not read {options.config}")
+
+    exposure = Exposure(config)
+    with metrics.stage("setup"):
+        exposure.setup()
+    exposure.run(options.full)
+
+
+if __name__ == "__main__":
+    with metrics.run():
+        main()
@@ -1,11 +1,13 @@
 import csv
+import hashlib
+import json
 import logging
-import requests
 import os
+import sys
+import threading
 
 from dotenv import load_dotenv
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
@@ -13,25 +15,52 @@ from sqlalchemy import (
     Boolean,
     ForeignKey,
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.schema import CreateSchema
+from sqlalchemy.sql import text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-from geoalchemy2 import Geometry, func
+from geoalchemy2 import Geometry
 from sqlalchemy.exc import ProgrammingError
 
-from datetime import date
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from optparse import OptionParser
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import BulkWriter, LazyEngine  # noqa: E402
+from common.http import HttpClient  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
 
 load_dotenv("config.env")
 
 API_URL = os.getenv("API_URL")
 DB_URL = os.getenv("DB_URL")
 DB_SCHEMA = os.getenv("DB_SCHEMA")
-
-engine = create_engine(DB_URL)
-Session = sessionmaker(bind=engine)
-session = Session()
+WORKERS = int(os.getenv("WORKERS", 8))
+RETRIES = int(os.getenv("RETRIES", 5))
+TIMEOUT = int(os.getenv("TIMEOUT", 60))
+
+PRICES_TABLE = "wld_market_prices"
+PRICES_START = os.getenv("PRICES_START", "2020-01")
+PRICES_LOOKBACK = int(os.getenv("PRICES_LOOKBACK", 1))
+PRICE_COLUMNS = [
+    "adm0code",
+    "market_id",
+    "commodity_id",
+    "commodity_name",
+    "price_type",
+    "unit",
+    "currency",
+    "price",
+    "price_date",
+]
+
+engine = LazyEngine(DB_URL, application_name="fetch_catalog")
+writer = BulkWriter(engine)
+metrics = Metrics("fetch_catalog")
+metrics.include(writer=writer)
 
 Base = declarative_base()
 
@@ -64,14 +93,32 @@ class MarketHistory(Base):
     action = Column(String, nullable=False)
 
 
-def get_token():
+class MarketSnapshot(Base):
+    __tablename__ = "wld_markets_snapshots"
+    __table_args__ = {"schema": DB_SCHEMA}
+
+    code = Column(Integer, primary_key=True, autoincrement=False)
+    fingerprint = Column(String, nullable=False)
+    market_hashes = Column(JSONB, nullable=False)
+    last_updated = Column(Date, nullable=False)
+
+
+class PriceWatermark(Base):
+    __tablename__ = "wld_market_prices_watermarks"
+    __table_args__ = {"schema": DB_SCHEMA}
+
+    adm0code = Column(Integer, primary_key=True, autoincrement=False)
+    last_month = Column(Date, nullable=False)
+
+
+def get_token(http):
     auth = (os.getenv("CONSUMER_KEY"), os.getenv("CONSUMER_SECRET"))
     data = dict(grant_type="client_credentials")
 
     token_url = f"{API_URL}/token"
     logging.info("Request for token")
 
-    resp = requests.post(token_url, data=data, auth=auth)
+    resp = http.post(token_url, data=data, auth=auth, retry=True)
     if resp.status_code != 200:
         raise ValueError("Invalid token response")
     response_json = resp.json()
@@ -81,140 +128,490 @@ def get_token():
     return response_json.get("access_token")
 
 
-def get_markets(params):
-    token, country = params
-    logging.info(f"Fetching markets for country {country['name']}")
+class DataBridgesClient:
+    """Pooled client shared by the fetching threads, refreshing the token
+    when the API answers 401."""
 
-    url = f"{API_URL}/vam-data-bridges/1.0.0/Markets/GeoJSONList"
+    def __init__(self, workers):
+        self.http = HttpClient(
+            timeout=TIMEOUT, retries=RETRIES, pool_size=workers
+        )
 
-    request_params = {
-        "url": url,
-        "headers": {"Authorization": f"Bearer {token}"},
-        "params": {"adm0code": country["code"]},
-    }
+        self.token = None
+        self.lock = threading.Lock()
 
-    resp = requests.get(**request_params)
-    if resp.status_code != 200:
-        return None
+    def refresh_token(self, stale_token=None):
+        with self.lock:
+            # Another thread already replaced the expired token.
+            if self.token is not None and self.token != stale_token:
+                return self.token
 
-    data = resp.json()
+            self.token = get_token(self.http)
+            return self.token
+
+    def request(self, token, path, params):
+        return self.http.get(
+            f"{API_URL}/vam-data-bridges/1.0.0/{path}",
+            headers={"Authorization": f"Bearer {token}"},
+            params=params,
+        )
+
+    def get(self, path, params):
+        token = self.token or self.refresh_token()
+
+        resp = self.request(token, path, params)
+        if resp.status_code == 401:
+            logging.info("Token expired")
+            resp = self.request(self.refresh_token(token), path, params)
+
+        resp.raise_for_status()
+
+        return resp.json()
+
+
+def get_markets(client, country):
+    logging.info(f"Fetching markets for country {country['name']}")
+
+    with metrics.stage("fetch"):
+        data = client.get(
+            "Markets/GeoJSONList", {"adm0code": country["code"]}
+        )
 
     # Parsing objects.
     markets = []
-    for market_dict in data.get("features"):
-        x, y = market_dict.get("geometry").get("coordinates")
-        name = market_dict.get("properties").get("name")
-        id = market_dict.get("id")
-
-        market = Market(
-            id=id,
-            name=name,
-            code=country["code"],
-            geom=f"POINT ({x} {y})",
-            created_at=RUN_DATE,
-        )
-        markets.append(market)
+    with metrics.stage("parse"):
+        for market_dict in data.get("features"):
+            x, y = market_dict.get("geometry").get("coordinates")
+            name = market_dict.get("properties").get("name")
+            id = market_dict.get("id")
+
+            markets.append(
+                (id, int(country["code"]), name, f"POINT ({x} {y})")
+            )
+
+    metrics.count("markets", len(markets))
 
     return markets
 
 
-def main():
-    try:
-        engine.execute(CreateSchema(DB_SCHEMA))
-    except ProgrammingError:
-        pass
+def market_hash(market):
+    id, _, name, wkt = market
+    return hashlib.sha1(f"{id}|{name}|{wkt}".encode("utf-8")).hexdigest()
 
-    # Create tables.
-    Base.metadata.create_all(engine)
 
-    token = get_token()
+def snapshot_fingerprint(hashes):
+    content = ";".join(f"{k}:{v}" for k, v in sorted(hashes.items()))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
 
-    # Read csv file
-    with open(os.getenv("ADMIN0_FILE"), "r") as f:
-        reader = csv.DictReader(f)
-        codes = [(token, r) for r in reader][:4]
-
-    with Pool() as p:
-        api_data = p.map(get_markets, codes)
-
-    api_data = [item for sublist in api_data for item in sublist]
-
-    add_markets = []
-    markets_history = []
-    for market in api_data:
-        # Check if elements are equal..if exists in db.
-        res = (
-            session.query(
-                Market,
-                func.st_equals(Market.geom, market.geom),
-                (Market.name == market.name),
-            )
-            .filter(Market.id == market.id)
-            .one_or_none()
+
+def get_snapshots(codes):
+    snapshots_table = MarketSnapshot.__table__.fullname
+    rows = engine.execute(
+        text(
+            "SELECT code, fingerprint, market_hashes "
+            f"FROM {snapshots_table} WHERE code = ANY(:codes)"
+        ),
+        dict(codes=codes),
+    )
+
+    return {r.code: r for r in rows}
+
+
+def reconcile(markets, codes, live_ids, snapshots):
+    """Apply the changed markets to the markets table in a few set based
+    statements. markets is a list of (id, code, name, wkt) tuples, codes the
+    countries that changed and live_ids every market id returned by the
+    API."""
+    markets_table = Market.__table__.fullname
+    history_table = MarketHistory.__table__.fullname
+    snapshots_table = MarketSnapshot.__table__.fullname
+
+    # One row per market id.
+    markets = list({m[0]: m for m in markets}.values())
+
+    params = dict(run_date=RUN_DATE, codes=codes, live_ids=live_ids)
+
+    with engine.begin() as conn:
+        conn.execute(
+            "CREATE TEMP TABLE markets_staging ("
+            "id integer PRIMARY KEY, code integer, name varchar, geom geometry"
+            ") ON COMMIT DROP"
+        )
+
+        writer.copy_rows(
+            "markets_staging", ["id", "code", "name", "geom"], markets, conn
+        )
+        conn.execute("ANALYZE markets_staging")
+
+        added = conn.execute(
+            text(
+                f"INSERT INTO {markets_table} "
+                "(id, code, name, geom, created_at) "
+                "SELECT s.id, s.code, s.name, s.geom, :run_date "
+                "FROM markets_staging s "
+                f"LEFT JOIN {markets_table} m ON m.id = s.id "
+                "WHERE m.id IS NULL"
+            ),
+            params,
+        ).rowcount
+        logging.info(f"Added {added} markets into the database")
+
+        # History has to be written before the rows are updated.
+        conn.execute(
+            text(
+                f"INSERT INTO {history_table} "
+                "(market_id, action_date, action) "
+                "SELECT m.id, :run_date, a.action "
+                f"FROM {markets_table} m "
+                "JOIN markets_staging s ON s.id = m.id "
+                "CROSS JOIN LATERAL (VALUES "
+                "('UPDATED_GEOM', NOT ST_Equals(m.geom, s.geom)), "
+                "('UPDATED_NAME', m.name <> s.name)"
+                ") AS a (action, changed) "
+                "WHERE a.changed"
+            ),
+            params,
+        )
+
+        updated = conn.execute(
+            text(
+                f"UPDATE {markets_table} m "
+                "SET geom = s.geom, name = s.name, last_updated = :run_date "
+                "FROM markets_staging s "
+                "WHERE m.id = s.id "
+                "AND (NOT ST_Equals(m.geom, s.geom) OR m.name <> s.name)"
+            ),
+            params,
+        ).rowcount
+        logging.info(f"Updated {updated} markets")
+
+        # Only countries present in the snapshot can have removed markets.
+        deleted = conn.execute(
+            text(
+                f"UPDATE {markets_table} m SET deleted = TRUE "
+                "WHERE m.code = ANY(:codes) "
+                "AND m.deleted IS NOT TRUE "
+                "AND m.id <> ALL(:live_ids)"
+            ),
+            params,
+        ).rowcount
+        logging.info(f"Marked {deleted} markets as deleted")
+        metrics.rows(
+            Market.__tablename__,
+            inserted=added,
+            updated=updated,
+            deleted=deleted,
+        )
+
+        conn.execute(
+            text(
+                f"INSERT INTO {snapshots_table} "
+                "(code, fingerprint, market_hashes, last_updated) "
+                "VALUES (:code, :fingerprint, "
+                "CAST(:market_hashes AS jsonb), :run_date) "
+                "ON CONFLICT (code) DO UPDATE SET "
+                "fingerprint = EXCLUDED.fingerprint, "
+                "market_hashes = EXCLUDED.market_hashes, "
+                "last_updated = EXCLUDED.last_updated"
+            ),
+            [
+                dict(
+                    code=code,
+                    fingerprint=fingerprint,
+                    market_hashes=json.dumps(hashes),
+                    run_date=RUN_DATE,
+                )
+                for code, fingerprint, hashes in snapshots
+            ],
         )
 
-        if res is None:
-            add_markets.append(market)
+
+def sync_markets(client, countries):
+    country_markets = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = {
+            executor.submit(get_markets, client, country): country
+            for country in countries
+        }
+
+        for future in as_completed(futures):
+            country = futures[future]
+            try:
+                country_markets[int(country["code"])] = future.result()
+            except Exception as e:
+                logging.error(f"Failed fetching {country['name']}: {e}")
+                failed.append(country["name"])
+
+    if len(failed) > 0:
+        logging.error(f"Countries not synced: {', '.join(failed)}")
+
+    stored = get_snapshots(list(country_markets.keys()))
+
+    changed_markets = []
+    snapshots = []
+    live_ids = []
+    for code, markets in country_markets.items():
+        live_ids.extend(m[0] for m in markets)
+
+        hashes = {str(m[0]): market_hash(m) for m in markets}
+        fingerprint = snapshot_fingerprint(hashes)
+
+        snapshot = stored.get(code)
+        if snapshot is not None and snapshot.fingerprint == fingerprint:
             continue
 
-        market_db, geom_equal, name_equal = res
-        update = False
-        if geom_equal is False:
-            history = MarketHistory(
-                action="UPDATED_GEOM",
-                market_id=market_db.id,
-                action_date=RUN_DATE,
-            )
-            markets_history.append(history)
+        # Only markets whose hash differs from the last snapshot.
+        previous = snapshot.market_hashes if snapshot is not None else {}
+        changed_markets.extend(
+            m for m in markets if previous.get(str(m[0])) != hashes[str(m[0])]
+        )
+        snapshots.append((code, fingerprint, hashes))
+
+    logging.info(
+        f"{len(snapshots)} of {len(country_markets)} countries changed, "
+        f"{len(changed_markets)} markets to compare"
+    )
+    if len(snapshots) == 0:
+        return
+
+    with metrics.stage("write"):
+        reconcile(
+            changed_markets, [s[0] for s in snapshots], live_ids, snapshots
+        )
+
 
-            market_db.geom = market.geom
-            update = True
+def next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
 
-        if name_equal is False:
-            history = MarketHistory(
-                action="UPDATED_NAME",
-                market_id=market_db.id,
-                action_date=RUN_DATE,
+
+def previous_month(day, months=1):
+    for _ in range(months):
+        day = (day.replace(day=1) - timedelta(days=1)).replace(day=1)
+    return day
+
+
+def create_price_partition(conn, month):
+    parent = f"{DB_SCHEMA}.{PRICES_TABLE}"
+    partition = f"{parent}_y{month.year}m{month.month:02d}"
+
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {parent} "
+        f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"
+    )
+
+
+def create_prices_table():
+    parent = f"{DB_SCHEMA}.{PRICES_TABLE}"
+
+    # Monthly range partitions, queries filtering on price_date only scan
+    # the months they need.
+    with engine.begin() as conn:
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {parent} ("
+            "adm0code integer NOT NULL, "
+            "market_id integer NOT NULL, "
+            "commodity_id integer NOT NULL, "
+            "commodity_name varchar, "
+            "price_type varchar, "
+            "unit varchar, "
+            "currency varchar, "
+            "price double precision, "
+            "price_date date NOT NULL"
+            ") PARTITION BY RANGE (price_date)"
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {PRICES_TABLE}_market_idx "
+            f"ON {parent} (adm0code, market_id, commodity_id)"
+        )
+
+
+def get_prices(client, country, month):
+    logging.info(f"Fetching prices for {country['name']} {month:%Y-%m}")
+
+    params = {
+        "adm0code": country["code"],
+        "startDate": month.isoformat(),
+        "endDate": (next_month(month) - timedelta(days=1)).isoformat(),
+        "page": 1,
+    }
+
+    start = month.isoformat()
+    end = next_month(month).isoformat()
+
+    prices = []
+    num_items = dropped = 0
+    while True:
+        with metrics.stage("fetch"):
+            data = client.get("MarketPrices/PriceMonthly", params)
+        items = data.get("items") or []
+        num_items += len(items)
+
+        for item in items:
+            # Rows outside the month have no partition to go to and would
+            # abort the COPY of the whole month.
+            price_date = (item.get("commodityPriceDate") or "")[:10]
+            if not start <= price_date < end:
+                dropped += 1
+                continue
+
+            prices.append(
+                (
+                    int(country["code"]),
+                    item.get("marketID"),
+                    item.get("commodityID"),
+                    item.get("commodityName"),
+                    item.get("priceTypeName"),
+                    item.get("commodityUnitName"),
+                    item.get("currencyName"),
+                    item.get("commodityPrice"),
+                    price_date,
+                )
             )
-            markets_history.append(history)
 
-            market_db.name = market.name
-            update = True
+        total = data.get("totalItems") or 0
+        if len(items) == 0 or num_items >= total:
+            break
+        params["page"] += 1
+
+    if dropped > 0:
+        logging.warning(
+            f"Dropped {dropped} prices of {country['name']} without a date "
+            f"in {month:%Y-%m}"
+        )
+        metrics.count("prices_dropped", dropped)
+
+    return prices
+
+
+def store_prices(code, month, prices):
+    parent = f"{DB_SCHEMA}.{PRICES_TABLE}"
+
+    # Replace the whole country month, reruns are idempotent.
+    with metrics.stage("write"), engine.begin() as conn:
+        create_price_partition(conn, month)
+        deleted = conn.execute(
+            text(
+                f"DELETE FROM {parent} WHERE adm0code = :code "
+                "AND price_date >= :start AND price_date < :end"
+            ),
+            dict(code=code, start=month, end=next_month(month)),
+        ).rowcount
+
+        inserted = writer.copy_rows(parent, PRICE_COLUMNS, prices, conn)
+
+    metrics.rows(PRICES_TABLE, inserted=inserted, deleted=deleted)
+
+
+def sync_prices(client, countries):
+    create_prices_table()
+
+    watermarks = {
+        w.adm0code: w.last_month
+        for w in engine.execute(PriceWatermark.__table__.select())
+    }
 
-        if update is True:
-            market_db.last_updated = RUN_DATE
-            session.add(market_db)
+    current_month = RUN_DATE.replace(day=1)
+    first_month = datetime.strptime(PRICES_START, "%Y-%m").date()
+
+    # Refresh from the last synced month, going back a few months to pick
+    # up late revisions.
+    tasks = []
+    for country in countries:
+        start = first_month
+        watermark = watermarks.get(int(country["code"]))
+        if watermark is not None:
+            start = max(previous_month(watermark, PRICES_LOOKBACK), start)
+
+        month = start
+        while month <= current_month:
+            tasks.append((country, month))
+            month = next_month(month)
+
+    logging.info(f"Fetching {len(tasks)} country months of prices")
+
+    fetched = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = {
+            executor.submit(get_prices, client, country, month): (
+                country,
+                month,
+            )
+            for country, month in tasks
+        }
+
+        for future in as_completed(futures):
+            country, month = futures[future]
+            code = int(country["code"])
+            try:
+                prices = future.result()
+                store_prices(code, month, prices)
+            except Exception as e:
+                logging.error(
+                    f"Failed prices for {country['name']} {month:%Y-%m}: {e}"
+                )
+                failed[code] = min(month, failed.get(code, month))
+                continue
+
+            fetched[code] = max(month, fetched.get(code, month))
+
+    # Never move a watermark past a month that failed.
+    rows = [
+        dict(adm0code=code, last_month=failed.get(code, month))
+        for code, month in fetched.items()
+    ]
+    if len(rows) == 0:
+        return
+
+    engine.execute(
+        text(
+            f"INSERT INTO {PriceWatermark.__table__.fullname} "
+            "(adm0code, last_month) VALUES (:adm0code, :last_month) "
+            "ON CONFLICT (adm0code) DO UPDATE "
+            "SET last_month = EXCLUDED.last_month"
+        ),
+        rows,
+    )
 
-    len_add_markets = len(add_markets)
-    if len_add_markets > 0:
-        session.add_all(add_markets)
-        session.flush()
 
-        # add_markets_history = [
-        #     MarketHistory(
-        #         action="CREATE", market_id=m.id, action_date=RUN_DATE
-        #     )
-        #     for m in add_markets
-        # ]
-        # markets_history.extend(add_markets_history)
+def main():
+    try:
+        engine.execute(CreateSchema(DB_SCHEMA))
+    except ProgrammingError:
+        pass
 
-        logging.info(f"Added {len_add_markets} markets into the database")
+    # Create tables.
+    Base.metadata.create_all(engine)
 
-    session.add_all(markets_history)
-    logging.info(f"Updated {len(markets_history)} markets")
+    # Read csv file
+    with open(os.getenv("ADMIN0_FILE"), "r") as f:
+        countries = [r for r in csv.DictReader(f)]
 
-    # Check elements that are needed to be removed.
-    markets = session.query(Market).all()
-    api_ids = [m.id for m in api_data]
+    client = DataBridgesClient(WORKERS)
+    metrics.include(client=client.http)
 
-    markets_delete = [m for m in markets if m.id not in api_ids]
-    for market in markets_delete:
-        market.deleted = True
-        session.add(market)
+    if options.prices is True:
+        sync_prices(client, countries)
+    else:
+        sync_markets(client, countries)
 
-    session.commit()
+    client.http.stats.log()
+    writer.log_metrics()
 
 
 if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+        "-p",
+        "--prices",
+        action="store_true",
+        dest="prices",
+        default=False,
+        help="Collect monthly market prices instead of markets",
+    )
+    options, _ = parser.parse_args()
+
     RUN_DATE = date.today()
-    main()
+    with metrics.run():
+        main()
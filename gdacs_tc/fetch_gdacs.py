@@ -1,12 +1,58 @@
-import requests
+import logging
+import os
+import sys
+import time
+
+from collections import defaultdict
+from configparser import ConfigParser
 from enum import Enum
-from os.path import basename
+from functools import partial
+from multiprocessing import Pool, Process, Queue
+from optparse import OptionParser
+from os.path import abspath, basename, dirname
+from queue import Empty, Full
 from urllib.parse import urljoin
-from lxml import html
 
 from dateutil import parser as dateparser
-
-GDACS_URL = "https://www.gdacs.org"
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    text,
+)
+from sqlalchemy.schema import CreateSchema
+from sqlalchemy.exc import ProgrammingError
+from geoalchemy2 import Geometry
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import BulkWriter, get_engine  # noqa: E402
+from common.http import default_client  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+from common.profiling import worker  # noqa: E402
+
+logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+client = default_client()
+metrics = Metrics("fetch_gdacs")
+metrics.include(client=client)
+
+REQUIRED_POLYGON_CLASSES = [
+    "Poly_Green",
+    "Poly_Orange",
+    "Poly_Red",
+    "Poly_Cones",
+]
+
+# Points after which older TC episodes are no longer crawled, 0 crawls all
+# of them to rebuild the full track as gdacs.py does.
+MIN_POINTS = 0
+
+# Columns shared by every row of an event, sent once per event.
+EVENT_COLUMNS = ["event_id", "episode_id", "event_name", "timestamp"]
 
 
 class EventType(Enum):
@@ -14,9 +60,70 @@ class EventType(Enum):
     EQ = "EQ"
 
 
-def list_events_paths(event_type):
-    events_list_url = urljoin(GDACS_URL, f"datareport/resources/{event_type}")
-    resp = requests.get(events_list_url)
+def event_columns():
+    return [
+        Column("id", Integer, primary_key=True),
+        Column("event_id", Integer, index=True),
+        Column("episode_id", String),
+        Column("event_name", String),
+        Column("timestamp", DateTime, nullable=False),
+    ]
+
+
+def define_tables(metadata):
+    """Tables of every event type, in the order of the row lists returned
+    by process_event. The TC tables are the ones gdacs.py writes."""
+    return {
+        EventType.TC: [
+            Table(
+                "wld_gdacs_tc_events_nodes",
+                metadata,
+                *event_columns(),
+                Column("wind_speed", Float, nullable=False),
+                Column("released_date", DateTime),
+                Column("shape", Geometry("POINT", 4326)),
+            ),
+            Table(
+                "wld_gdacs_tc_events_tracks",
+                metadata,
+                *event_columns(),
+                Column("shape", Geometry("LINESTRING", 4326)),
+            ),
+            Table(
+                "wld_gdacs_tc_events_buffers",
+                metadata,
+                *event_columns(),
+                Column("label", String, nullable=False),
+                Column("shape", Geometry("POLYGON", 4326)),
+            ),
+        ],
+        EventType.EQ: [
+            Table(
+                "wld_gdacs_eq_events",
+                metadata,
+                *event_columns(),
+                Column("magnitude", Float),
+                Column("alert_level", String),
+                Column("country", String),
+                Column("shape", Geometry("POINT", 4326)),
+            ),
+            Table(
+                "wld_gdacs_eq_polygons",
+                metadata,
+                *event_columns(),
+                Column("label", String),
+                Column("shape", Geometry("POLYGON", 4326)),
+            ),
+        ],
+    }
+
+
+def list_events_paths(base_url, event_type):
+    from lxml import html
+
+    events_list_url = urljoin(base_url, f"datareport/resources/{event_type}")
+    resp = client.get(events_list_url, conditional=True)
+    resp.raise_for_status()
 
     # Parse html to lxml object.
     tree = html.fromstring(resp.content.decode("utf-8"))
@@ -30,8 +137,11 @@ def list_events_paths(event_type):
     return events_urls
 
 
-def list_ordered_geojsons(path):
-    resp = requests.get(urljoin(GDACS_URL, path))
+def list_ordered_geojsons(base_url, path):
+    from lxml import html
+
+    resp = client.get(urljoin(base_url, path), conditional=True)
+    resp.raise_for_status()
     tree = html.fromstring(resp.content.decode("utf-8"))
     links = tree.body.find("pre").findall("a")
 
@@ -41,7 +151,7 @@ def list_ordered_geojsons(path):
         if link.attrib.get("href").endswith(".geojson")
     ]
 
-    links = [l for l in links if len(l.split("_")) == 3]
+    links = [l for l in links if len(basename(l).split("_")) == 3]
 
     links.sort(
         key=lambda f: int(basename(f).split("_")[-1].split(".")[0]),
@@ -51,11 +161,11 @@ def list_ordered_geojsons(path):
     return links
 
 
-def download_geojson_as_feature(path):
-    feature_collection = requests.get(urljoin(GDACS_URL, path)).json()
-    features = feature_collection.get("features")
+def download_geojson_as_feature(base_url, path):
+    resp = client.get(urljoin(base_url, path))
+    resp.raise_for_status()
 
-    return features
+    return resp.json().get("features") or []
 
 
 def filter_features(features, geometry_type):
@@ -64,82 +174,374 @@ def filter_features(features, geometry_type):
     ]
 
 
-def process_event(event_path):
-    print(f"Processing event {event_path}")
-    geojsons_paths = list_ordered_geojsons(event_path)
+def get_datetime(props):
+    # Latest of the date fields, todate before fromdate.
+    datetime_keys = [k for k in props.keys() if "date" in k]
+    datetime_keys.sort(reverse=True)
 
-    paths_iter = iter(geojsons_paths)
-    latest = next(paths_iter)
+    return dateparser.parse(props.get(datetime_keys[0]))
 
-    features = download_geojson_as_feature(latest)
 
-    geometry_types = ["Polygon", "LineString", "Point"]
-    geometries = {
-        k.lower(): filter_features(features, k) for k in geometry_types
-    }
+def point_wkt(feature):
+    x, y = feature.get("geometry").get("coordinates")[:2]
 
-    # Get additional points for previous episodes.
-    if len(geometries.get("point")) == 1:
-        for path in paths_iter:
-            features = download_geojson_as_feature(path)
-            point = next(
-                iter(filter_features(features, "Point")),
-                None,
-            )
-            if point is None:
-                continue
-            point["path"] = path
-            geometries.get("point").append(point)
+    return f"POINT ({x} {y})"
 
-    points_dict = []
-    for point in geometries.get("point"):
-        coords = point.get("geometry").get("coordinates")
-        props = point.get("properties")
 
-        # Validate dates.
-        datetime_keys = [k for k in props.keys() if "date" in k]
-        datetime_keys.sort(reverse=True)
+def polygons_wkt(feature):
+    """WKT of the polygons of feature, multipolygons split."""
+    from shapely.geometry import shape
+
+    geom = shape(feature.get("geometry"))
+    if geom.geom_type == "MultiPolygon":
+        return [g.wkt for g in geom.geoms]
+
+    return [geom.wkt]
+
+
+def get_event_fields(path, features, timestamp):
+    props = features[0].get("properties")
+    # geojson_<event>_<episode>.geojson of the latest episode.
+    episode_id = basename(path).split("_")[-1].split(".")[0]
+
+    return (
+        props.get("eventid"),
+        episode_id,
+        props.get("eventname") or props.get("name"),
+        timestamp,
+    )
+
 
+def parse_nodes(points):
+    nodes = {}
+    for point in points:
+        props = point.get("properties")
         try:
-            datetime_value = dateparser.parse(props.get(datetime_keys[0]))
-        except:
-            print("FAILLLLLL:", point, event_path)
+            released_date = get_datetime(props)
+        except (IndexError, TypeError, ValueError):
+            logging.warning(f"Point without date: {props.get('eventid')}")
             continue
 
-        fields = {
-            "timestamp": datetime_value,
-            "event_id": props.get("eventid"),
-            "event_name": props.get("eventname"),
-            "wind_speed": float(props.get("windspeed", 0.0)),
-            "shape": coords,
-        }
+        # Episodes repeat the points of the previous ones.
+        nodes[released_date] = (
+            float(props.get("windspeed", 0.0)),
+            released_date,
+            point_wkt(point),
+        )
 
-        points_dict.append(fields)
+    return nodes
 
-    if len(points_dict) == 0:
-        return
 
-    points_dict.sort(key=lambda x: x.get("timestamp"), reverse=True)
+def process_tc(base_url, path, min_points):
+    geojsons_paths = list_ordered_geojsons(base_url, path)
+    if len(geojsons_paths) == 0:
+        return None
 
-    # Update points.
-    fields = {
-        k: v
-        for k, v in points_dict[0].items()
-        if k in ["timestamp", "event_id", "event_name"]
-    }
-    processed_points = [
-        {**fields, "released_date": p.get("timestamp")} for p in points_dict
+    paths_iter = iter(geojsons_paths)
+    latest = next(paths_iter)
+    features = download_geojson_as_feature(base_url, latest)
+
+    points = filter_features(features, "Point")
+    nodes = parse_nodes(points)
+
+    # Older episodes only until the track has enough points.
+    for older in paths_iter:
+        if min_points and len(nodes) >= min_points:
+            break
+        older_points = filter_features(
+            download_geojson_as_feature(base_url, older), "Point"
+        )
+        for key, node in parse_nodes(older_points).items():
+            nodes.setdefault(key, node)
+
+    # A single point is not a track, discard it.
+    if len(nodes) < 2:
+        return None
+
+    # The event takes the date of its latest point.
+    fields = get_event_fields(latest, points, max(nodes))
+    nodes = [nodes[k] for k in sorted(nodes)]
+
+    tracks = [
+        (f"LINESTRING ({', '.join(' '.join(map(str, c)) for c in coords)})",)
+        for coords in (
+            [c[:2] for c in f.get("geometry").get("coordinates")]
+            for f in filter_features(features, "LineString")
+        )
+    ]
+    if len(tracks) == 0:
+        coords = ", ".join(n[2][7:-1] for n in nodes)
+        tracks = [(f"LINESTRING ({coords})",)]
+
+    buffers = [
+        (feature.get("properties").get("polygonlabel"), wkt)
+        for feature in filter_features(features, "Polygon")
+        if feature.get("properties").get("Class") in REQUIRED_POLYGON_CLASSES
+        for wkt in polygons_wkt(feature)
+    ]
+
+    return fields, (nodes, tracks, buffers)
+
+
+def process_eq(base_url, path):
+    geojsons_paths = list_ordered_geojsons(base_url, path)
+    if len(geojsons_paths) == 0:
+        return None
+
+    latest = geojsons_paths[0]
+    features = download_geojson_as_feature(base_url, latest)
+    points = filter_features(features, "Point")
+    if len(points) == 0:
+        return None
+
+    props = points[0].get("properties")
+    fields = get_event_fields(latest, points, get_datetime(props))
+    severity = props.get("severitydata") or {}
+    events = [
+        (
+            severity.get("severity"),
+            props.get("alertlevel"),
+            props.get("country"),
+            point_wkt(points[0]),
+        )
+    ]
+
+    polygons = [
+        (
+            feature.get("properties").get("polygonlabel")
+            or feature.get("properties").get("Class"),
+            wkt,
+        )
+        for geometry_type in ("Polygon", "MultiPolygon")
+        for feature in filter_features(features, geometry_type)
+        for wkt in polygons_wkt(feature)
     ]
 
-    #print([d.get("released_date").isoformat() for d in processed_points])
-    #return processed_points
+    return fields, (events, polygons)
+
+
+def process_event(base_url, min_points, task):
+    """Fetch and parse one event in a worker, returning (event type,
+    event fields, row lists) with the rows as tuples of the table columns
+    after EVENT_COLUMNS, or (event type, path, None) when skipped."""
+    event_type, path = task
+    try:
+        if event_type == EventType.TC:
+            result = process_tc(base_url, path, min_points)
+        else:
+            result = process_eq(base_url, path)
+    except Exception as e:
+        logging.error(f"Failed processing event {path}: {e}")
+        return event_type, path, None
+
+    if result is None:
+        logging.info(f"Discarding event {path}")
+        return event_type, path, None
+
+    return (event_type,) + result
+
+
+def write_batch(engine, writer, tables, batch):
+    """Replace the rows of the events in batch in a single transaction."""
+    counts = defaultdict(lambda: dict(inserted=0, deleted=0))
+    with engine.begin() as conn:
+        for event_type, events in batch.items():
+            ids = [fields[0] for fields, _ in events]
+            for n, table in enumerate(tables[event_type]):
+                deleted = conn.execute(
+                    text(
+                        f"DELETE FROM {table.fullname} "
+                        "WHERE event_id = ANY(:ids)"
+                    ),
+                    ids=ids,
+                ).rowcount
+
+                columns = [c.name for c in table.columns if c.name != "id"]
+                rows = (
+                    fields + row
+                    for fields, row_lists in events
+                    for row in row_lists[n]
+                )
+                inserted = writer.copy_rows(table, columns, rows, conn)
+
+                counts[table.name]["inserted"] += inserted
+                counts[table.name]["deleted"] += deleted
+
+    return counts
+
+
+def write_events(queue, summary, db_url, schema, batch_size):
+    """Writer process: batches events from queue into the database until
+    it receives None, then puts its row counts on summary."""
+    engine = get_engine(db_url, application_name="fetch_gdacs")
+    writer = BulkWriter(engine)
+
+    try:
+        engine.execute(CreateSchema(schema))
+    except ProgrammingError:
+        pass
+    metadata = MetaData(schema=schema)
+    tables = define_tables(metadata)
+    metadata.create_all(engine)
+
+    counts = defaultdict(lambda: dict(inserted=0, deleted=0))
+    batch = defaultdict(list)
+    num_rows = 0
+    while True:
+        item = queue.get()
+        if item is not None:
+            event_type, fields, row_lists = item
+            batch[event_type].append((fields, row_lists))
+            num_rows += sum(len(rows) for rows in row_lists)
+
+        if num_rows >= batch_size or (item is None and num_rows > 0):
+            for table, values in write_batch(
+                engine, writer, tables, batch
+            ).items():
+                for key, value in values.items():
+                    counts[table][key] += value
+            batch = defaultdict(list)
+            num_rows = 0
+
+        if item is None:
+            break
+
+    writer.log_metrics()
+    summary.put(dict(counts))
+
+
+def send(queue, process, item):
+    # Never block forever on a full queue if the writer died.
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Full:
+            if not process.is_alive():
+                raise RuntimeError("Writer process failed")
 
 
-event_type = EventType("TC")
-events_paths = list_events_paths(event_type.name)
+def receive(queue, process):
+    # Wait for the writer's result as long as it runs. It flushes the
+    # queue before exiting, so a clean exit leaves the result readable.
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if process.is_alive():
+                continue
 
-from multiprocessing import Pool
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(
+                f"Writer process failed with exit code {process.exitcode}"
+            )
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            raise RuntimeError("Writer process exited without a result")
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="config", default="config.txt")
+    parser.add_option(
+        "-t",
+        "--types",
+        dest="types",
+        default="TC,EQ",
+        help="Comma separated event types",
+    )
+    parser.add_option(
+        "-w",
+        "--workers",
+        dest="workers",
+        type="int",
+        default=os.cpu_count(),
+    )
+    parser.add_option(
+        "--min-points",
+        dest="min_points",
+        type="int",
+        default=MIN_POINTS,
+        help="Stop crawling older TC episodes once the track has this "
+        "many points, 0 (the default) crawls them all",
+    )
+    parser.add_option(
+        "--batch-size",
+        dest="batch_size",
+        type="int",
+        default=5000,
+        help="Rows written per transaction",
+    )
+    options, _ = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(options.config)
+
+    base_url = config.get("GDACS", "URL", fallback="https://www.gdacs.org")
+    db_url = "postgresql://{}:{}@{}:{}/{}".format(
+        config.get("PG", "USER"),
+        config.get("PG", "PW"),
+        config.get("PG", "HOST"),
+        config.get("PG", "PORT"),
+        config.get("PG", "NAME"),
+    )
+
+    tasks = []
+    with metrics.stage("list"):
+        for name in options.types.split(","):
+            event_type = EventType(name.strip())
+            paths = list_events_paths(base_url, event_type.value)
+            logging.info(f"Found {len(paths)} {event_type.value} events")
+            tasks.extend((event_type, path) for path in paths)
+
+    # Bounded, so workers running ahead of the database wait.
+    queue = Queue(maxsize=options.workers * 4)
+    summary = Queue()
+    writer = Process(
+        target=write_events,
+        args=(
+            queue,
+            summary,
+            db_url,
+            config.get("PG", "SCHEMA"),
+            options.batch_size,
+        ),
+        name="fetch_gdacs_writer",
+    )
+    writer.start()
+
+    start = time.perf_counter()
+    func = worker(partial(process_event, base_url, options.min_points))
+    with metrics.stage("crawl"), Pool(options.workers) as pool:
+        for event_type, fields, row_lists in pool.imap_unordered(
+            func, tasks
+        ):
+            if row_lists is None:
+                metrics.count(f"{event_type.value}_events_skipped")
+                continue
+            metrics.count(f"{event_type.value}_events")
+            send(queue, writer, (event_type, fields, row_lists))
+
+    send(queue, writer, None)
+    with metrics.stage("write"):
+        counts = receive(summary, writer)
+        writer.join()
+
+    for table, values in counts.items():
+        metrics.rows(table, **values)
+        logging.info(
+            f"{table}: {values['inserted']} rows written, "
+            f"{values['deleted']} replaced"
+        )
+    logging.info(
+        f"Processed {len(tasks)} events in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+    client.stats.log()
 
-with Pool() as p:
-    p.map(process_event, events_paths)
 
+if __name__ == "__main__":
+    with metrics.run():
+        main()
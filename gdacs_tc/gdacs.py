@@ -1,13 +1,12 @@
+import json
 import logging
-import requests
-from lxml import html, etree
-from shapely.geometry import shape, LineString
-from shapely.wkt import loads
-from os.path import basename
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import abspath, basename, dirname, exists, join
 from datetime import datetime
 
 from sqlalchemy import (
-    create_engine,
     Column,
     Float,
     Integer,
@@ -17,7 +16,6 @@ from sqlalchemy import (
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from geoalchemy2 import Geometry
-from geoalchemy2.shape import to_shape
 from sqlalchemy.schema import CreateSchema
 from sqlalchemy.exc import ProgrammingError
 from optparse import OptionParser
@@ -26,6 +24,11 @@ from dateutil import parser as dateparser
 
 from configparser import ConfigParser
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import BulkWriter, LazyEngine  # noqa: E402
+from common.http import default_client  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
 parser = OptionParser()
@@ -42,6 +45,12 @@ config = ConfigParser()
 config.read(options.config)
 
 GDACS_URL = config.get("GDACS", "URL")
+# Nodes of the previous episodes of every event, published episodes do not
+# change.
+CACHE_DIR = config.get(
+    "GDACS", "CACHE_DIR", fallback="/tmp/wfp_gdacs_episodes"
+)
+WORKERS = config.getint("GDACS", "WORKERS", fallback=8)
 
 DB_HOST = config.get("PG", "HOST")
 DB_USER = config.get("PG", "USER")
@@ -50,11 +59,16 @@ DB_NAME = config.get("PG", "NAME")
 DB_SCHEMA = config.get("PG", "SCHEMA")
 DB_PORT = config.get("PG", "PORT")
 
-engine = create_engine(
-    f"postgresql://{DB_USER}:{DB_PW}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+engine = LazyEngine(
+    f"postgresql://{DB_USER}:{DB_PW}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
+    application_name="gdacs_tc",
 )
 Session = sessionmaker(bind=engine)
 session = Session()
+writer = BulkWriter(engine)
+client = default_client()
+metrics = Metrics("gdacs_tc")
+metrics.include(client=client, writer=writer)
 
 Base = declarative_base()
 
@@ -106,7 +120,10 @@ class Track(Base):
 
 
 def get_html_response(url):
-    resp = requests.get(url)
+    from lxml import html
+
+    resp = client.get(url, conditional=True)
+    resp.raise_for_status()
     tree = html.fromstring(resp.content)
 
     return tree
@@ -165,6 +182,8 @@ def get_points(features):
 
 
 def get_nodes_and_fields(json_features):
+    from shapely.geometry import shape
+
     points = get_points(json_features)
 
     fields = None
@@ -204,6 +223,8 @@ def get_nodes_and_fields(json_features):
 
 
 def get_buffers(json_features, fields):
+    from shapely.geometry import shape
+
     buffers = []
     features = [
         f
@@ -231,6 +252,8 @@ def get_buffers(json_features, fields):
 
 
 def get_tracks(json_features, fields):
+    from shapely.geometry import shape
+
     features = [
         f
         for f in json_features
@@ -254,28 +277,114 @@ def get_tracks(json_features, fields):
     return tracks
 
 
-def get_missing_nodes(paths, fields):
+def read_episodes_cache(event_id):
+    path = join(CACHE_DIR, f"{event_id}.json")
+    if not exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_episodes_cache(event_id, episodes):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    path = join(CACHE_DIR, f"{event_id}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(episodes, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def fetch_episode_node(path):
+    """Node reported by a previous episode: its own point, or the latest
+    one when the points do not carry the episode."""
+    from shapely.geometry import shape
+
+    resp = client.get(f"{GDACS_URL}{path}")
+    resp.raise_for_status()
+    points = get_points(resp.json().get("features") or [])
+
+    episode = str(get_file_number(path))
+    node = None
+    for point in points:
+        props = point.get("properties")
+        try:
+            released_date = get_datetime(props)
+        except (TypeError, ValueError):
+            continue
+
+        if str(props.get("episodeid")) == episode:
+            node = (released_date, point)
+            break
+        if node is None or released_date > node[0]:
+            node = (released_date, point)
+
+    if node is None:
+        return None
+
+    released_date, point = node
+    return dict(
+        released_date=released_date.isoformat(),
+        wind_speed=float(point.get("properties").get("windspeed", 0.0)),
+        shape=shape(point.get("geometry")).wkt,
+    )
+
+
+def get_missing_nodes(event_id, paths, fields):
+    """One node per previous episode, deduplicated by date. Episodes
+    already seen come from the event cache, new ones are fetched in
+    parallel."""
+    episodes = read_episodes_cache(event_id)
+    new_paths = [p for p in paths if p not in episodes]
+    metrics.count("episodes_cached", len(paths) - len(new_paths))
+
+    if len(new_paths) > 0:
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            futures = {
+                executor.submit(fetch_episode_node, path): path
+                for path in new_paths
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    episodes[path] = future.result()
+                except Exception as e:
+                    # Not cached, fetched again by the next run.
+                    logging.error(f"Failed fetching episode {path}: {e}")
+                    metrics.count("episodes_failed")
+                    continue
+                metrics.count("episodes_fetched")
+
+        write_episodes_cache(event_id, episodes)
+
+    nodes = {}
+    for path in paths:
+        node = episodes.get(path)
+        if node is None:
+            continue
+        nodes.setdefault(dateparser.parse(node["released_date"]), node)
 
     missing_nodes = []
-    for event in paths:
-        resp = requests.get(f"{GDACS_URL}{event}").json()
-        points = get_points(resp.get("features"))
-
-        for point in points:
-            geom = shape(point.get("geometry")).wkt
-            fields_copy = fields.copy()
-            fields_copy["shape"] = f"SRID=4326; {geom}"
-            fields_copy["wind_speed"] = float(
-                point.get("properties").get("windspeed", 0.0)
-            )
+    for released_date in sorted(nodes):
+        node = nodes[released_date]
 
-            node = Node(**fields_copy)
-            missing_nodes.append(node)
+        fields_copy = fields.copy()
+        fields_copy.update(
+            {
+                "shape": f"SRID=4326; {node['shape']}",
+                "released_date": released_date,
+                "wind_speed": node["wind_speed"],
+            }
+        )
+        missing_nodes.append(Node(**fields_copy))
 
     return missing_nodes
 
 
 def create_track(nodes, fields):
+    from shapely.geometry import LineString
+    from shapely.wkt import loads
+
     wkt_points = [loads(n.shape.split(";")[1].strip()) for n in nodes]
     geom = LineString(wkt_points).wkt
     # geom = MultiLineString([track_linestring]).wkt
@@ -300,48 +409,71 @@ def process_tc(path):
     tc_event_id = path.split("/")[-2]
     logging.error(f"Processing event: {tc_event_id}")
 
-    ordered_paths = get_geojsons_paths(path)
+    with metrics.stage("fetch"):
+        ordered_paths = get_geojsons_paths(path)
 
-    # Get last result.
-    latest = requests.get(f"{GDACS_URL}{ordered_paths[-1]}").json()
+        # Get last result.
+        latest = client.get(f"{GDACS_URL}{ordered_paths[-1]}").json()
 
     features = latest.get("features")
     if len(features) == 0:
         logging.warning(f"Event without features: {tc_event_id}")
+        metrics.count("events_empty")
         return
 
-    nodes, fields = get_nodes_and_fields(features)
+    with metrics.stage("geometry"):
+        nodes, fields = get_nodes_and_fields(features)
+
     missing_nodes = []
     if len(nodes) == 1:
         logging.info(f"Collecting points from previous reports: {tc_event_id}")
-        missing_nodes = get_missing_nodes(ordered_paths[:-1], fields)
+        with metrics.stage("fetch_missing_nodes"):
+            missing_nodes = get_missing_nodes(
+                tc_event_id, ordered_paths[:-1], fields
+            )
 
-    nodes = missing_nodes + nodes
+    # The latest episode may repeat the date of a previous one.
+    dates = {n.released_date for n in nodes}
+    nodes = [n for n in missing_nodes if n.released_date not in dates] + nodes
 
     # TC event still has a single point, discard it.
     if len(nodes) == 1:
         logging.warning(f"Discarding event {tc_event_id}")
+        metrics.count("events_discarded")
         return
 
-    buffers = get_buffers(features, fields)
-    tracks = get_tracks(features, fields)
+    with metrics.stage("geometry"):
+        buffers = get_buffers(features, fields)
+        tracks = get_tracks(features, fields)
 
-    # Create Linestring from list of points.
-    if len(tracks) == 0:
-        logging.info(f"Creating track from points: {tc_event_id}")
-        tracks = create_track(nodes, fields)
+        # Create Linestring from list of points.
+        if len(tracks) == 0:
+            logging.info(f"Creating track from points: {tc_event_id}")
+            tracks = create_track(nodes, fields)
     rows = nodes + tracks + buffers
 
     logging.info(f"Save into database: {tc_event_id}")
 
-    session.add_all(rows)
-    session.commit()
+    with metrics.stage("write"):
+        writer.write_objects(rows)
+
+    metrics.count("events")
+    for model, objects in ((Node, nodes), (Track, tracks), (Buffer, buffers)):
+        metrics.rows(model.__tablename__, inserted=len(objects))
 
 
 def get_events_from_rss():
+    from lxml import etree
+
     rss_url = f"{GDACS_URL}/xml/rss.xml"
 
-    resp = requests.get(rss_url)
+    resp = client.get(rss_url, conditional=True)
+    resp.raise_for_status()
+
+    # Every event of an unchanged feed was processed by a previous run.
+    if resp.from_cache:
+        logging.info("Feed unchanged")
+        return []
 
     xml_obj = etree.fromstring(resp.content)
     channel = xml_obj.getchildren()[0]
@@ -363,6 +495,8 @@ def get_events_from_rss():
 
 
 def process_rss_event(event):
+    from geoalchemy2.shape import to_shape
+
     # Download file.
     event_id, episode_id = event
 
@@ -374,36 +508,59 @@ def process_rss_event(event):
         logging.info(
             f"Episode {episode_id} for event {event_id} already within the db"
         )
+        metrics.count("episodes_known")
         return
 
     event_url = f"{GDACS_URL}/datareport/resources/TC/{event_id}/geojson_{event_id}_{episode_id}.geojson"
     print(event_url)
 
-    resp = requests.get(event_url).json()
+    with metrics.stage("fetch"):
+        resp = client.get(event_url).json()
 
     features = resp.get("features")
-    session.query(Node).filter(Node.event_id == event_id).delete()
+    with metrics.stage("write"):
+        deleted = (
+            session.query(Node).filter(Node.event_id == event_id).delete()
+        )
 
-    nodes, fields = get_nodes_and_fields(features)
-    session.add_all(nodes)
-    session.commit()
+    with metrics.stage("geometry"):
+        nodes, fields = get_nodes_and_fields(features)
 
-    all_nodes = session.query(Node).filter(Node.event_id == event_id).all()
-    # Transform to wkt.
-    for node in all_nodes:
-        node.shape = f"SRID=4326; {to_shape(node.shape).wkt}"
+    with metrics.stage("write"):
+        writer.write_objects(nodes, session.connection())
+        session.commit()
+    metrics.rows(Node.__tablename__, inserted=len(nodes), deleted=deleted)
 
-    track = create_track(all_nodes, fields)
-    buffers = get_buffers(features, fields)
+    all_nodes = session.query(Node).filter(Node.event_id == event_id).all()
+    with metrics.stage("geometry"):
+        # Transform to wkt.
+        for node in all_nodes:
+            node.shape = f"SRID=4326; {to_shape(node.shape).wkt}"
+
+        track = create_track(all_nodes, fields)
+        buffers = get_buffers(features, fields)
+
+    with metrics.stage("write"):
+        # Delete previous track and buffer.
+        deleted_tracks = (
+            session.query(Track).filter(Track.event_id == event_id).delete()
+        )
 
-    # Delete previous track and buffer.
-    session.query(Track).filter(Track.event_id == event_id).delete()
+        deleted_buffers = (
+            session.query(Buffer).filter(Buffer.event_id == event_id).delete()
+        )
 
-    session.query(Buffer).filter(Buffer.event_id == event_id).delete()
+        writer.write_objects(track + buffers, session.connection())
 
-    session.add_all(track + buffers)
+        session.commit()
 
-    session.commit()
+    metrics.count("episodes")
+    metrics.rows(
+        Track.__tablename__, inserted=len(track), deleted=deleted_tracks
+    )
+    metrics.rows(
+        Buffer.__tablename__, inserted=len(buffers), deleted=deleted_buffers
+    )
 
 
 def update_database(events):
@@ -422,12 +579,16 @@ def main():
     Base.metadata.create_all(engine)
 
     if options.rss is True:
-        tc_events = get_events_from_rss()
+        with metrics.stage("fetch"):
+            tc_events = get_events_from_rss()
         update_database(tc_events)
+        writer.log_metrics()
+        client.stats.log()
         return
 
     dataset_url = f"{GDACS_URL}/datareport/resources/TC"
-    tc_paths = get_tc_paths(dataset_url)
+    with metrics.stage("fetch"):
+        tc_paths = get_tc_paths(dataset_url)
 
     for idx, path in enumerate(tc_paths):
         try:
@@ -435,6 +596,10 @@ def main():
         except Exception as e:
             logging.error(f"Failed processing path {path}")
             logging.error(e)
+            metrics.count("events_failed")
+
+    writer.log_metrics()
+    client.stats.log()
 
 
 if __name__ == "__main__":
@@ -443,4 +608,5 @@ if __name__ == "__main__":
     exit()
     """
 
-    main()
+    with metrics.run():
+        main()
@@ -0,0 +1,158 @@
+import logging
+import pickle
+import re
+
+import numpy as np
+import shapely
+
+from shapely import STRtree
+
+# OSM admin_level to the Nominatim address field it fills.
+LEVEL_FIELDS = {2: "country", 4: "state", 6: "county"}
+
+ISO_PATTERN = re.compile(r'"ISO3166-1(?::alpha2)?"=>"([A-Za-z]{2})"')
+
+
+def read_geopackage(path):
+    """Admin boundaries from a GeoPackage with name and admin_level fields,
+    e.g. the multipolygons layer of an ogr2ogr converted OSM extract."""
+    from osgeo import ogr
+
+    source = ogr.Open(path)
+    layer = source.GetLayerByName("multipolygons") or source.GetLayer(0)
+    definition = layer.GetLayerDefn()
+    fields = [
+        definition.GetFieldDefn(i).GetName()
+        for i in range(definition.GetFieldCount())
+    ]
+
+    for feature in layer:
+        level = feature.GetField("admin_level")
+        if level is None or not str(level).isdigit():
+            continue
+        if int(level) not in LEVEL_FIELDS:
+            continue
+
+        code = None
+        if "country_code" in fields:
+            code = feature.GetField("country_code")
+        elif "other_tags" in fields:
+            match = ISO_PATTERN.search(feature.GetField("other_tags") or "")
+            code = match.group(1) if match else None
+
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+
+        yield (
+            int(level),
+            feature.GetField("name"),
+            code,
+            bytes(geom.ExportToWkb()),
+        )
+
+
+def read_pbf(path):
+    """Admin boundaries assembled from the relations of an OSM PBF file."""
+    import osmium
+
+    class BoundaryHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.factory = osmium.geom.WKBFactory()
+            self.rows = []
+
+        def area(self, area):
+            if area.tags.get("boundary") != "administrative":
+                return
+
+            level = area.tags.get("admin_level")
+            if level is None or not level.isdigit():
+                return
+            if int(level) not in LEVEL_FIELDS:
+                return
+
+            try:
+                wkb = self.factory.create_multipolygon(area)
+            except RuntimeError:
+                return
+
+            self.rows.append(
+                (
+                    int(level),
+                    area.tags.get("name:en") or area.tags.get("name"),
+                    area.tags.get("ISO3166-1:alpha2"),
+                    bytes.fromhex(wkb),
+                )
+            )
+
+    handler = BoundaryHandler()
+    handler.apply_file(path, locations=True, idx="flex_mem")
+
+    return handler.rows
+
+
+class AdminIndex:
+    """STRtree over admin boundary polygons answering point in polygon
+    lookups for whole batches of points."""
+
+    def __init__(self, levels, names, codes, geometries):
+        self.levels = np.asarray(levels)
+        self.names = list(names)
+        self.codes = list(codes)
+        self.geometries = geometries
+        self.tree = STRtree(geometries)
+
+    @classmethod
+    def build(cls, source):
+        if source.endswith(".pbf"):
+            rows = read_pbf(source)
+        else:
+            rows = list(read_geopackage(source))
+
+        logging.info(f"Indexing {len(rows)} admin boundaries from {source}")
+
+        levels, names, codes, wkbs = zip(*rows)
+        geometries = shapely.from_wkb(np.array(wkbs, dtype=object))
+        shapely.prepare(geometries)
+
+        return cls(levels, names, codes, geometries)
+
+    def save(self, path):
+        data = dict(
+            levels=self.levels,
+            names=self.names,
+            codes=self.codes,
+            wkb=shapely.to_wkb(self.geometries),
+        )
+        with open(path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+
+        geometries = shapely.from_wkb(data["wkb"])
+        shapely.prepare(geometries)
+
+        return cls(data["levels"], data["names"], data["codes"], geometries)
+
+    def lookup(self, lats, lngs):
+        points = shapely.points(
+            np.asarray(lngs, dtype=float), np.asarray(lats, dtype=float)
+        )
+        point_idx, geom_idx = self.tree.query(points, predicate="within")
+
+        results = [{} for _ in range(len(points))]
+        for p, g in zip(point_idx.tolist(), geom_idx.tolist()):
+            field = LEVEL_FIELDS[int(self.levels[g])]
+            result = results[p]
+            if field in result:
+                continue
+
+            result[field] = self.names[g]
+            if field == "country" and self.codes[g]:
+                result["country_code"] = self.codes[g].lower()
+
+        return results
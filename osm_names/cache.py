@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import time
+
+
+class GeocodeCache:
+    """Reverse geocoding results stored in SQLite, keyed by coordinates
+    rounded to a fixed number of decimals."""
+
+    def __init__(self, path, precision=4, ttl_days=180):
+        self.precision = precision
+        self.ttl = ttl_days * 86400
+        self.pending = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS addresses ("
+            "lat TEXT NOT NULL, "
+            "lng TEXT NOT NULL, "
+            "address TEXT NOT NULL, "
+            "updated_at INTEGER NOT NULL, "
+            "PRIMARY KEY (lat, lng))"
+        )
+
+    def key(self, lat, lng):
+        return (
+            f"{float(lat):.{self.precision}f}",
+            f"{float(lng):.{self.precision}f}",
+        )
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT address FROM addresses "
+            "WHERE lat = ? AND lng = ? AND updated_at >= ?",
+            (*key, int(time.time()) - self.ttl),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def put(self, key, address):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO addresses (lat, lng, address, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (*key, json.dumps(address), int(time.time())),
+        )
+
+        self.pending += 1
+        if self.pending >= 100:
+            self.commit()
+
+    def invalidate(self, expired_only=True):
+        if expired_only:
+            cursor = self.conn.execute(
+                "DELETE FROM addresses WHERE updated_at < ?",
+                (int(time.time()) - self.ttl,),
+            )
+        else:
+            cursor = self.conn.execute("DELETE FROM addresses")
+
+        self.conn.commit()
+
+        return cursor.rowcount
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -1,13 +1,129 @@
+import asyncio
 import csv
+import logging
 import os
-import requests
+import random
+import sys
 
-from multiprocessing import Pool
+import aiohttp
 
+from argparse import ArgumentParser
+from os.path import abspath, dirname, exists, getsize
+from urllib.parse import urlsplit
 
-def get_data(item):
-    print(f"Processing city {item['city_name']}")
+from cache import GeocodeCache
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.http import AsyncHttpClient, HttpStatusError  # noqa: E402
+
+logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+ADDRESS_FIELDS = [
+    "village",
+    "neighbourhood",
+    "city",
+    "municipality",
+    "county",
+    "state_district",
+    "postcode",
+    "state",
+    "region",
+    "island",
+    "archipelago",
+    "country",
+    "country_code",
+    "continent",
+]
+
+NOMINATIM_URL = os.getenv(
+    "NOMINATIM_URL", "https://nominatim.openstreetmap.org/reverse"
+)
+USER_AGENT = os.getenv("USER_AGENT", "wfp_scripts/osm_names")
+
+DUMP_FILE = os.getenv("DUMP_FILE", "dump.csv")
+OUT_FILE = os.getenv("OUT_FILE", "out.csv")
+CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", f"{OUT_FILE}.done")
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10000))
+
+CACHE_FILE = os.getenv("CACHE_FILE", "cache.sqlite")
+CACHE_PRECISION = int(os.getenv("CACHE_PRECISION", 4))
+CACHE_TTL_DAYS = int(os.getenv("CACHE_TTL_DAYS", 180))
+
+ADMIN_INDEX = os.getenv("ADMIN_INDEX", "admin_index.pkl")
+REQUIRED_FIELDS = os.getenv("REQUIRED_FIELDS", "country,state,county")
+REQUIRED_FIELDS = REQUIRED_FIELDS.split(",")
+
+# Public Nominatim allows one request per second, a local instance can take
+# far more.
+RATE = float(os.getenv("RATE", 1))
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 1))
+RETRIES = int(os.getenv("RETRIES", 5))
+TIMEOUT = float(os.getenv("TIMEOUT", 30))
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that grows by one after a full window of successful
+    requests and halves whenever the server pushes back."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *args):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def success(self):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self.successes = 0
+
+    def backoff(self):
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+        logging.warning(f"Server pushing back, concurrency {self.limit}")
+
+
+class RetryableError(Exception):
+    def __init__(self, message, wait=None):
+        super().__init__(message)
+        self.wait = wait
+
+
+RETRY_ERRORS = (RetryableError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def request_address(http, limiter, params):
+    async with limiter:
+        resp = await http.get(NOMINATIM_URL, params=params)
+
+    if resp.status == 429 or resp.status >= 500:
+        limiter.backoff()
+        wait = resp.headers.get("Retry-After")
+        raise RetryableError(
+            f"HTTP {resp.status}",
+            float(wait) if wait and wait.isdigit() else None,
+        )
+
+    resp.raise_for_status()
+    limiter.success()
+
+    return resp.json().get("address", {})
+
+
+async def get_address(http, limiter, item):
+    """Address of the row coordinates, None when Nominatim could not be
+    reached."""
     params = {
         "addressdetails": 1,
         "accept-language": "en",
@@ -16,56 +132,259 @@ def get_data(item):
         "lat": item["lat"],
         "lon": item["lng"],
     }
-    resp = requests.get(NOMINATIM_URL, params=params)
 
-    resp_json = resp.json()
+    for attempt in range(RETRIES + 1):
+        try:
+            address = await request_address(http, limiter, params)
+        except HttpStatusError as e:
+            # Client errors will not get better with a retry.
+            logging.error(f"Failed city {item['objectid']}: {e.status}")
+            return None
+        except ValueError as e:
+            logging.error(f"Invalid response for city {item['objectid']}: {e}")
+            return None
+        except RETRY_ERRORS as e:
+            if attempt == RETRIES:
+                logging.error(f"Giving up city {item['objectid']}: {e}")
+                return None
+
+            wait = getattr(e, "wait", None)
+            if wait is None:
+                wait = min(60, 2 ** attempt) + random.random()
+            await asyncio.sleep(wait)
+            continue
+
+        return {field: address.get(field) for field in ADDRESS_FIELDS}
+
+
+class ResultWriter:
+    """Appends finished rows to OUT_FILE and their objectid to the
+    checkpoint file, so an interrupted run can pick up where it stopped."""
+
+    def __init__(self, path, checkpoint_path):
+        keys = ["objectid", "city_name"] + ADDRESS_FIELDS
+        new_file = not exists(path) or getsize(path) == 0
+
+        self.file = open(path, "a", newline="")
+        self.writer = csv.DictWriter(self.file, keys)
+        if new_file:
+            self.writer.writeheader()
+
+        self.checkpoint = open(checkpoint_path, "a")
+        self.count = 0
+
+    def write(self, out):
+        self.writer.writerow(out)
+        self.file.flush()
+
+        self.checkpoint.write(f"{out['objectid']}\n")
+        self.checkpoint.flush()
+
+        self.count += 1
+        if self.count % 1000 == 0:
+            logging.info(f"Written {self.count} rows")
 
-    address = resp_json["address"]
+    def close(self):
+        self.file.close()
+        self.checkpoint.close()
 
+
+def read_checkpoint(path):
+    if not exists(path):
+        return set()
+
+    with open(path, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def read_batches(path, done, size):
+    with open(path, "r") as f:
+        batch = []
+        for item in csv.DictReader(f):
+            if item["objectid"] in done:
+                continue
+
+            batch.append(item)
+            if len(batch) == size:
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            yield batch
+
+
+def get_out(item, address, admin_fields):
     out = {"objectid": item["objectid"], "city_name": item["city_name"]}
 
+    # Boundary index values win, Nominatim fills the rest.
+    address = {**(address or {}), **admin_fields}
     for field in ADDRESS_FIELDS:
         out[field] = address.get(field, None)
 
-    return address.keys()
+    return out
+
+
+async def geocode(batches, index, cache, writer):
+    limiter = AdaptiveLimiter(MAX_CONCURRENCY)
+    queue = asyncio.Queue(maxsize=MAX_CONCURRENCY * 4)
+
+    # Rows sharing a rounded location wait for the same request.
+    in_flight = {}
+    failed = []
+
+    async def resolve(http, item):
+        key = cache.key(item["lat"], item["lng"])
+
+        address = cache.get(key)
+        if address is not None:
+            return address
+
+        if key in in_flight:
+            return await in_flight[key]
+
+        future = asyncio.get_running_loop().create_future()
+        in_flight[key] = future
+        address = None
+        try:
+            address = await get_address(http, limiter, item)
+            if address is not None:
+                cache.put(key, address)
+        except Exception as e:
+            # Rows waiting on the same key must not hang, the row is
+            # retried on the next run.
+            logging.error(f"Failed city {item['objectid']}: {e}")
+        finally:
+            future.set_result(address)
+            del in_flight[key]
+
+        return address
+
+    async def worker(http):
+        while True:
+            task = await queue.get()
+            if task is None:
+                return
+
+            item, fields = task
+            address = await resolve(http, item)
+
+            # Unfinished rows stay out of the checkpoint and are retried
+            # on the next run.
+            if address is None:
+                failed.append(item["objectid"])
+                continue
+
+            writer.write(get_out(item, address, fields))
+
+    # Retries stay here, they also drive the adaptive limiter.
+    client = AsyncHttpClient(
+        timeout=TIMEOUT,
+        retries=0,
+        rates={urlsplit(NOMINATIM_URL).netloc: RATE},
+        pool_size=MAX_CONCURRENCY,
+        headers={"User-Agent": USER_AGENT},
+    )
+
+    async with client as http:
+        workers = [
+            asyncio.create_task(worker(http))
+            for _ in range(MAX_CONCURRENCY)
+        ]
+
+        for batch in batches:
+            admin_fields = [{} for _ in batch]
+            if index is not None:
+                admin_fields = index.lookup(
+                    [item["lat"] for item in batch],
+                    [item["lng"] for item in batch],
+                )
+
+            for item, fields in zip(batch, admin_fields):
+                if all(fields.get(f) for f in REQUIRED_FIELDS):
+                    writer.write(get_out(item, {}, fields))
+                    continue
+
+                await queue.put((item, fields))
+
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    client.stats.log()
+
+    return failed
 
 
 def main():
-    with open(DUMP_FILE, "r") as f:
-        reader = csv.DictReader(f)
+    parser = ArgumentParser(description="Reverse geocode dump.csv")
+    parser.add_argument(
+        "--invalidate",
+        choices=["expired", "all"],
+        help="Remove cached addresses before running",
+    )
+    parser.add_argument(
+        "--build-index",
+        metavar="SOURCE",
+        help="Build the admin boundary index from a .gpkg or .osm.pbf file",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Fill admin fields from the boundary index, Nominatim is only "
+        "asked for rows missing one of REQUIRED_FIELDS",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Discard OUT_FILE and the checkpoint instead of resuming",
+    )
+    args = parser.parse_args()
+
+    if args.build_index is not None:
+        from admin_index import AdminIndex
+
+        AdminIndex.build(args.build_index).save(ADMIN_INDEX)
+        logging.info(f"Saved admin index to {ADMIN_INDEX}")
+        return
+
+    cache = GeocodeCache(CACHE_FILE, CACHE_PRECISION, CACHE_TTL_DAYS)
+    if args.invalidate is not None:
+        removed = cache.invalidate(expired_only=args.invalidate == "expired")
+        logging.info(f"Removed {removed} cached addresses")
+
+    index = None
+    if args.offline is True:
+        from admin_index import AdminIndex
+
+        index = AdminIndex.load(ADMIN_INDEX)
+
+    if args.restart is True:
+        for path in (OUT_FILE, CHECKPOINT_FILE):
+            if exists(path):
+                os.remove(path)
 
-        data = [r for r in reader]
+    done = read_checkpoint(CHECKPOINT_FILE)
+    if len(done) > 0:
+        logging.info(f"Resuming, skipping {len(done)} finished rows")
 
-    with Pool() as p:
-        addresses = p.map(get_data, data)
+    writer = ResultWriter(OUT_FILE, CHECKPOINT_FILE)
+    try:
+        failed = asyncio.run(
+            geocode(
+                read_batches(DUMP_FILE, done, BATCH_SIZE),
+                index,
+                cache,
+                writer,
+            )
+        )
+    finally:
+        writer.close()
+        cache.close()
 
-    keys = addresses[0].keys()
-    with open(OUT_FILE, "w", newline="") as output_file:
-        dict_writer = csv.DictWriter(output_file, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(addresses)
+    logging.info(f"Written {writer.count} rows")
+    if len(failed) > 0:
+        logging.warning(f"{len(failed)} rows failed, rerun to retry them")
 
 
 if __name__ == "__main__":
-    ADDRESS_FIELDS = [
-        "village",
-        "neighbourhood",
-        "city",
-        "municipality",
-        "county",
-        "state_district",
-        "postcode",
-        "state",
-        "region",
-        "island",
-        "archipelago",
-        "country",
-        "country_code",
-        "continent",
-    ]
-
-    NOMINATIM_URL = "https://nominatim.openstreetmap.org/reverse"
-
-    DUMP_FILE = os.getenv("DUMP_FILE", "dump.csv")
-    OUT_FILE = os.getenv("OUT_FILE", "out.csv")
     main()
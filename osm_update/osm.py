@@ -1,27 +1,29 @@
+import os
 import osmium
-from sqlalchemy import create_engine, Column, Float, BigInteger, String
+import sys
+
+from sqlalchemy import Column, Float, BigInteger, String
 
 from sqlalchemy.dialects.postgresql import HSTORE, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import CreateSchema
 from sqlalchemy.exc import ProgrammingError
 
 from argparse import ArgumentParser
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import BulkWriter, LazyEngine  # noqa: E402
 
 DB_SCHEMA = "example"
+DB_URL = os.getenv("DB_URL", "postgresql://mj:mj@localhost:5432/osm_countries")
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10000))
 
-engine = create_engine("postgresql://mj:mj@localhost:5432/osm_countries")
-Session = sessionmaker(bind=engine)
-session = Session()
+engine = LazyEngine(DB_URL, application_name="osm_update")
+writer = BulkWriter(engine)
 
 Base = declarative_base()
 
-import psycopg2
-
-conn = psycopg2.connect("postgresql://mj:mj@localhost:5432/osm_countries")
-cur = conn.cursor()
-
 
 class Node(Base):
     __tablename__ = "osm_nodes"
@@ -56,72 +58,80 @@ def populate_database(osm_file):
     h = PopulateHandler()
 
     h.apply_file(osm_file)
+    h.flush()
+
+    writer.log_metrics()
 
 
 class PopulateHandler(osmium.SimpleHandler):
     def __init__(self):
         osmium.SimpleHandler.__init__(self)
+        self.rows = {Node: [], Way: [], Relation: []}
 
-    @staticmethod
-    def to_hstore_str(tags):
-        values = list()
-        for k, v in dict(tags).items():
-            value = v.replace('"', '\\"').replace("'", "''")
-            values.append(f'"{k}" => "{value}"')
+    def add(self, model, row):
+        rows = self.rows[model]
+        rows.append(row)
 
-        tags = ",".join(values)
-        tags = f"'{tags}'::hstore"
+        if len(rows) >= BATCH_SIZE:
+            self.flush_model(model)
 
-        return tags
+    def flush_model(self, model):
+        rows = self.rows[model]
+        if len(rows) == 0:
+            return
 
-    def node(self, elm):
-        items = dict(id=elm.id, user=elm.user, lat=elm.location.lat, lng=elm.location.lon, tags=PopulateHandler.to_hstore_str(elm.tags))
-        query = "INSERT INTO example.osm_nodes(osm_id, username, lat, lon, tags) VALUES ({id},'{user}',{lat},{lng},{tags})".format(**items)
+        columns = [c.name for c in model.__table__.columns]
+        writer.copy_rows(model.__table__, columns, rows)
+        self.rows[model] = []
 
-        cur.execute(query)
-        conn.commit()
+    def flush(self):
+        for model in self.rows:
+            self.flush_model(model)
 
-    def way(self, elm):
-        node_refs = ",".join([str(n.ref) for n in elm.nodes])
-        node_refs = f"ARRAY[{node_refs}]"
+    def node(self, elm):
+        self.add(
+            Node,
+            (
+                elm.id,
+                elm.user,
+                elm.location.lat,
+                elm.location.lon,
+                dict(elm.tags),
+            ),
+        )
 
-        items = dict(id=elm.id, user=elm.user, node_refs=node_refs, tags=PopulateHandler.to_hstore_str(elm.tags))
-        query = "INSERT INTO example.osm_ways(osm_id, username, node_refs, tags) VALUES ({id},'{user}',{node_refs},{tags})".format(**items)
+    def way(self, elm):
+        node_refs = [n.ref for n in elm.nodes]
 
-        cur.execute(query)
-        conn.commit()
+        self.add(Way, (elm.id, elm.user, node_refs, dict(elm.tags)))
 
     def relation(self, elm):
-        members_dict = [{'ref': e.ref, 'type': e.type, 'role': e.role} for e in elm.members]
-        members_dict = [",".join([f'"{k}" => "{v}"' for k,v in m.items()]) for m in members_dict]
+        members = [
+            {"ref": m.ref, "type": m.type, "role": m.role}
+            for m in elm.members
+        ]
 
-        members_dict = ",".join([f"'{m}'::hstore" for m in members_dict])
+        self.add(Relation, (elm.id, elm.user, members, dict(elm.tags)))
 
-        members = f"ARRAY[{members_dict}]"
-        tags = PopulateHandler.to_hstore_str(elm.tags)
 
-        items = dict(id=elm.id, user=elm.user, tags=tags, members=members)
-        query = "INSERT INTO example.osm_relations(osm_id, username, members, tags) VALUES ({id},'{user}',{members},{tags})".format(**items)
-
-        cur.execute(query)
-        conn.commit()
+def main():
+    parser = ArgumentParser(description="Process osm files into database")
+    parser.add_argument("-p", "--populate", default=False, action="store_true")
+    parser.add_argument("osm_file", type=str)
 
+    args = parser.parse_args()
 
-def main():
     # Database check.
     try:
         engine.execute(CreateSchema(DB_SCHEMA))
     except ProgrammingError:
         pass
 
+    engine.execute("CREATE EXTENSION IF NOT EXISTS hstore")
+
     # Create tables.
     Base.metadata.create_all(engine)
 
-    parser = ArgumentParser(description="Process osm files into database")
-    parser.add_argument("-p", "--populate", default=False, action="store_true")
-    parser.add_argument("osm_file", type=str)
-
-    args = parser.parse_args()
     if args.populate is True:
         populate_database(args.osm_file)
 
@@ -0,0 +1,124 @@
+"""Single entry point for the scripts.
+
+    python run.py [--profile] <command> [script options]
+
+Commands are only imported when run, so listing them or starting one never
+pays for the dependencies of the others. Each script runs from its own
+folder, as its default config paths expect.
+
+--profile writes cProfile stats, a collapsed stack file and tracemalloc
+peaks per stage to WFP_PROFILE_DIR, by default a new folder under
+$WFP_METRICS_DIR/profile.
+"""
+import os
+import runpy
+import sys
+
+from datetime import datetime
+from os.path import abspath, dirname, join
+
+ROOT = dirname(abspath(__file__))
+
+COMMANDS = {
+    "acled": ("acled/main.py", "ACLED events by country to ArcGIS Online"),
+    "acled2": ("acled2/main.py", "Incremental ACLED events to ArcGIS Online"),
+    "countries-fetch": (
+        "countries_fetch/test_login.py",
+        "Geofabrik country extracts",
+    ),
+    "eq-historical": (
+        "eq_historical/main.py",
+        "USGS earthquakes and shakemaps",
+    ),
+    "exposure": (
+        "exposure/main.py",
+        "Markets and admin units in hazard areas",
+    ),
+    "fetch-catalog": (
+        "fetch_catalog/main.py",
+        "DataBridges markets and prices",
+    ),
+    "fetch-gdacs": (
+        "gdacs_tc/fetch_gdacs.py",
+        "GDACS cyclones and earthquakes",
+    ),
+    "gdacs": ("gdacs_tc/gdacs.py", "GDACS tropical cyclones"),
+    "osm-names": ("osm_names/main.py", "Reverse geocode city names"),
+    "osm-update": ("osm_update/osm.py", "OSM extract into PostgreSQL"),
+    "scheduler": ("scheduler.py", "Run the feeds on intervals"),
+    "tiles": ("tiles/main.py", "Vector tiles of the hazard layers"),
+    "travel-spreadsheet": (
+        "travel_spreadsheet/main.py",
+        "Travel restrictions sheet to ArcGIS Online",
+    ),
+    "ts-historical": ("ts_historical/main.py", "IBTrACS storm tracks"),
+}
+
+
+def usage():
+    print("usage: python run.py [--profile] <command> [script options]")
+    print("\ncommands:")
+    for name, (_, description) in sorted(COMMANDS.items()):
+        print(f"  {name:<20}{description}")
+
+
+def run(command, args):
+    path = join(ROOT, COMMANDS[command][0])
+    folder = dirname(path)
+
+    # Scripts import their sibling modules (acled/store.py,
+    # osm_names/cache.py) and read configs relative to their folder.
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+    sys.argv = [path] + list(args)
+
+    runpy.run_path(path, run_name="__main__")
+
+
+def run_profiled(command, args):
+    from common.metrics import METRICS_DIR
+    from common.profiling import Profiler
+
+    directory = os.getenv("WFP_PROFILE_DIR") or join(
+        METRICS_DIR,
+        "profile",
+        f"{command}-{datetime.now():%Y%m%d-%H%M%S}",
+    )
+    # Worker processes profile themselves into the same folder.
+    directory = abspath(directory)
+    os.environ["WFP_PROFILE_DIR"] = directory
+
+    profiler = Profiler(directory, command)
+    profiler.start()
+    try:
+        run(command, args)
+    finally:
+        profiler.stop()
+        profiler.dump()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    profile = len(argv) > 0 and argv[0] == "--profile"
+    if profile:
+        argv = argv[1:]
+
+    if len(argv) == 0 or argv[0] in ("-h", "--help"):
+        usage()
+        return
+
+    command, args = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"Unknown command: {command}\n", file=sys.stderr)
+        usage()
+        sys.exit(2)
+
+    if profile:
+        run_profiled(command, args)
+    else:
+        run(command, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""Long running scheduler for the feeds.
+
+    python run.py scheduler -c scheduler.txt
+
+Every section of the config other than [scheduler] is a job running a
+run.py command on an interval, see scheduler.txt.sample. Jobs are forked
+from a server process that has already imported the shared dependencies,
+so a run pays neither the interpreter start nor the imports, while each
+job keeps its own working directory, environment and arguments. Runs are
+limited by a global budget, a budget per upstream and a budget of jobs
+using the database, never overlap (a PostgreSQL advisory lock also keeps
+other schedulers on the same database out, runs started outside a
+scheduler do not take it) and are recorded in a history table.
+"""
+import logging
+import multiprocessing
+import os
+import shlex
+import signal
+import sys
+import threading
+import time
+
+from configparser import ConfigParser
+from datetime import datetime
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    text,
+)
+from sqlalchemy.schema import CreateSchema
+from sqlalchemy.exc import ProgrammingError
+
+ROOT = dirname(abspath(__file__))
+sys.path.append(ROOT)
+
+from common.db import LazyEngine  # noqa: E402
+from common.http import parse_rates  # noqa: E402
+
+logger = logging.getLogger()
+
+# Imported once by the fork server and shared by every job.
+PRELOAD = [
+    "sqlalchemy",
+    "sqlalchemy.ext.declarative",
+    "sqlalchemy.orm",
+    "geoalchemy2",
+    "psycopg2",
+    "requests",
+    "dateutil.parser",
+    "dotenv",
+    "lxml.html",
+    "lxml.etree",
+    "shapely.geometry",
+    "common.db",
+    "common.http",
+    "common.metrics",
+]
+
+TICK = 1
+
+
+class Job:
+    def __init__(self, name, section):
+        self.name = name
+        self.command = section.get("COMMAND")
+        self.args = shlex.split(section.get("ARGS", ""))
+        self.interval = section.getint("INTERVAL")
+        self.timeout = section.getint("TIMEOUT", fallback=None)
+        self.upstreams = split(section.get("UPSTREAM", ""))
+        self.database = section.getboolean("DATABASE", fallback=True)
+        self.depends = split(section.get("DEPENDS", ""))
+
+        self.next_run = 0
+        self.running = False
+        self.last_status = None
+
+
+def split(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def create_history_table(metadata):
+    return Table(
+        "scheduler_runs",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("job", String, nullable=False, index=True),
+        Column("command", String, nullable=False),
+        Column("started_at", DateTime, nullable=False),
+        Column("finished_at", DateTime),
+        Column("seconds", Float),
+        Column("status", String, nullable=False),
+        Column("exit_code", Integer),
+        Column("log_path", String),
+    )
+
+
+def run_job(command, args, env, log_path):
+    """Body of a job process: run.py's run with the output in log_path."""
+    log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.environ.update(env)
+
+    from run import run
+
+    run(command, args)
+
+
+class Scheduler:
+    def __init__(self, config, names=None):
+        settings = config["scheduler"]
+
+        self.engine = LazyEngine(
+            settings.get("DB_URL"), application_name="wfp_scheduler"
+        )
+        self.schema = settings.get("SCHEMA", "scheduler")
+        self.history = create_history_table(MetaData(schema=self.schema))
+
+        self.log_dir = settings.get("LOG_DIR", "/tmp/wfp_scheduler")
+        self.pool_size = settings.get("POOL_SIZE", "2")
+
+        self.slots = threading.BoundedSemaphore(
+            settings.getint("MAX_JOBS", 4)
+        )
+        self.db_slots = threading.BoundedSemaphore(
+            settings.getint("DB_JOBS", 2)
+        )
+        budgets = parse_rates(settings.get("UPSTREAMS", ""))
+
+        self.jobs = {
+            name: Job(name, config[name])
+            for name in config.sections()
+            if name != "scheduler"
+        }
+        for job in self.jobs.values():
+            for name in job.depends:
+                if name not in self.jobs:
+                    raise ValueError(f"{job.name} depends on unknown {name}")
+
+        if names is not None:
+            self.jobs = {n: j for n, j in self.jobs.items() if n in names}
+            for job in self.jobs.values():
+                job.depends = [d for d in job.depends if d in self.jobs]
+
+        self.upstream_slots = {
+            name: threading.BoundedSemaphore(int(budgets.get(name, 1)))
+            for job in self.jobs.values()
+            for name in job.upstreams
+        }
+
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(PRELOAD)
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def setup(self):
+        try:
+            self.engine.execute(CreateSchema(self.schema))
+        except ProgrammingError:
+            pass
+        self.history.metadata.create_all(self.engine)
+
+        # Runs left as running by a killed scheduler.
+        table = self.history
+        self.engine.execute(
+            table.update()
+            .where(table.c.status == "running")
+            .values(status="interrupted")
+        )
+
+        # Restarts keep the schedule instead of running everything at once.
+        rows = self.engine.execute(
+            text(
+                "SELECT DISTINCT ON (job) job, started_at, status "
+                f"FROM {table.fullname} "
+                "WHERE status NOT IN ('locked', 'blocked') "
+                "ORDER BY job, started_at DESC"
+            )
+        )
+        for row in rows:
+            job = self.jobs.get(row.job)
+            if job is None:
+                continue
+            job.last_status = row.status
+            job.next_run = row.started_at.timestamp() + job.interval
+
+    def is_blocked(self, job):
+        """None when job can start, otherwise why it has to wait."""
+        for name in job.depends:
+            dependency = self.jobs[name]
+            if dependency.running:
+                return "waiting"
+            if dependency.last_status not in (None, "success"):
+                return "blocked"
+
+        return None
+
+    def record_start(self, job, log_path, status="running"):
+        return self.engine.execute(
+            self.history.insert().values(
+                job=job.name,
+                command=" ".join([job.command] + job.args),
+                started_at=datetime.now(),
+                status=status,
+                log_path=log_path,
+            )
+        ).inserted_primary_key[0]
+
+    def record_end(self, run_id, status, exit_code, seconds):
+        self.engine.execute(
+            self.history.update()
+            .where(self.history.c.id == run_id)
+            .values(
+                finished_at=datetime.now(),
+                seconds=round(seconds, 3),
+                status=status,
+                exit_code=exit_code,
+            )
+        )
+
+    def acquire(self, job):
+        """Take the budgets of job, always in the same order so jobs
+        waiting for each other's slots cannot deadlock."""
+        semaphores = [self.slots]
+        semaphores += [self.upstream_slots[u] for u in sorted(job.upstreams)]
+        if job.database:
+            semaphores.append(self.db_slots)
+
+        for semaphore in semaphores:
+            semaphore.acquire()
+
+        return semaphores
+
+    def execute(self, job):
+        semaphores = self.acquire(job)
+        try:
+            self.run_locked(job)
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+            with self.lock:
+                job.running = False
+
+    def run_locked(self, job):
+        stamp = f"{datetime.now():%Y%m%d-%H%M%S}"
+        log_path = join(self.log_dir, f"{job.name}-{stamp}.log")
+
+        with self.engine.connect() as conn:
+            locked = conn.execute(
+                text("SELECT pg_try_advisory_lock(hashtext(:key))"),
+                key=f"wfp_scheduler:{job.name}",
+            ).scalar()
+            if not locked:
+                logger.warning(f"{job.name} is running elsewhere, skipped")
+                self.record_start(job, None, status="locked")
+                return
+
+            try:
+                status, exit_code, seconds = self.run_process(job, log_path)
+            finally:
+                conn.execute(
+                    text("SELECT pg_advisory_unlock(hashtext(:key))"),
+                    key=f"wfp_scheduler:{job.name}",
+                )
+
+        with self.lock:
+            job.last_status = status
+
+    def run_process(self, job, log_path):
+        run_id = self.record_start(job, log_path)
+        logger.info(f"Starting {job.name}, log in {log_path}")
+
+        env = {}
+        if job.database:
+            # Jobs share the database through the DB_JOBS budget, each
+            # with a small pool.
+            env["WFP_DB_POOL_SIZE"] = self.pool_size
+            env["WFP_DB_MAX_OVERFLOW"] = "0"
+
+        start = time.perf_counter()
+        process = self.context.Process(
+            target=run_job,
+            args=(job.command, job.args, env, log_path),
+            name=job.name,
+        )
+        process.start()
+        process.join(job.timeout)
+
+        status = "success"
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            status = "timeout"
+        elif process.exitcode != 0:
+            status = "failed"
+
+        seconds = time.perf_counter() - start
+        self.record_end(run_id, status, process.exitcode, seconds)
+        logger.info(f"{job.name} finished: {status} in {seconds:.1f}s")
+
+        return status, process.exitcode, seconds
+
+    def start(self, job):
+        with self.lock:
+            job.running = True
+
+        thread = threading.Thread(
+            target=self.execute, args=(job,), name=job.name
+        )
+        thread.start()
+        self.threads.append(thread)
+
+    def tick(self, now):
+        for job in self.jobs.values():
+            if job.running or job.next_run > now:
+                continue
+
+            reason = self.is_blocked(job)
+            if reason == "waiting":
+                continue
+
+            # Fixed rate, a long run does not shift the schedule.
+            job.next_run = max(job.next_run + job.interval, now)
+
+            if reason == "blocked":
+                logger.warning(f"{job.name} skipped, a dependency failed")
+                self.record_start(job, None, status="blocked")
+                continue
+
+            self.start(job)
+
+        self.threads = [t for t in self.threads if t.is_alive()]
+
+    def run_forever(self):
+        while not self.stopped.is_set():
+            self.tick(time.time())
+            self.stopped.wait(TICK)
+
+        logger.info("Stopping, waiting for running jobs")
+        for thread in self.threads:
+            thread.join()
+
+    def run_once(self):
+        """Run every job once, dependencies first."""
+        for job in self.jobs.values():
+            job.next_run = 0
+
+        while not self.stopped.is_set():
+            pending = [
+                job
+                for job in self.jobs.values()
+                if job.next_run == 0 or job.running
+            ]
+            if len(pending) == 0:
+                break
+
+            for job in pending:
+                if job.running:
+                    continue
+                reason = self.is_blocked(job)
+                if reason == "waiting":
+                    continue
+
+                # Dependencies still to run first.
+                if any(self.jobs[d].next_run == 0 for d in job.depends):
+                    continue
+
+                job.next_run = time.time()
+                if reason == "blocked":
+                    logger.warning(f"{job.name} skipped, a dependency failed")
+                    self.record_start(job, None, status="blocked")
+                    continue
+
+                self.start(job)
+
+            self.stopped.wait(TICK)
+
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option(
+        "-c", "--config", dest="config", default="scheduler.txt"
+    )
+    parser.add_option(
+        "--once",
+        dest="once",
+        action="store_true",
+        default=False,
+        help="Run every job once, dependencies first, and exit",
+    )
+    parser.add_option(
+        "--jobs", dest="jobs", help="Comma separated subset of the jobs"
+    )
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    config = ConfigParser()
+    if not config.read(options.config):
+        raise ValueError(f"Could not read {options.config}")
+
+    names = split(options.jobs) if options.jobs else None
+    scheduler = Scheduler(config, names)
+    os.makedirs(scheduler.log_dir, exist_ok=True)
+    scheduler.setup()
+
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+
+    if options.once:
+        scheduler.run_once()
+    else:
+        scheduler.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import importlib.util
+import sys
+
+from os.path import abspath, dirname, join
+
+import pytest
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.append(ROOT)
+
+from benchmarks.fixtures import synthesize  # noqa: E402
+from benchmarks.replay_server import start_servers  # noqa: E402
+from common.http import default_client  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fixtures_root(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("fixtures"))
+    synthesize(root, scale=0.1, upstreams=["gdacs", "usgs"])
+
+    return root
+
+
+@pytest.fixture(scope="session")
+def upstreams(fixtures_root):
+    """{name: base url} of the replay servers for the gdacs and usgs
+    fixtures."""
+    servers = start_servers(fixtures_root, names=["gdacs", "usgs"])
+
+    yield {name: upstream.url for name, (_, upstream) in servers.items()}
+
+    for server, _ in servers.values():
+        server.shutdown()
+
+
+@pytest.fixture
+def load_script(tmp_path, monkeypatch):
+    """Import a script as a new module with its command line arguments,
+    the way run.py runs it, with an empty conditional GET cache."""
+    client = default_client()
+    monkeypatch.setattr(client, "cache_dir", str(tmp_path / "http_cache"))
+    monkeypatch.setattr(client, "cache", None)
+
+    def load(path, *args):
+        path = join(ROOT, path)
+        monkeypatch.setattr(sys, "argv", [path] + list(args))
+        monkeypatch.chdir(dirname(path))
+
+        name = path[len(ROOT) + 1 : -3].replace("/", "_")
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        return module
+
+    return load
+
+
+def write_config(path, sections):
+    with open(path, "w") as f:
+        for section, values in sections.items():
+            f.write(f"[{section}]\n")
+            for key, value in values.items():
+                f.write(f"{key}={value}\n")
+
+    return str(path)
+
+
+@pytest.fixture
+def gdacs_config(tmp_path, upstreams):
+    """Config of gdacs.py and fetch_gdacs.py for the GDACS server at url,
+    the fixtures one by default. The database is never reached."""
+
+    def config(url=None):
+        return write_config(
+            tmp_path / "gdacs.txt",
+            dict(
+                GDACS=dict(
+                    URL=url or upstreams["gdacs"],
+                    CACHE_DIR=tmp_path / "episodes",
+                ),
+                PG=dict(
+                    HOST="localhost",
+                    USER="test",
+                    PW="",
+                    NAME="test",
+                    SCHEMA="test",
+                    PORT=5432,
+                ),
+            ),
+        )
+
+    return config
+
+
+@pytest.fixture
+def eq_config(tmp_path, fixtures_root, upstreams):
+    usgs = upstreams["usgs"]
+    return write_config(
+        tmp_path / "eq_historical.txt",
+        dict(
+            USGS=dict(
+                API_URL=f"{usgs}/fdsnws/event/1/query",
+                FEED_URL=f"{usgs}/earthquakes/feed/v1.0/summary/"
+                "all_hour.geojson",
+                COUNTRIES_FILE=join(fixtures_root, "usgs_countries.csv"),
+            ),
+            DB=dict(
+                SCHEMA="test",
+                URL="postgresql://test@localhost/test",
+                EVENTS_TABLE_NAME="eq_events",
+                SM_TABLE_NAME="eq_shakemaps",
+            ),
+        ),
+    )
@@ -0,0 +1,69 @@
+"""A second run against an unchanged feed, answered 304 by the replay
+server, writes nothing."""
+import sys
+import types
+
+
+class Geometry:
+    def Contains(self, other):
+        return True
+
+
+class Session:
+    def __init__(self, deletes):
+        self.deletes = deletes
+
+    def query(self, model):
+        return self
+
+    def filter(self, condition):
+        self.deletes.append(condition)
+        return self
+
+    def delete(self, synchronize_session=None):
+        return 0
+
+    def commit(self):
+        pass
+
+
+def test_gdacs_rss_unchanged(load_script, gdacs_config, monkeypatch):
+    gdacs = load_script("gdacs_tc/gdacs.py", "-c", gdacs_config(), "--rss")
+
+    processed = []
+    monkeypatch.setattr(gdacs, "process_rss_event", processed.append)
+
+    gdacs.update_database(gdacs.get_events_from_rss())
+    assert len(processed) > 0
+
+    processed.clear()
+    gdacs.update_database(gdacs.get_events_from_rss())
+    assert processed == []
+
+
+def test_eq_rss_unchanged(load_script, eq_config, monkeypatch):
+    eq = load_script("eq_historical/main.py", "-c", eq_config, "--rss")
+
+    ogr = types.SimpleNamespace(
+        CreateGeometryFromWkt=lambda wkt: Geometry(),
+        CreateGeometryFromJson=lambda geojson: Geometry(),
+    )
+    monkeypatch.setitem(sys.modules, "osgeo", types.SimpleNamespace(ogr=ogr))
+    monkeypatch.setitem(sys.modules, "osgeo.ogr", ogr)
+
+    deletes = []
+    parsed = []
+    monkeypatch.setattr(eq, "Session", lambda: Session(deletes))
+    monkeypatch.setattr(
+        eq, "parse_feature", lambda feature, iso3: parsed.append(feature)
+    )
+
+    eq.fetch_rss()
+    assert len(deletes) > 0
+    assert len(parsed) > 0
+
+    deletes.clear()
+    parsed.clear()
+    eq.fetch_rss()
+    assert deletes == []
+    assert parsed == []
@@ -0,0 +1,87 @@
+"""fetch_gdacs.py stores the same cyclone track as gdacs.py, the script it
+replaces."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from shapely import wkt
+
+from benchmarks.fixtures import HTML, FixtureWriter, listing
+from benchmarks.replay_server import start_servers
+
+EVENT_ID = 2000001
+PREFIX = "/datareport/resources/TC"
+PATH = f"{PREFIX}/{EVENT_ID}/"
+
+
+def point(episode, day):
+    return dict(
+        type="Feature",
+        geometry=dict(type="Point", coordinates=[10.0 + episode, -episode]),
+        properties=dict(
+            eventid=EVENT_ID,
+            eventname="STORM",
+            episodeid=episode,
+            eventtype="TC",
+            fromdate=day.isoformat(),
+            todate=day.isoformat(),
+            windspeed=100.0,
+        ),
+    )
+
+
+@pytest.fixture
+def multi_episode(tmp_path):
+    """Base url of a GDACS server with one cyclone whose episodes only
+    carry their own point, so the track needs all of them."""
+    root = str(tmp_path / "gdacs_fixtures")
+    writer = FixtureWriter(root, "gdacs")
+
+    files = []
+    day = datetime(2020, 1, 1)
+    for episode in range(1, 7):
+        path = f"{PATH}geojson_{EVENT_ID}_{episode}.geojson"
+        files.append(path)
+        writer.add(
+            path,
+            dict(type="FeatureCollection", features=[point(episode, day)]),
+        )
+        day += timedelta(hours=6)
+    writer.add(PATH, listing(files), **HTML)
+    writer.add(PREFIX, listing([PATH]), **HTML)
+    writer.save()
+
+    servers = start_servers(root, names=["gdacs"])
+    server, upstream = servers["gdacs"]
+
+    yield upstream.url
+
+    server.shutdown()
+
+
+def coordinates(shape):
+    return list(wkt.loads(shape.split(";")[-1]).coords)
+
+
+def test_track_matches_gdacs(
+    load_script, gdacs_config, multi_episode, monkeypatch
+):
+    config = gdacs_config(multi_episode)
+
+    gdacs = load_script("gdacs_tc/gdacs.py", "-c", config)
+    written = []
+    monkeypatch.setattr(gdacs.writer, "write_objects", written.extend)
+    gdacs.process_tc(PATH)
+    expected = [
+        coordinates(row.shape)
+        for row in written
+        if isinstance(row, gdacs.Track)
+    ]
+
+    fetch_gdacs = load_script("gdacs_tc/fetch_gdacs.py", "-c", config)
+    _, (nodes, tracks, _) = fetch_gdacs.process_tc(
+        multi_episode, PATH, fetch_gdacs.MIN_POINTS
+    )
+
+    assert len(nodes) == 6
+    assert [coordinates(shape) for shape, in tracks] == expected
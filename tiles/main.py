@@ -0,0 +1,390 @@
+"""Vector tiles of the hazard layers in MBTiles files.
+
+    python run.py tiles -c config.txt
+
+Renders the GDACS cyclone tables, the eq_historical shakemaps and the
+IBTrACS points with ST_AsMVT into one MBTiles file per tileset, ready to be
+served statically. Geometries are simplified to about a pixel of each zoom.
+The hash and bounding box of every event are kept in the MBTiles file, so a
+run only renders again the tiles covering events added, changed or removed
+since the last one.
+"""
+import gzip
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from configparser import ConfigParser
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+
+from sqlalchemy import text
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import LazyEngine, get_pool_capacity  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+
+logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+metrics = Metrics("tiles")
+
+# Half the width of the web mercator world in meters.
+WORLD = 20037508.342789244
+MAX_LATITUDE = 85.0511287798
+
+# Layers of each tileset: (config option in [LAYERS], layer name, column
+# grouping the rows of an event, attribute columns).
+TILESETS = dict(
+    gdacs=[
+        (
+            "BUFFERS",
+            "buffers",
+            "event_id",
+            ["event_id", "event_name", "episode_id", "label"],
+        ),
+        (
+            "TRACKS",
+            "tracks",
+            "event_id",
+            ["event_id", "event_name", "episode_id"],
+        ),
+        (
+            "NODES",
+            "nodes",
+            "event_id",
+            ["event_id", "event_name", "wind_speed", "released_date"],
+        ),
+    ],
+    shakemaps=[
+        ("SHAKEMAPS", "shakemaps", "eq_id", ["eq_id", "mmi", "time", "iso3"])
+    ],
+    ibtracs=[
+        (
+            "IBTRACS",
+            "ibtracs",
+            "sid",
+            ["sid", "name", "season", "basin", "nature", "iso_time"],
+        )
+    ],
+)
+
+
+def tile_size(zoom):
+    return 2 * WORLD / 2**zoom
+
+
+def tile_range(bbox, zoom, margin):
+    """(x0, y0, x1, y1) of the tiles of zoom covering bbox in lon/lat,
+    widened by margin, a fraction of a tile."""
+    minx, miny, maxx, maxy = bbox
+    n = 2**zoom
+
+    def column(lon):
+        return (lon + 180) / 360 * n
+
+    def row(lat):
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        return (1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n
+
+    x0 = max(0, int(column(minx) - margin))
+    x1 = min(n - 1, int(column(maxx) + margin))
+    y0 = max(0, int(row(maxy) - margin))
+    y1 = min(n - 1, int(row(miny) + margin))
+
+    return x0, y0, x1, y1
+
+
+def open_mbtiles(path):
+    db = sqlite3.connect(path)
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS metadata (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tiles (
+            zoom_level INTEGER,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_data BLOB,
+            PRIMARY KEY (zoom_level, tile_column, tile_row)
+        );
+        CREATE TABLE IF NOT EXISTS features (
+            layer TEXT,
+            key TEXT,
+            hash TEXT,
+            minx REAL,
+            miny REAL,
+            maxx REAL,
+            maxy REAL,
+            PRIMARY KEY (layer, key)
+        );
+        """
+    )
+
+    return db
+
+
+class Tileset:
+    def __init__(self, name, engine, config):
+        self.name = name
+        self.engine = engine
+        self.tables = [
+            (config.get("LAYERS", option), layer, key, columns)
+            for option, layer, key, columns in TILESETS[name]
+            if config.get("LAYERS", option, fallback=None)
+        ]
+
+        settings = config["TILES"]
+        self.min_zoom = settings.getint("MIN_ZOOM", 0)
+        self.max_zoom = settings.getint("MAX_ZOOM", 8)
+        self.extent = settings.getint("EXTENT", 4096)
+        self.buffer = settings.getint("BUFFER", 64)
+        # One connection per thread, within the pool the scheduler allows.
+        self.workers = min(settings.getint("WORKERS", 4), get_pool_capacity())
+        self.path = join(settings.get("DIR", "."), f"{name}.mbtiles")
+
+    def get_features(self, conn, table, key, columns):
+        """Hash and bounding box of every event of table."""
+        attributes = ", ".join(columns)
+        rows = conn.execute(
+            f"""
+            SELECT
+                {key}::text AS key,
+                md5(string_agg(
+                    md5(ST_AsEWKB(shape)) || md5(ROW({attributes})::text),
+                    '' ORDER BY id
+                )) AS hash,
+                ST_XMin(ST_Extent(shape)),
+                ST_YMin(ST_Extent(shape)),
+                ST_XMax(ST_Extent(shape)),
+                ST_YMax(ST_Extent(shape))
+            FROM {table}
+            WHERE shape IS NOT NULL
+            GROUP BY {key}
+            """
+        )
+
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def get_changes(self, db, layer, features):
+        """Bounding boxes of the events added, changed or removed."""
+        stored = {
+            key: (hash_, minx, miny, maxx, maxy)
+            for key, hash_, minx, miny, maxx, maxy in db.execute(
+                "SELECT key, hash, minx, miny, maxx, maxy FROM features "
+                "WHERE layer = ?",
+                (layer,),
+            )
+        }
+
+        boxes = []
+        for key, feature in features.items():
+            old = stored.get(key)
+            if old is not None and old[0] == feature[0]:
+                continue
+            boxes.append(feature[1:])
+            if old is not None:
+                boxes.append(old[1:])
+        for key in stored.keys() - features.keys():
+            boxes.append(stored[key][1:])
+
+        return boxes
+
+    def dirty_tiles(self, boxes):
+        tiles = set()
+        margin = self.buffer / self.extent
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            for bbox in boxes:
+                x0, y0, x1, y1 = tile_range(bbox, zoom, margin)
+                tiles.update(
+                    (zoom, x, y)
+                    for x in range(x0, x1 + 1)
+                    for y in range(y0, y1 + 1)
+                )
+
+        return tiles
+
+    def tile_sql(self):
+        """One ST_AsMVT layer per table, concatenated into the tile."""
+        layers = []
+        for table, layer, _, columns in self.tables:
+            layers.append(
+                f"""
+                (SELECT coalesce(ST_AsMVT(t, '{layer}', :extent, 'geom'), '')
+                FROM (
+                    SELECT {", ".join(columns)}, ST_AsMVTGeom(
+                        ST_Simplify(
+                            ST_Transform(shape, 3857), :tolerance, true
+                        ),
+                        ST_TileEnvelope(:z, :x, :y),
+                        :extent,
+                        :buffer,
+                        true
+                    ) AS geom
+                    FROM {table}
+                    WHERE shape && ST_Transform(
+                        ST_Expand(ST_TileEnvelope(:z, :x, :y), :margin), 4326
+                    )
+                ) AS t
+                WHERE geom IS NOT NULL)
+                """
+            )
+
+        return text("SELECT " + " || ".join(layers))
+
+    def render(self, sql, tiles):
+        """(tile, data) of tiles, empty data when no layer reaches it."""
+        rendered = []
+        with self.engine.connect() as conn:
+            for z, x, y in tiles:
+                size = tile_size(z)
+                data = conn.execute(
+                    sql,
+                    z=z,
+                    x=x,
+                    y=y,
+                    extent=self.extent,
+                    buffer=self.buffer,
+                    # About one pixel of a 256px tile.
+                    tolerance=size / 256,
+                    margin=size * self.buffer / self.extent,
+                ).scalar()
+                rendered.append(((z, x, y), bytes(data or b"")))
+
+        return rendered
+
+    def write_metadata(self, db):
+        vector_layers = [
+            dict(
+                id=layer,
+                fields={c: "String" for c in columns},
+                minzoom=self.min_zoom,
+                maxzoom=self.max_zoom,
+            )
+            for _, layer, _, columns in self.tables
+        ]
+        metadata = dict(
+            name=self.name,
+            format="pbf",
+            type="overlay",
+            minzoom=self.min_zoom,
+            maxzoom=self.max_zoom,
+            bounds="-180,-85.0511,180,85.0511",
+            center=f"0,0,{self.min_zoom}",
+            json=json.dumps(dict(vector_layers=vector_layers)),
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+            [(k, str(v)) for k, v in metadata.items()],
+        )
+
+    def update(self, full=False):
+        if len(self.tables) == 0:
+            return
+
+        db = open_mbtiles(self.path)
+        if full:
+            db.execute("DELETE FROM tiles")
+            db.execute("DELETE FROM features")
+
+        with metrics.stage(f"{self.name}_changes"):
+            boxes = []
+            states = {}
+            with self.engine.connect() as conn:
+                for table, layer, key, columns in self.tables:
+                    features = self.get_features(conn, table, key, columns)
+                    boxes += self.get_changes(db, layer, features)
+                    states[layer] = features
+
+            tiles = sorted(self.dirty_tiles(boxes))
+
+        logging.info(
+            f"{self.name}: {len(boxes)} changed extents, "
+            f"{len(tiles)} tiles to render"
+        )
+        metrics.count(f"{self.name}_tiles", len(tiles))
+
+        sql = self.tile_sql()
+        written = deleted = 0
+        with metrics.stage(f"{self.name}_render"):
+            chunks = [tiles[i::self.workers] for i in range(self.workers)]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self.render, sql, chunk)
+                    for chunk in chunks
+                    if chunk
+                ]
+                for future in as_completed(futures):
+                    for (z, x, y), data in future.result():
+                        # MBTiles rows count from the south.
+                        row = 2**z - 1 - y
+                        if len(data) == 0:
+                            db.execute(
+                                "DELETE FROM tiles WHERE zoom_level = ? "
+                                "AND tile_column = ? AND tile_row = ?",
+                                (z, x, row),
+                            )
+                            deleted += 1
+                            continue
+
+                        db.execute(
+                            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                            (z, x, row, gzip.compress(data)),
+                        )
+                        written += 1
+
+        # Tiles and event states are committed together.
+        for layer, features in states.items():
+            db.execute("DELETE FROM features WHERE layer = ?", (layer,))
+            db.executemany(
+                "INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(layer, k) + v for k, v in features.items()],
+            )
+        self.write_metadata(db)
+        db.commit()
+        db.close()
+
+        metrics.rows(self.name, inserted=written, deleted=deleted)
+        logging.info(
+            f"{self.path}: {written} tiles written, {deleted} emptied"
+        )
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="config", default="config.txt")
+    parser.add_option(
+        "-t",
+        "--tilesets",
+        dest="tilesets",
+        default=",".join(TILESETS),
+        help="Comma separated subset of " + ",".join(TILESETS),
+    )
+    parser.add_option(
+        "--full",
+        dest="full",
+        action="store_true",
+        default=False,
+        help="Render every tile again, e.g. after changing the zooms",
+    )
+    options, _ = parser.parse_args()
+
+    config = ConfigParser()
+    if not config.read(options.config):
+        raise ValueError(f"Could not read {options.config}")
+
+    os.makedirs(config.get("TILES", "DIR", fallback="."), exist_ok=True)
+
+    engine = LazyEngine(config.get("DB", "URL"), application_name="tiles")
+    for name in options.tilesets.split(","):
+        Tileset(name, engine, config).update(options.full)
+
+
+if __name__ == "__main__":
+    with metrics.run():
+        main()
@@ -1,12 +1,19 @@
+import csv
+import hashlib
+import json
 import logging
-import requests
+import os
+import sys
 from configparser import ConfigParser
-from os.path import join
-from arcgis.features import FeatureLayerCollection
-from arcgis.gis import GIS
+from os.path import abspath, dirname, exists, join
 
 from optparse import OptionParser
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from common.chunked_upload import batches, to_feature  # noqa: E402
+from common.http import HttpClient  # noqa: E402
+
 parser = OptionParser()
 parser.add_option("-c", "--config", dest="config", default="config.txt")
 options, _ = parser.parse_args()
@@ -14,12 +21,14 @@ options, _ = parser.parse_args()
 logger = logging.getLogger()
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
-def upload_arcgis():
-    ARCGIS_USER = config.get("ARCGIS", "USER")
-    ARCGIS_PW = config.get("ARCGIS", "PW")
-    ARCGIS_URL = config.get("ARCGIS", "URL")
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 120
 
-    gis = GIS(ARCGIS_URL, ARCGIS_USER, ARCGIS_PW)
+
+def upload_arcgis(gis):
+    from arcgis.features import FeatureLayerCollection
+
+    ARCGIS_USER = config.get("ARCGIS", "USER")
     content_data = f"title:{FILENAME} type:CSV owner:{ARCGIS_USER}"
 
     items = gis.content.search(content_data)
@@ -33,7 +42,7 @@ def upload_arcgis():
         feature_layer = FeatureLayerCollection.fromitem(feature_layer_item)
         feature_layer.manager.overwrite(TEMP_PATH)
 
-        return
+        return feature_layer_item.layers[0]
 
     logger.info("Uploading file to Arcgis")
     item = gis.content.add(item_params, data=TEMP_PATH)
@@ -49,18 +58,258 @@ def upload_arcgis():
         longitudeFieldName="X",
     )
 
-    item = item.publish(publish_parameters=publish_params, overwrite=overwrite)
+    item = item.publish(publish_parameters=publish_params)
     item.share(everyone=True)
 
+    return item.layers[0]
+
+
+def get_feature_layer(gis):
+    ARCGIS_USER = config.get("ARCGIS", "USER")
+    content_data = f"title:{FILENAME} type:Feature Service owner:{ARCGIS_USER}"
+
+    item = next((i for i in gis.content.search(content_data)), None)
+    if item is None:
+        return None
+
+    return item.layers[0]
+
+
+def normalize_id(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value).strip()
+
+    return str(int(number)) if number.is_integer() else str(number)
+
+
+def row_hash(row):
+    content = json.dumps(row, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+def row_key(row):
+    # Without an id column a row is identified by its location and
+    # attributes, so changes show up as a delete plus an add.
+    if ID_FIELD is None:
+        return row_hash(row)
+
+    return normalize_id(row[ID_FIELD])
+
+
+def read_rows(path):
+    with open(path, "r", newline="") as f:
+        return [r for r in csv.DictReader(f)]
+
+
+def load_snapshot():
+    if not exists(SNAPSHOT_PATH):
+        return None
+
+    with open(SNAPSHOT_PATH, "r") as f:
+        snapshot = json.load(f)
+
+    # Keys built with another id column are useless.
+    if snapshot.get("id_field") != ID_FIELD:
+        return None
+
+    return snapshot["rows"]
+
+
+def save_snapshot(rows):
+    with open(f"{SNAPSHOT_PATH}.tmp", "w") as f:
+        json.dump(dict(id_field=ID_FIELD, rows=rows), f)
+    os.replace(f"{SNAPSHOT_PATH}.tmp", SNAPSHOT_PATH)
+
+
+def build_snapshot(layer, rows):
+    """Map every csv row to the object id it got in a freshly published
+    layer, matching on the id column or on the point location."""
+    oid_field = layer.properties.objectIdField
+
+    snapshot = {}
+    if ID_FIELD is not None:
+        result = layer.query(
+            out_fields=f"{oid_field},{ID_FIELD}", return_geometry=False
+        )
+        object_ids = {
+            normalize_id(f.attributes[ID_FIELD]): f.attributes[oid_field]
+            for f in result.features
+        }
+
+        for row in rows:
+            key = row_key(row)
+            snapshot[key] = dict(hash=row_hash(row), oid=object_ids.get(key))
+
+        return snapshot
+
+    result = layer.query(out_fields=oid_field, out_sr=4326)
+
+    locations = {}
+    for feature in sorted(
+        result.features, key=lambda f: f.attributes[oid_field]
+    ):
+        location = (
+            round(feature.geometry["x"], 6),
+            round(feature.geometry["y"], 6),
+        )
+        locations.setdefault(location, []).append(
+            feature.attributes[oid_field]
+        )
+
+    # Rows sharing a location were published in csv order.
+    for row in rows:
+        location = (round(float(row["X"]), 6), round(float(row["Y"]), 6))
+        object_ids = locations.get(location) or [None]
+        snapshot[row_key(row)] = dict(
+            hash=row_hash(row), oid=object_ids.pop(0)
+        )
+
+    return snapshot
+
+
+def diff(snapshot, rows):
+    current = {row_key(r): r for r in rows}
+
+    adds = [k for k in current if k not in snapshot]
+    updates = [
+        k
+        for k in current
+        if k in snapshot and snapshot[k]["hash"] != row_hash(current[k])
+    ]
+    deletes = [k for k in snapshot if k not in current]
+
+    return current, adds, updates, deletes
+
+
+def check_edit_results(results):
+    errors = [r for r in results if r.get("success") is not True]
+    if len(errors) > 0:
+        raise ValueError(
+            f"{len(errors)} edits failed: {errors[0].get('error')}"
+        )
+
+
+def publish_changes(layer, snapshot, rows):
+    """Send only added, updated and deleted rows. Returns False when the
+    layer has to be republished instead."""
+    if len(set(row_key(r) for r in rows)) != len(rows):
+        logger.warning("Duplicated row keys, falling back to overwrite")
+        return False
+
+    current, adds, updates, deletes = diff(snapshot, rows)
+    logger.info(
+        f"{len(adds)} rows added, {len(updates)} updated, "
+        f"{len(deletes)} deleted"
+    )
+
+    num_changes = len(adds) + len(updates) + len(deletes)
+    if num_changes > MAX_DIFF_RATIO * max(len(rows), 1):
+        logger.info("Too many changes, falling back to overwrite")
+        return False
+
+    if any(snapshot[k]["oid"] is None for k in updates + deletes):
+        logger.warning("Unknown object ids, falling back to overwrite")
+        return False
+
+    oid_field = layer.properties.objectIdField
+
+    # The snapshot is saved after every batch, a failure halfway leaves it
+    # matching the layer.
+    for keys in batches(deletes, BATCH_SIZE):
+        result = layer.edit_features(
+            deletes=",".join(str(snapshot[k]["oid"]) for k in keys)
+        )
+        check_edit_results(result.get("deleteResults", []))
+        for key in keys:
+            del snapshot[key]
+        save_snapshot(snapshot)
+
+    for keys in batches(updates, BATCH_SIZE):
+        features = []
+        for key in keys:
+            feature = to_feature(current[key], "X", "Y")
+            feature["attributes"][oid_field] = snapshot[key]["oid"]
+            features.append(feature)
+
+        result = layer.edit_features(updates=features)
+        check_edit_results(result.get("updateResults", []))
+        for key in keys:
+            snapshot[key]["hash"] = row_hash(current[key])
+        save_snapshot(snapshot)
+
+    for keys in batches(adds, BATCH_SIZE):
+        features = [to_feature(current[k], "X", "Y") for k in keys]
+
+        result = layer.edit_features(adds=features)
+        add_results = result.get("addResults", [])
+        check_edit_results(add_results)
+        for key, add_result in zip(keys, add_results):
+            snapshot[key] = dict(
+                hash=row_hash(current[key]), oid=add_result.get("objectId")
+            )
+        save_snapshot(snapshot)
+
+    return True
+
+
+def download(url, path):
+    """Stream the sheet to path and return the sha256 of its content."""
+    digest = hashlib.sha256()
+
+    http = HttpClient(timeout=TIMEOUT)
+    with http.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        with open(f"{path}.part", "wb") as f:
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+
+    os.replace(f"{path}.part", path)
+
+    return digest.hexdigest()
+
+
+def get_published_hash():
+    if not exists(HASH_PATH):
+        return None
+
+    with open(HASH_PATH, "r") as f:
+        return f.read().strip()
+
 
 def main():
     logger.info("Downloading data")
-    resp = requests.get(config.get("MISC", "GOOGLE_URL"))
-    with open(TEMP_PATH, "wb") as f:
-        for chunk in resp.iter_content():
-            f.write(chunk)
+    content_hash = download(config.get("MISC", "GOOGLE_URL"), TEMP_PATH)
+
+    if content_hash == get_published_hash():
+        logger.info("Sheet unchanged since last publish, skipping")
+        return
+
+    # arcgis takes seconds to import, unchanged runs never load it.
+    from arcgis.gis import GIS
+
+    ARCGIS_USER = config.get("ARCGIS", "USER")
+    ARCGIS_PW = config.get("ARCGIS", "PW")
+    ARCGIS_URL = config.get("ARCGIS", "URL")
+
+    gis = GIS(ARCGIS_URL, ARCGIS_USER, ARCGIS_PW)
+
+    rows = read_rows(TEMP_PATH)
+    layer = get_feature_layer(gis)
+    snapshot = load_snapshot()
+
+    published = False
+    if layer is not None and snapshot is not None:
+        published = publish_changes(layer, snapshot, rows)
+
+    if published is False:
+        layer = upload_arcgis(gis)
+        save_snapshot(build_snapshot(layer, rows))
 
-    upload_arcgis()
+    with open(HASH_PATH, "w") as f:
+        f.write(content_hash)
 
 
 if __name__ == "__main__":
@@ -69,8 +318,13 @@ if __name__ == "__main__":
 
     FILENAME = config.get("MISC", "FILENAME")
     PATH = config.get("MISC", "PATH")
+    ID_FIELD = config.get("MISC", "ID_FIELD", fallback=None) or None
+    BATCH_SIZE = config.getint("MISC", "BATCH_SIZE", fallback=500)
+    MAX_DIFF_RATIO = config.getfloat("MISC", "MAX_DIFF_RATIO", fallback=0.5)
 
     TEMP_PATH = join(PATH, f"{FILENAME}.csv")
+    HASH_PATH = join(PATH, f"{FILENAME}.sha256")
+    SNAPSHOT_PATH = join(PATH, f"{FILENAME}.snapshot.json")
 
     main()
 
@@ -1,13 +1,14 @@
 import logging
-import requests
 from datetime import datetime
 
 import optparse
 import os
+import sys
 
 from dotenv import load_dotenv
+from os.path import abspath, dirname
+
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
@@ -15,18 +16,25 @@ from sqlalchemy import (
 )
 from sqlalchemy.schema import CreateSchema
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 from geoalchemy2 import Geometry
 from sqlalchemy.exc import ProgrammingError
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+from common.db import BulkWriter, LazyEngine  # noqa: E402
+from common.http import default_client  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
 load_dotenv("config.env")
 
-engine = create_engine(os.getenv("DB_URL"))
-Session = sessionmaker(bind=engine)
-session = Session()
+engine = LazyEngine(
+    os.getenv("DB_URL"), application_name="ts_historical"
+)
+writer = BulkWriter(engine)
+metrics = Metrics("ts_historical")
+metrics.include(writer=writer)
 
 Base = declarative_base()
 
@@ -100,8 +108,6 @@ def parse(item):
     )
     obj["id"] = obj_id
 
-    obj = Ibtracs(**obj)
-
     return obj
 
 
@@ -126,30 +132,34 @@ def main():
 
     file_name = os.getenv(url_field)
     logging.info(f"Using file name {file_name}")
-    resp = requests.post(file_name)
-    if resp.status_code != 200:
-        raise ValueError("Could not download data")
-
-    data = [d.split(",") for d in resp.content.decode("utf-8").splitlines()]
-
-    # Parse to dict.
-    data = [parse(d) for d in data[2:]]
-
-    search_ids = (
-        session.query(Ibtracs.id)
-        .filter(Ibtracs.id.in_([d.id for d in data]))
-        .all()
+    client = default_client()
+    metrics.include(client=client)
+    with metrics.stage("fetch"):
+        resp = client.post(file_name, retry=True)
+        if resp.status_code != 200:
+            raise ValueError("Could not download data")
+
+    with metrics.stage("parse"):
+        data = [
+            d.split(",") for d in resp.content.decode("utf-8").splitlines()
+        ]
+
+        # Parse to dict.
+        data = [parse(d) for d in data[2:]]
+
+    # Rows already in the table are skipped by the database.
+    columns = [c.name for c in Ibtracs.__table__.columns]
+    with metrics.stage("write"):
+        inserted = writer.upsert(Ibtracs.__table__, columns, data, ["id"])
+
+    logging.info(f"Inserted {inserted} new rows of {len(data)}")
+    metrics.rows(
+        Ibtracs.__tablename__, inserted=inserted, skipped=len(data) - inserted
     )
-    search_ids = [s.id for s in search_ids]
-
-    # Filter already created.
-    data = [d for d in data if d.id not in search_ids]
-
-    logging.info(f"Skipping ids {search_ids}")
-
-    session.add_all(data)
-    session.commit()
+    writer.log_metrics()
+    client.stats.log()
 
 
 if __name__ == "__main__":
-    main()
+    with metrics.run():
+        main()